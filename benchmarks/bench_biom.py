@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Reading of a BIOM table (AbundanceTable._funcBiomToStructuredArray) with
+# 100k observations, with taxonomy metadata on the observations and class
+# metadata on the samples, written to a temporary JSON BIOM file.
+#
+#   python benchmarks/bench_biom.py [--observations 100000] [--samples 50] [--density 0.05]
+#
+# The conversion of the loaded table is timed against the implementation it
+# replaced (legacy, copied below), which went through Table.to_json and one
+# tuple per observation, and the two results are checked to be the same.
+
+import os,json,time,tempfile,argparse
+import numpy as np
+import scipy.sparse
+from biom import load_table
+from biom.table import Table
+from lefsebiom.AbundanceTable import AbundanceTable,RowMetadata
+from lefsebiom.ConstantsBreadCrumbs import ConstantsBreadCrumbs
+
+def legacy(BiomTable):
+    BiomCommonArea = dict()
+    dBugNames = list()
+    dRowsMetadata = None
+    BiomElements = json.loads(BiomTable.to_json(''))
+    for BiomKey, BiomValue in BiomElements.items():
+        if (BiomKey == ConstantsBreadCrumbs.c_strFormatKey
+        or BiomKey == ConstantsBreadCrumbs.c_strFormatUrl
+        or BiomKey == ConstantsBreadCrumbs.c_MatrixTtype
+        or BiomKey == ConstantsBreadCrumbs.c_strTypekey
+        or BiomKey == ConstantsBreadCrumbs.c_strIDKey
+        or BiomKey == ConstantsBreadCrumbs.c_GeneratedBy
+        or BiomKey == ConstantsBreadCrumbs.c_strDateKey):
+            BiomCommonArea = AbundanceTable._funcInsertKeyToCommonArea(BiomCommonArea, BiomKey, BiomValue)
+        if BiomKey == ConstantsBreadCrumbs.c_rows:
+            iMaxIdLen = 0
+            for iIndexRowMetaData in range(0, len(BiomValue)):
+                if ConstantsBreadCrumbs.c_id_lowercase in BiomValue[iIndexRowMetaData]:
+                    sBugName = BiomValue[iIndexRowMetaData][ConstantsBreadCrumbs.c_id_lowercase]
+                    dBugNames.append(sBugName)
+                    if len(sBugName) > iMaxIdLen:
+                        iMaxIdLen = len(sBugName)
+            if ConstantsBreadCrumbs.c_metadata_lowercase in BiomValue[0] and BiomValue[0][ConstantsBreadCrumbs.c_metadata_lowercase] != None:
+                dRowsMetadata = AbundanceTable._funcBiomBuildRowMetadata(BiomValue, iMaxIdLen)
+        if BiomKey == ConstantsBreadCrumbs.c_columns:
+            BiomCommonArea = AbundanceTable._funcDecodeBiomMetadata(BiomCommonArea, BiomValue, iMaxIdLen)
+    BiomTaxDataWork = list()
+    for BiomObservationData in BiomTable.iter(axis='observation'):
+        BiomTaxDataEntry = [BiomObservationData[1]]
+        BiomTaxDataEntry.extend(BiomObservationData[0].tolist())
+        BiomTaxDataWork.append(tuple(BiomTaxDataEntry))
+    BiomCommonArea[ConstantsBreadCrumbs.c_BiomTaxData] = np.array(BiomTaxDataWork,dtype=np.dtype(BiomCommonArea[ConstantsBreadCrumbs.c_Dtype]))
+    BiomCommonArea[ConstantsBreadCrumbs.c_dRowsMetadata] = RowMetadata(dRowsMetadata)
+    del(BiomCommonArea[ConstantsBreadCrumbs.c_Dtype])
+    return BiomCommonArea
+
+def write_table(fn, nobs, nsamp, density, seed = 1982):
+    rng = np.random.RandomState(seed)
+    m = scipy.sparse.random(nobs, nsamp, density, format='csr', random_state=rng, data_rvs=lambda n: rng.randint(1,1000,n).astype(float))
+    lev = ['k','p','c','o','f','g','s']
+    omd = [{'taxonomy': [l+"__"+l.upper()+str(i % (7**(j+1))) for j,l in enumerate(lev)]} for i in range(nobs)]
+    smd = [{'Group': "g%d" % (j % 3), 'Sub': "s%d" % (j % 2)} for j in range(nsamp)]
+    t = Table(m, ["OTU_%d" % i for i in range(nobs)], ["S%d" % j for j in range(nsamp)], omd, smd, table_id="bench", type="OTU table")
+    with open(fn, 'w') as out: out.write(t.to_json("bench_biom"))
+
+def timed(f, *args):
+    t0 = time.perf_counter()
+    ret = f(*args)
+    return time.perf_counter()-t0, ret
+
+def check(ref, res):
+    assert set(ref) == set(res)
+    for k in ref:
+        if k == ConstantsBreadCrumbs.c_BiomTaxData:
+            assert ref[k].dtype == res[k].dtype and (ref[k] == res[k]).all()
+        elif k == ConstantsBreadCrumbs.c_dRowsMetadata:
+            assert ref[k].dictRowMetadata == res[k].dictRowMetadata
+        elif k == ConstantsBreadCrumbs.c_BiomFileInfo:
+            assert dict([i for i in ref[k].items() if i[0] != 'date']) == dict([i for i in res[k].items() if i[0] != 'date'])
+        else:
+            assert ref[k] == res[k], k
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the reading of BIOM tables")
+    parser.add_argument('--observations', type=int, default=100000)
+    parser.add_argument('--samples', type=int, default=50)
+    parser.add_argument('--density', type=float, default=0.05)
+    args = parser.parse_args()
+
+    fd, fn = tempfile.mkstemp(suffix=".biom")
+    os.close(fd)
+    try:
+        write_table(fn, args.observations, args.samples, args.density)
+        print("%d observations x %d samples, %.1f MB" % (args.observations,args.samples,os.path.getsize(fn)/2.0**20))
+        t_load, table = timed(load_table, fn)
+        print("load_table                    %7.2f s" % t_load)
+        t_new, new = timed(AbundanceTable._funcBiomToStructuredArray, table)
+        print("_funcBiomToStructuredArray    %7.2f s" % t_new)
+        t_old, old = timed(legacy, table)
+        print("legacy                        %7.2f s" % t_old)
+        check(old, new)
+    finally:
+        os.remove(fn)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Construction of the cladogram tree (lefse_plot_cladogram.build_tree) on
+# random 6-level taxonomies of about 1k, 10k and 50k clades.
+#
+#   python benchmarks/bench_build_tree.py [--clades 1000 10000 50000] [--legacy_max 50000]
+#
+# build_tree is timed against the old implementation (copied below), which
+# scanned all the nodes below the father with cmp_names at every level and
+# is only run up to --legacy_max clades. The two trees are checked to be the
+# same.
+
+import time,random,argparse
+import matplotlib
+matplotlib.use('Agg')
+from lefse import lefse_plot_cladogram as clad
+
+def legacy_cmp_names(la,lb):
+    if len(la) != len(lb): return False
+    for p in [(a,b) for i,a in enumerate(la) for j,b in enumerate(lb) if i == j]:
+        if p[0] != p[1]: return False
+    return True
+
+def legacy_build_tree(father,all_nodes,l,depth,viz):
+    cc = [n for n in all_nodes if len(n.name) > len(father.name) and legacy_cmp_names(father.name,n.name[:len(father.name)])]
+    children = [n for n in cc if len(n.name) == len(father.name)+1]
+    if len(children) == 0 and l < depth -1: # !!!
+        nc = clad.CladeNode(father.id+"."+father.id.split(".")[-1],1.0,viz)
+        father.add_child(nc)
+        children.append(nc)
+    for child in children:
+        legacy_build_tree(child,cc,l+1,depth,viz)
+        father.add_child(child)
+
+def clade_names(n, seed = 1982):
+    # every clade with all its ancestors, some ending before the last level
+    r = random.Random(seed)
+    fan = max(2,int(round((n/2.0)**(1.0/5))))+1
+    names = set()
+    while len(names) < n:
+        d = r.randint(3,6)
+        name = tuple("l%d_%d" % (i,r.randint(0,fan)) for i in range(d))
+        names.update([".".join(name[:k]) for k in range(1,d+1)])
+    return sorted(names)
+
+def timed(build, names):
+    all_nodes = [clad.CladeNode("root."+n,1.0) for n in names]
+    depth = max([len(n.name) for n in all_nodes])
+    root = clad.CladeNode("root",-1.0)
+    t0 = time.perf_counter()
+    build(root,all_nodes,0,depth,True)
+    return time.perf_counter()-t0, [n.id for n in clad.get_all_nodes(root)]
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the construction of the cladogram tree")
+    parser.add_argument('--clades', type=int, nargs='+', default=[1000,10000,50000])
+    parser.add_argument('--legacy_max', type=int, default=50000)
+    args = parser.parse_args()
+
+    for n in args.clades:
+        names = clade_names(n)
+        t_new, new = timed(clad.build_tree, names)
+        line = "%6d clades  build_tree %7.3f s" % (len(names),t_new)
+        if n <= args.legacy_max:
+            t_old, old = timed(legacy_build_tree, names)
+            assert old == new
+            line += "  legacy %7.3f s" % t_old
+        print(line)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Memory and traversal time of the cladogram tree (lefse_plot_cladogram
+# CladeNode) of a random taxonomy of about 100k clades, up to 7 levels.
+#
+#   python benchmarks/bench_clade_nodes.py [--clades 100000]
+#
+# The tree is read with read_tree using CladeNode and then the node class it
+# replaced (legacy, copied below: no slots, a dict of children sorted on
+# every get_children). The memory is the one still allocated after
+# read_tree (tracemalloc), the traversal is get_all_nodes followed by three
+# get_children on every node, as add_all_pos and draw_tree do.
+
+import time,random,argparse,tracemalloc
+import matplotlib
+matplotlib.use('Agg')
+from lefse import lefse_plot_cladogram as clad
+
+class LegacyCladeNode:
+    def __init__(self, name, abundance, viz=True):
+        self.id = name
+        self.name = name.split('.')
+        self.last_name = self.name[-1]
+        self.abundance = abundance
+        self.pos = (-1.0, -1.0)
+        self.children = {}
+        self.isleaf = True
+        self.color = 'y'
+        self.next_leaf = -1
+        self.prev_leaf = -1
+        self.viz = viz
+    def __repr__(self):
+        return self.last_name
+    def add_child(self, node):
+        self.isleaf = False
+        self.children[node.__repr__()] = node
+    def get_children(self):
+        return [self.children[k] for k in sorted(self.children.keys())]
+    def get_color(self):
+        return self.color
+    def set_color(self, c):
+        self.color = c
+    def set_pos(self, pos):
+        self.pos = pos
+
+def legacy_get_all_nodes(father):
+    ret = [father]
+    children = father.get_children()
+    for c in children:
+        ret += legacy_get_all_nodes(c)
+    return ret
+
+def res_lines(n, seed = 0):
+    r = random.Random(seed)
+    names = set()
+    while len(names) < n:
+        d = r.randint(1,7)
+        name = tuple("t%d_%d" % (i,r.randint(0,12)) for i in range(d))
+        names.update([".".join(name[:k]) for k in range(1,d+1)])
+    return ["%s\t%.3f\t-\t\t-\n" % (name,r.random()*5) for name in sorted(names)]
+
+def measure(lines, node_class, get_all_nodes):
+    params = clad.read_params(["", "in.res", "out.png"])
+    saved = clad.CladeNode
+    clad.CladeNode = node_class
+    try:
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        tree = clad.read_tree(lines, params)
+        t_read = time.perf_counter()-t0
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    finally:
+        clad.CladeNode = saved
+    t0 = time.perf_counter()
+    nodes = get_all_nodes(tree['root'])
+    for i in range(3):
+        for n in nodes: n.get_children()
+    return len(nodes), t_read, mem, time.perf_counter()-t0
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the nodes of the cladogram tree")
+    parser.add_argument('--clades', type=int, default=100000)
+    args = parser.parse_args()
+
+    lines = res_lines(args.clades)
+    for name, node_class, get_all_nodes in [("CladeNode",clad.CladeNode,clad.get_all_nodes), ("legacy",LegacyCladeNode,legacy_get_all_nodes)]:
+        n, t_read, mem, t_trav = measure(lines, node_class, get_all_nodes)
+        print("%-10s %d nodes  read_tree %5.2f s  retained %6.1f MB  traversal %5.2f s" % (name,n,t_read,mem/2.0**20,t_trav))
+
+if __name__ == '__main__':
+    main()
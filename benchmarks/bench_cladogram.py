@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Drawing of the cladogram (lefse_plot_cladogram.draw_tree) of a random
+# result file of about 20k clades, 3% of them biomarkers of two classes.
+#
+#   python benchmarks/bench_cladogram.py [--clades 20000] [--formats png svg] [--dpi 150]
+#
+# draw_tree is timed with its collections and with one artist per element
+# (ax.plot for every line and point, ax.bar for every shaded clade, as it
+# drew before), swapped in for add_lines, add_points and add_wedges.
+
+import os,time,random,tempfile,argparse
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from lefse import lefse_plot_cladogram as clad
+
+def artist_lines(ax,lines):
+    for v,c,w in lines:
+        v = np.asarray(v,dtype=float)
+        ax.plot(v[:,0],v[:,1],"-",color=c,lw=w)
+
+def artist_points(ax,pts,params):
+    for x,r,s,c,w in pts:
+        ax.plot(x,r,'o',markersize=s,color=c,markeredgewidth=w,markeredgecolor=params['fore_color'])
+
+def artist_wedges(ax,wedges,params):
+    for x,w,b,h,c in wedges:
+        ax.bar(x,h,width=w,bottom=b,alpha=params['alpha'],color=c,edgecolor=c)
+
+def write_res(fn, n, seed = 0):
+    r = random.Random(seed)
+    names = set()
+    while len(names) < n:
+        d = r.randint(2,6)
+        name = tuple("t%d_%d" % (i,r.randint(0,9)) for i in range(d))
+        names.update([".".join(name[:k]) for k in range(1,d+1)])
+    with open(fn, 'w') as out:
+        for name in sorted(names):
+            if r.random() < 0.03: out.write("%s\t%.3f\t%s\t%.2f\t0.01\n" % (name,r.random()*5,r.choice(['A','B']),2+r.random()*2))
+            else: out.write("%s\t%.3f\t\t\t-\n" % (name,r.random()*5))
+    return len(names)
+
+def timed(fn, out, fmt, dpi):
+    params = clad.read_params(["", fn, out, "--format", fmt, "--dpi", str(dpi)])
+    params['fore_color'] = 'w' if params['back_color'] == 'k' else 'k'
+    tree = clad.read_data(fn, params)
+    t0 = time.perf_counter()
+    clad.draw_tree(out, tree, params)
+    return time.perf_counter()-t0
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the drawing of the cladogram")
+    parser.add_argument('--clades', type=int, default=20000)
+    parser.add_argument('--formats', nargs='+', default=['png','svg'])
+    parser.add_argument('--dpi', type=int, default=150)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    fn = os.path.join(tmp, "clades.res")
+    print("%d clades" % write_res(fn, args.clades))
+    collections = (clad.add_lines, clad.add_points, clad.add_wedges)
+    try:
+        for fmt in args.formats:
+            out = os.path.join(tmp, "cladogram."+fmt)
+            t_new = timed(fn, out, fmt, args.dpi)
+            clad.add_lines, clad.add_points, clad.add_wedges = artist_lines, artist_points, artist_wedges
+            try: t_old = timed(fn, out, fmt, args.dpi)
+            finally: clad.add_lines, clad.add_points, clad.add_wedges = collections
+            print("%-4s collections %6.2f s  one artist per element %6.2f s" % (fmt,t_new,t_old))
+    finally:
+        for f in os.listdir(tmp): os.remove(os.path.join(tmp, f))
+        os.rmdir(tmp)
+
+if __name__ == '__main__':
+    main()
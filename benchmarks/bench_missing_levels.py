@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Completion of the missing hierarchy levels (lefse_format_input -c) on a
+# MetaPhlAn-style table: 8 levels (k__ to t__) with only the leaves given,
+# as lists of strings like the ones read from the input file.
+#
+#   python benchmarks/bench_missing_levels.py [--leaves 100000] [--samples 100]
+#
+# add_missing_levels is timed against the implementation it replaced
+# (legacy, copied below) and against add_missing_levels2, which scans all
+# the features for every missing clade and is only run on the first
+# --legacy2_leaves leaves.
+
+import math,time,argparse
+import numpy
+from lefse.lefse_format_input import add_missing_levels,add_missing_levels2
+
+levels = ['k','p','c','o','f','g','s','t']
+
+def legacy(ff):
+    if sum( [f.count(".") for f in ff] ) < 1: return ff
+
+    clades2leaves = {}
+    for f in ff:
+        fs = f.split(".")
+        if len(fs) < 2:
+            continue
+        for l in range(len(fs)):
+            n = ".".join( fs[:l] )
+            if n in clades2leaves:
+                clades2leaves[n].append( f )
+            else:
+                clades2leaves[n] = [f]
+    for k,v in clades2leaves.items():
+        if k and k not in ff:
+            ff[k] = [sum(a) for a in zip(*[[float(fn) for fn in ff[vv]] for vv in v])]
+    return ff
+
+def leaf_names(n, seed = 1982):
+    # a random tree with up to fan children per clade, n leaves at level 8
+    rng = numpy.random.RandomState(seed)
+    fan = int(math.ceil(n**(1.0/(len(levels)-1))))+1
+    names = set()
+    while len(names) < n:
+        ids = rng.randint(0,fan,size=len(levels)-1)
+        names.add(".".join([levels[0]+"__Bacteria"]+[l+"__"+l.upper()+str(i) for l,i in zip(levels[1:],ids.cumsum())]))
+    return sorted(names)
+
+def table(names, samples, seed = 1982):
+    rng = numpy.random.RandomState(seed)
+    vals = numpy.where(rng.rand(len(names),samples) < 0.7, 0.0, rng.rand(len(names),samples))
+    return dict([(n,[str(v) for v in row]) for n,row in zip(names,vals)])
+
+def timed(f, ff):
+    t0 = time.perf_counter()
+    ff = f(dict(ff))
+    return time.perf_counter()-t0, ff
+
+def check(ref, res):
+    assert set(ref) == set(res)
+    return max([numpy.abs(numpy.asarray(ref[k],dtype=float)-numpy.asarray(res[k],dtype=float)).max() for k in ref])
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the completion of the missing hierarchy levels")
+    parser.add_argument('--leaves', type=int, default=100000)
+    parser.add_argument('--samples', type=int, default=100)
+    parser.add_argument('--legacy2_leaves', type=int, default=2000)
+    args = parser.parse_args()
+
+    names = leaf_names(args.leaves)
+    ff = table(names, args.samples)
+    t_new, new = timed(add_missing_levels, ff)
+    print("%d leaves x %d samples, %d clades added" % (len(names),args.samples,len(new)-len(names)))
+    print("add_missing_levels   %8.2f s" % t_new)
+    t_old, old = timed(legacy, ff)
+    print("legacy               %8.2f s  (max abs difference %.1e)" % (t_old,check(old,new)))
+
+    sub = dict([(n,ff[n]) for n in names[:args.legacy2_leaves]])
+    t_new, new = timed(add_missing_levels, sub)
+    t_old, old = timed(add_missing_levels2, sub)
+    print("%d leaves: add_missing_levels %.2f s, add_missing_levels2 %.2f s  (max abs difference %.1e)" % (len(sub),t_new,t_old,check(old,new)))
+
+if __name__ == '__main__':
+    main()
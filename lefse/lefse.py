@@ -1,12 +1,29 @@
-import os,sys,math,pickle
+import os,sys,math,pickle,multiprocessing,json,struct,collections.abc
 import random as lrand
-import rpy2.robjects as robjects
 import argparse
 import numpy
+from scipy.stats import chi2,norm
+import scipy.sparse
 #import svmutil
 
-def init():
-    lrand.seed(1982)
+robjects = None
+
+# when set, the long steps call progress_hook(stage,done,total) with stage
+# 'kw' or 'wilcoxon' (features tested) and 'bootstrap' (LDA iterations),
+# and pipeline.analyse adds 'format' and 'plots'; total is None when not
+# known in advance
+progress_hook = None
+
+def report_progress(stage,done,total):
+    if progress_hook is not None: progress_hook(stage,done,total)
+
+def init(load_r=True,seed=1982):
+    global robjects
+    lrand.seed(seed)
+    # R and its libraries are loaded once per process, later calls only
+    # reset the seed
+    if not load_r or robjects is not None: return
+    import rpy2.robjects as robjects
     robjects.r('library(splines)')
     robjects.r('library(stats4)')
     robjects.r('library(survival)')
@@ -22,22 +39,154 @@ def get_class_means(class_sl,feats):
         means[fk] = [numpy.mean((f[class_sl[k][0]:class_sl[k][1]])) for k in clk]
     return clk,means
 
+def res_lines(res):
+    # the lines of the result file, as read by the plotting modules
+    lines = []
+    for k,v in res['cls_means'].items():
+        line = k+"\t"+str(math.log(max(max(v),1.0),10.0))+"\t"
+        if k in res['lda_res_th']:
+            for i,vv in enumerate(v):
+                if vv == max(v):
+                    line += str(res['cls_means_kord'][i])+"\t"
+                    break
+            line += str(res['lda_res'][k])
+        else: line += "\t"
+        lines.append(line + "\t" + (res['wilcox_res'][k] if 'wilcox_res' in res and k in res['wilcox_res'] else "-")+"\n")
+    return lines
+
 def save_res(res,filename):
     with open(filename, 'w') as out:
-        for k,v in res['cls_means'].items():
-            out.write(k+"\t"+str(math.log(max(max(v),1.0),10.0))+"\t")
-            if k in res['lda_res_th']:
-                for i,vv in enumerate(v):
-                    if vv == max(v):
-                        out.write(str(res['cls_means_kord'][i])+"\t")
-                        break
-                out.write(str(res['lda_res'][k]))
-            else: out.write("\t")
-            out.write( "\t" + (res['wilcox_res'][k] if 'wilcox_res' in res and k in res['wilcox_res'] else "-")+"\n")
+        out.writelines(res_lines(res))
+
+def save_store(store,filename):
+    with open(filename, 'w') as out:
+        json.dump(store,out)
+
+def load_store(filename):
+    with open(filename, 'r') as inp:
+        return json.load(inp)
+
+class SparseFeats(collections.abc.MutableMapping):
+    # the features (rows) of a CSR matrix with no explicit zeros, used as
+    # the dict of features: the rows are made dense on access, one at a time.
+    # Removing a feature leaves the matrix untouched, so copies share it
+    def __init__(self, names, m):
+        self.m = scipy.sparse.csr_matrix(m)
+        self.index = dict(zip(names,range(len(names))))
+        self.extra = {}
+    def __getitem__(self, k):
+        if k in self.extra: return self.extra[k]
+        i = self.index[k]
+        row = numpy.zeros(self.m.shape[1])
+        i1,i2 = self.m.indptr[i],self.m.indptr[i+1]
+        row[self.m.indices[i1:i2]] = self.m.data[i1:i2]
+        return row
+    def __setitem__(self, k, v):
+        self.index.pop(k,None)
+        self.extra[k] = v
+    def __delitem__(self, k):
+        if k in self.extra: del self.extra[k]
+        else: del self.index[k]
+    def __iter__(self):
+        return iter(list(self.index)+list(self.extra))
+    def __len__(self):
+        return len(self.index)+len(self.extra)
+    def copy(self):
+        cp = SparseFeats([],scipy.sparse.csr_matrix((0,0)))
+        cp.m,cp.index,cp.extra = self.m,dict(self.index),dict(self.extra)
+        return cp
+    def matrix(self, names):
+        # the CSR rows of the features names (not the ones set afterwards)
+        return self.m[[self.index[k] for k in names]]
+
+# the columnar format written by lefse_format_input: a magic string, the
+# length of a JSON header with the feature names and the class metadata and,
+# 64-byte aligned after the header, the features x samples matrix in C order
+# or, for sparse features, the data, indices and indptr arrays of the CSR
+# matrix, each one padded to 8 bytes
+mmap_magic = b"LEFSEMM1"
+
+def mmap_data_offset(header_len):
+    return (len(mmap_magic)+8+header_len+63)//64*64
+
+def csr_arrays(header, offset):
+    # the dtypes, lengths and offsets of the data, indices and indptr arrays
+    nnz,nr = header['sparse']['nnz'],header['shape'][0]
+    arrays = []
+    for dt,n in ((header['dtype'],nnz),(header['sparse']['index_dtype'],nnz),(header['sparse']['index_dtype'],nr+1)):
+        arrays.append((dt,n,offset))
+        offset += (n*numpy.dtype(dt).itemsize+7)//8*8
+    return arrays
+
+def save_data(out, filename, dtype = 'float64'):
+    sparse = isinstance(out['feats'],SparseFeats) and not out['feats'].extra
+    if sparse:
+        m = out['feats'].matrix(list(out['feats'].keys()))
+        idt = numpy.int32 if max(m.shape[1],m.nnz) < 2**31 else numpy.int64
+        arrays = [m.data.astype(dtype),m.indices.astype(idt),m.indptr.astype(idt)]
+    else: m = numpy.asarray(list(out['feats'].values()),dtype=dtype)
+    header = {'feat_names':list(out['feats'].keys()), 'dtype':numpy.dtype(dtype).str, 'shape':list(m.shape),
+              'norm':out['norm'], 'cls':dict([(k,list(v)) for k,v in out['cls'].items()]),
+              'class_sl':out['class_sl'], 'subclass_sl':out['subclass_sl'], 'class_hierarchy':out['class_hierarchy']}
+    if sparse: header['sparse'] = {'nnz':int(m.nnz), 'index_dtype':numpy.dtype(idt).str}
+    hb = json.dumps(header).encode('utf-8')
+    with open(filename, 'wb') as outf:
+        outf.write(mmap_magic)
+        outf.write(struct.pack('<Q',len(hb)))
+        outf.write(hb)
+        outf.write(b'\0'*(mmap_data_offset(len(hb))-outf.tell()))
+        if not sparse: m.tofile(outf)
+        else:
+            for a in arrays:
+                a.tofile(outf)
+                outf.write(b'\0'*(-a.nbytes % 8))
+
+def load_mmap_data(input_file):
+    # the features are rows of a copy-on-write numpy.memmap, only the pages
+    # actually used are read from disk
+    size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as inputf:
+        if inputf.read(len(mmap_magic)) != mmap_magic:
+            raise ValueError(input_file+" is not a LEfSe matrix file (no "+mmap_magic.decode('ascii')+" magic string)")
+        hl = inputf.read(8)
+        hl = struct.unpack('<Q',hl)[0] if len(hl) == 8 else size
+        if len(mmap_magic)+8+hl > size: raise ValueError(input_file+": truncated LEfSe matrix header")
+        try: header = json.loads(inputf.read(hl).decode('utf-8'))
+        except ValueError as e: raise ValueError(input_file+": corrupted LEfSe matrix header ("+str(e)+")")
+    missing = [k for k in ('feat_names','dtype','shape','norm','cls','class_sl','subclass_sl','class_hierarchy') if k not in header]
+    if missing: raise ValueError(input_file+": LEfSe matrix header without "+", ".join(missing))
+    shape = tuple(header['shape'])
+    offset = mmap_data_offset(hl)
+    if 'sparse' in header: end = max([off+n*numpy.dtype(dt).itemsize for dt,n,off in csr_arrays(header,offset)])
+    else: end = offset+shape[0]*shape[1]*numpy.dtype(header['dtype']).itemsize
+    if end > size: raise ValueError(input_file+": truncated LEfSe matrix, "+str(end)+" bytes expected, "+str(size)+" found")
+    if 'sparse' in header:
+        csr = [numpy.memmap(input_file, dtype=dt, mode='c', offset=off, shape=(n,)) if n > 0 else numpy.zeros(n,dtype=dt)
+               for dt,n,off in csr_arrays(header,offset)]
+        m = scipy.sparse.csr_matrix(tuple(csr),shape=shape)
+    elif shape[0]*shape[1] > 0:
+        m = numpy.memmap(input_file, dtype=header['dtype'], mode='c', offset=offset, shape=shape)
+    else: m = numpy.zeros(shape,dtype=header['dtype'])
+    inp = {}
+    inp['feats'] = SparseFeats(header['feat_names'],m) if 'sparse' in header else dict(zip(header['feat_names'],m))
+    inp['cls'] = header['cls']
+    inp['class_sl'] = dict([(k,tuple(v)) for k,v in header['class_sl'].items()])
+    inp['subclass_sl'] = dict([(k,tuple(v)) for k,v in header['subclass_sl'].items()])
+    inp['class_hierarchy'] = header['class_hierarchy']
+    inp['norm'] = header['norm']
+    return inp
 
 def load_data(input_file, nnorm = False):
     with open(input_file, 'rb') as inputf:
-        inp = pickle.load(inputf)
+        magic = inputf.read(len(mmap_magic))
+    if magic == mmap_magic: inp = load_mmap_data(input_file)
+    elif magic[:-1] == mmap_magic[:-1]:
+        raise ValueError(input_file+" is a LEfSe matrix file of an unsupported version ("+magic.decode('ascii','replace')+")")
+    else:
+        with open(input_file, 'rb') as inputf:
+            try: inp = pickle.load(inputf)
+            except Exception as e:
+                raise ValueError(input_file+" is neither a LEfSe matrix file nor a pickle written by lefse_format_input ("+str(e)+")")
     if nnorm: return inp['feats'],inp['cls'],inp['class_sl'],inp['subclass_sl'],inp['class_hierarchy'],inp['norm']
     else: return inp['feats'],inp['cls'],inp['class_sl'],inp['subclass_sl'],inp['class_hierarchy']
 
@@ -59,7 +208,165 @@ def test_kw_r(cls,feats,p,factors):
     kw_res = robjects.r('kruskal.test('+fo+',)$p.value')
     return float(tuple(kw_res)[0]) < p, float(tuple(kw_res)[0])
 
-def test_rep_wilcoxon_r(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,comp_only_same_subcl,curv=False):
+def sort_blocks(m,sl):
+    # copy of m with the columns of every subclass (slice of sl) sorted in
+    # each row. Both native tests rank from it so each feature is sorted
+    # once: the stable sort (timsort) of a row made of sorted runs only
+    # merges them, in linear time for the two subclasses of a Wilcoxon pair
+    srt = numpy.array(m,dtype=float)
+    for i1,i2 in set(sl.values()): srt[:,i1:i2].sort(axis=1)
+    return srt
+
+def sorted_rank_ties(srt):
+    # average ranks of the sorted rows srt, by position, and the tie term
+    # sum(t^3-t) of each row as used by R's rank() and kruskal.test()
+    nf,ns = srt.shape
+    new = numpy.ones((nf,ns),dtype=bool)
+    new[:,1:] = srt[:,1:] != srt[:,:-1]
+    gid = numpy.cumsum(new.ravel()) - 1
+    starts = numpy.flatnonzero(new.ravel())
+    t = numpy.diff(numpy.append(starts,nf*ns)).astype(float)
+    granks = starts % ns + (t+1.0)*0.5
+    ties = numpy.bincount(starts // ns,weights=t**3-t,minlength=nf)
+    return granks[gid].reshape(nf,ns),ties
+
+def test_kw_native(cls,feats,p,blocks=None):
+    # Kruskal-Wallis test of all the features (rows of feats) at once, it
+    # computes the same tie-corrected statistic of R's kruskal.test and the
+    # p-values agree with the R backend within 1e-9 (relative). blocks is
+    # feats sorted by sort_blocks, when already computed
+    if len(feats) == 0: return []
+    m = numpy.asarray(feats,dtype=float) if blocks is None else blocks
+    n = float(m.shape[1])
+    order = numpy.argsort(m,axis=1,kind='stable')
+    ranks,ties = sorted_rank_ties(numpy.take_along_axis(m,order,axis=1))
+    groups = numpy.unique(cls,return_inverse=True)[1]
+    ng = groups.max()+1
+    sgroups = groups[order]
+    rs = numpy.zeros((m.shape[0],ng))
+    for g in range(ng): rs[:,g] = numpy.where(sgroups == g,ranks,0.0).sum(axis=1)
+    return kw_pvalues(rs,numpy.bincount(groups,minlength=ng),ties,n,p)
+
+def kw_pvalues(rs,nn,ties,n,p):
+    # tie-corrected Kruskal-Wallis test from the rank sums rs of the groups
+    # (columns) of size nn for every feature (row), n samples
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        st = (12.0*(rs**2/nn).sum(axis=1)/(n*(n+1.0)) - 3.0*(n+1.0)) / (1.0 - ties/(n**3-n))
+    pvs = chi2.sf(st,len(nn)-1)
+    return [(float(pv) < p, float(pv)) for pv in pvs]
+
+def sort_sparse(m):
+    # the non-zero entries of the CSR matrix m as (row,col,val,shape) sorted
+    # by row and value, the counterpart of sort_blocks for sparse features:
+    # only the non-zero values are sorted, the zeros of a row are one tie
+    # group ranked by sparse_rank_sums
+    m = m.tocoo()
+    nz = m.data != 0
+    row,col,val = m.row[nz].astype(int),m.col[nz].astype(int),m.data[nz].astype(float)
+    order = numpy.lexsort((val,row))
+    return row[order],col[order],val[order],m.shape
+
+def sparse_rows(ent,rows):
+    # the entries of sort_sparse of the rows (increasing), renumbered
+    row,col,val,shape = ent
+    keep = numpy.zeros(shape[0],dtype=bool)
+    keep[rows] = True
+    sel = keep[row]
+    return (numpy.cumsum(keep)-1)[row[sel]],col[sel],val[sel],(len(rows),shape[1])
+
+def sparse_rank_sums(row,val,grp,nf,nn):
+    # rank sums of the groups (grp of every entry, nn samples per group) of
+    # the nf features and their tie terms, as rank_ties computes them on the
+    # dense rows. The entries are sorted by row and value, the samples not
+    # among them are zeros: one tie group after the negative values
+    ng = len(nn)
+    nnz = numpy.bincount(row,minlength=nf)
+    z = float(nn.sum()) - nnz
+    neg = numpy.bincount(row[val < 0],minlength=nf)
+    new = numpy.ones(len(row),dtype=bool)
+    new[1:] = (row[1:] != row[:-1]) | (val[1:] != val[:-1])
+    gid = numpy.cumsum(new) - 1
+    starts = numpy.flatnonzero(new)
+    t = numpy.diff(numpy.append(starts,len(row))).astype(float)
+    first = numpy.cumsum(nnz) - nnz
+    sr = row[starts]
+    granks = starts - first[sr] + numpy.where(val[starts] > 0,z[sr],0.0) + (t+1.0)*0.5
+    ties = numpy.bincount(sr,weights=t**3-t,minlength=nf) + z**3-z
+    cell = row*ng+grp
+    rs = numpy.bincount(cell,weights=granks[gid],minlength=nf*ng).reshape(nf,ng)
+    nz = numpy.bincount(cell,minlength=nf*ng).reshape(nf,ng)
+    return rs + (nn-nz)*(neg+(z+1.0)*0.5)[:,None],ties
+
+def test_kw_sparse(cls,ent,p):
+    # test_kw_native of the features sorted by sort_sparse
+    row,col,val,(nf,ns) = ent
+    if nf == 0: return []
+    groups = numpy.unique(cls,return_inverse=True)[1]
+    nn = numpy.bincount(groups)
+    rs,ties = sparse_rank_sums(row,val,groups[col],nf,nn)
+    return kw_pvalues(rs,nn,ties,float(ns),p)
+
+def wilcoxon_pairs(sl,cl_hie,min_c,comp_only_same_subcl):
+    # the subclass pairs on which test_rep_wilcoxon_r can run a rank-sum test
+    pairs = []
+    for pair in [(x,y) for x in cl_hie.keys() for y in cl_hie.keys() if x < y]:
+        for k1 in cl_hie[pair[0]]:
+            for k2 in cl_hie[pair[1]]:
+                if comp_only_same_subcl and k1[len(pair[0]):] != k2[len(pair[1]):]: continue
+                if sl[k1][1]-sl[k1][0] < min_c or sl[k2][1]-sl[k2][0] < min_c: continue
+                pairs.append((k1,k2))
+    return pairs
+
+def test_wilcoxon_native(sl,pairs,feats,blocks=None):
+    # rank-sum test of all the features (rows of feats) for every subclass pair
+    # in one vectorized pass per pair. Like coin's wilcox_test (the default
+    # asymptotic distribution, no continuity correction) the statistic is the
+    # rank sum of the first subclass standardized with the permutation
+    # variance conditional on the ties, p-values are two-sided. The pairs are
+    # ranked by merging the sorted subclasses of blocks (sort_blocks(feats,sl)
+    # when not given)
+    pvs = {}
+    if len(feats) == 0:
+        for pair in pairs: pvs[pair] = numpy.zeros(0)
+        return pvs
+    if blocks is None: blocks = sort_blocks(numpy.asarray(feats,dtype=float),sl)
+    for k1,k2 in pairs:
+        n1,n2 = sl[k1][1]-sl[k1][0], sl[k2][1]-sl[k2][0]
+        pm = numpy.hstack((blocks[:,sl[k1][0]:sl[k1][1]],blocks[:,sl[k2][0]:sl[k2][1]]))
+        order = numpy.argsort(pm,axis=1,kind='stable')
+        ranks,ties = sorted_rank_ties(numpy.take_along_axis(pm,order,axis=1))
+        pvs[(k1,k2)] = rank_sum_pvalues(numpy.where(order < n1,ranks,0.0).sum(axis=1),n1,n2,ties)
+    return pvs
+
+def rank_sum_pvalues(rs,n1,n2,ties):
+    # two-sided p-values of the rank sums rs of the first of two subclasses
+    n = float(n1+n2)
+    st = rs - n1*(n+1.0)*0.5
+    var = n1*n2*((n**3-n) - ties)/(12.0*n*(n-1.0))
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        return 2.0*norm.sf(numpy.abs(st/numpy.sqrt(var)))
+
+def test_wilcoxon_sparse(sl,pairs,ent):
+    # test_wilcoxon_native of the features sorted by sort_sparse, the entries
+    # of the two subclasses of a pair keep their order
+    row,col,val,(nf,ns) = ent
+    pvs = {}
+    for k1,k2 in pairs:
+        n1,n2 = sl[k1][1]-sl[k1][0], sl[k2][1]-sl[k2][0]
+        grp = numpy.full(ns,-1)
+        grp[sl[k1][0]:sl[k1][1]],grp[sl[k2][0]:sl[k2][1]] = 0,1
+        eg = grp[col]
+        sel = eg >= 0
+        rs,ties = sparse_rank_sums(row[sel],val[sel],eg[sel],nf,numpy.array([n1,n2]))
+        pvs[(k1,k2)] = rank_sum_pvalues(rs[:,0],n1,n2,ties)
+    return pvs
+
+def wilcoxon_pv_r(cl1,cl2):
+    robjects.globalenv["x"] = robjects.FloatVector(list(cl1)+list(cl2))
+    robjects.globalenv["y"] = robjects.FactorVector(robjects.StrVector(["a" for a in cl1]+["b" for b in cl2]))
+    return float(robjects.r('pvalue(wilcox_test(x~y,data=data.frame(x,y)))')[0])
+
+def test_rep_wilcoxon_r(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,comp_only_same_subcl,curv=False,pvs=None):
     comp_all_sub = not comp_only_same_subcl
     tot_ok =  0
     alpha_mtc = th
@@ -85,11 +392,10 @@ def test_rep_wilcoxon_r(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,com
                 sx,sy = numpy.median(cl1),numpy.median(cl2)
                 if cl1[0] == cl2[0] and len(set(cl1)) == 1 and  len(set(cl2)) == 1:
                     tres, first = False, False
+                elif not med_comp and pvs is not None:
+                    tres = pvs[(k1,k2)] < alpha_mtc*2.0
                 elif not med_comp:
-                    robjects.globalenv["x"] = robjects.FloatVector(cl1+cl2)
-                    robjects.globalenv["y"] = robjects.FactorVector(robjects.StrVector(["a" for a in cl1]+["b" for b in cl2]))
-                    pv = float(robjects.r('pvalue(wilcox_test(x~y,data=data.frame(x,y)))')[0])
-                    tres = pv < alpha_mtc*2.0
+                    tres = wilcoxon_pv_r(cl1,cl2) < alpha_mtc*2.0
                 if first:
                     first = False
                     if not curv and ( med_comp or tres ):
@@ -130,6 +436,102 @@ def test_rep_wilcoxon_r(sl,cl_hie,feats,th,multiclass_strat,mul_cor,fn,min_c,com
     return True
 
 
+def subclass_cmps(sl,cl_hie,feats,min_c,comp_only_same_subcl):
+    # the median comparisons of test_rep_wilcoxon_r (curv=False): for every
+    # class pair, whether its subclass comparisons are consistent (same
+    # direction, not all equal), the subclass pairs also needing a rank-sum
+    # test and the number of subclass pairs
+    comp_all_sub = not comp_only_same_subcl
+    cmps = []
+    for pair in [(x,y) for x in cl_hie.keys() for y in cl_hie.keys() if x < y]:
+        dir_cmp = "not_set"
+        consistent = True
+        first = True
+        tests = []
+        for k1 in cl_hie[pair[0]]:
+            for k2 in cl_hie[pair[1]]:
+                if not comp_all_sub and k1[len(pair[0]):] != k2[len(pair[1]):]: continue
+                cl1 = feats[sl[k1][0]:sl[k1][1]]
+                cl2 = feats[sl[k2][0]:sl[k2][1]]
+                sx,sy = numpy.median(cl1),numpy.median(cl2)
+                if cl1[0] == cl2[0] and len(set(cl1)) == 1 and  len(set(cl2)) == 1: consistent = False
+                elif first: dir_cmp = sx < sy
+                elif (sx < sy) != dir_cmp or sx == sy: consistent = False
+                first = False
+                if not consistent: break
+                if len(cl1) >= min_c and len(cl2) >= min_c: tests.append((k1,k2))
+            if not consistent: break
+        cmps.append((pair[0],pair[1],consistent,tests,len(cl_hie[pair[0]])*len(cl_hie[pair[1]])))
+    return cmps
+
+def wilcoxon_detail(sl,cl_hie,feats,min_c,comp_only_same_subcl,pvs=None):
+    # the part of test_rep_wilcoxon_r (curv=False) not depending on the
+    # alpha: for every class pair, whether the subclass comparisons are
+    # consistent (see subclass_cmps), the largest rank-sum p-value among them
+    # (None if only medians are compared or not consistent) and the number
+    # of subclass pairs. wilcoxon_pass(detail,...,th,...) is the result of
+    # test_rep_wilcoxon_r(...,th,...) without testing the features again
+    detail = []
+    for x,y,consistent,tests,n_sub in subclass_cmps(sl,cl_hie,feats,min_c,comp_only_same_subcl):
+        max_pv = None
+        for k1,k2 in tests if consistent else []:
+            pv = float(pvs[(k1,k2)]) if pvs is not None else wilcoxon_pv_r(feats[sl[k1][0]:sl[k1][1]],feats[sl[k2][0]:sl[k2][1]])
+            if math.isnan(pv): pv = float('inf')
+            max_pv = pv if max_pv is None else max(max_pv,pv)
+        detail.append((x,y,consistent,max_pv,n_sub))
+    return detail
+
+def wilcoxon_screen(sl,cl_hie,feats,th,multiclass_strat,mul_cor,min_c,comp_only_same_subcl):
+    # test_rep_wilcoxon_r (curv=False) with as few R tests as possible: the
+    # medians are compared first, then the subclass pairs are tested from the
+    # largest p-value of test_wilcoxon_native (same statistic, agreeing with
+    # R within 1e-9), the most likely to fail, stopping at the first failure.
+    # A pair the approximation rejects by a clear margin fails without
+    # calling R. Returns the result and the numbers of R tests run and skipped
+    cmps = subclass_cmps(sl,cl_hie,feats,min_c,comp_only_same_subcl)
+    n_tests = sum([len(tests) for x,y,consistent,tests,n_sub in cmps])
+    if multiclass_strat and not all([consistent for x,y,consistent,tests,n_sub in cmps]): return False,0,n_tests
+    approx = test_wilcoxon_native(sl,[p for x,y,consistent,tests,n_sub in cmps if consistent for p in tests],[feats])
+    def fail_score(p): # NaN p-values fail in R too, tested first
+        pv = float(approx[p][0])
+        return float('inf') if math.isnan(pv) else pv
+    cmps.sort(key=lambda c: -max([fail_score(p) for p in c[3]] or [0.0]) if c[2] else -float('inf'))
+    detail = []
+    n_run = 0
+    for x,y,consistent,tests,n_sub in cmps:
+        alpha_mtc = th
+        if mul_cor != 0: alpha_mtc = th*n_sub if mul_cor == 2 else 1.0-math.pow(1.0-th,n_sub)
+        diff = consistent
+        for k1,k2 in sorted(tests,key=fail_score,reverse=True) if consistent else []:
+            if approx[(k1,k2)][0] > alpha_mtc*2.0*(1.0+1e-6):
+                diff = False
+                break
+            n_run += 1
+            if not wilcoxon_pv_r(feats[sl[k1][0]:sl[k1][1]],feats[sl[k2][0]:sl[k2][1]]) < alpha_mtc*2.0:
+                diff = False
+                break
+        if not diff and multiclass_strat: return False,n_run,n_tests-n_run
+        detail.append((x,y,diff,None,n_sub))
+    return wilcoxon_pass(detail,list(cl_hie.keys()),th,multiclass_strat,mul_cor),n_run,n_tests-n_run
+
+def wilcoxon_pass(detail,classes,th,multiclass_strat,mul_cor):
+    all_diff = []
+    for x,y,consistent,max_pv,n_sub in detail:
+        alpha_mtc = th
+        if mul_cor != 0: alpha_mtc = th*n_sub if mul_cor == 2 else 1.0-math.pow(1.0-th,n_sub)
+        diff = consistent and (max_pv is None or max_pv < alpha_mtc*2.0)
+        if not diff and multiclass_strat: return False
+        if diff and not multiclass_strat: all_diff.append((x,y))
+    if not multiclass_strat:
+        tot_k = len(classes)
+        for k in classes:
+            nk = 0
+            for a in all_diff:
+                if k in a: nk += 1
+            if nk == tot_k-1: return True
+        return False
+    return True
+
 
 def contast_within_classes_or_few_per_class(feats,inds,min_cl,ncl):
     ff = list(zip(*[v for n,v in feats.items() if n != 'class']))
@@ -146,13 +548,11 @@ def contast_within_classes_or_few_per_class(feats,inds,min_cl,ncl):
                 return True
     return False
 
-def test_lda_r(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nlogs):
-    fk = list(feats.keys())
-    means = dict([(k,[]) for k in feats.keys()])
+def perturb_feats(cls,feats):
     feats['class'] = list(cls['class'])
-    clss = list(set(feats['class']))
+    clss = sorted(set(feats['class']))
 
-    for uu,k in enumerate(fk):
+    for uu,k in enumerate(list(feats.keys())):
         if k == 'class':
             continue
 
@@ -166,75 +566,167 @@ def test_lda_r(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nlogs):
                 if feats['class'][i] == c:
                     feats[k][i] = math.fabs(feats[k][i] + lrand.normalvariate(0.0,max(feats[k][i]*0.05,0.01)))
 
-    rdict = {}
-
-    for a,b in feats.items():
-        if a == 'class' or a == 'subclass' or a == 'subject':
-            rdict[a] = robjects.StrVector(b)
-        else:
-            rdict[a] = robjects.FloatVector(b)
-
-    robjects.globalenv["d"] = robjects.DataFrame(rdict)
+def boot_sample(cls,feats,fract_sample,rng):
+    fk = [k for k in feats.keys() if k != 'class']
     lfk = len(feats[fk[0]])
     rfk = int(float(len(feats[fk[0]]))*fract_sample)
-    f = "class ~ "+fk[0]
-
-    for k in fk[1:]:
-        f += " + " + k.strip()
-
     ncl = len(set(cls['class']))
     min_cl = int(float(min([cls['class'].count(c) for c in set(cls['class'])]))*fract_sample*fract_sample*0.5)
     min_cl = max(min_cl,1)
-    pairs = [(a,b) for a in set(cls['class']) for b in set(cls['class']) if a > b]
 
-    for k in fk:
-        for i in range(boots):
-            means[k].append([])
+    for rtmp in range(1000):
+        rand_s = [rng.randint(0,lfk-1) for v in range(rfk)]
+        if not contast_within_classes_or_few_per_class(feats,rand_s,min_cl,ncl):
+            break
 
-    for i in range(boots):
-        for rtmp in range(1000):
-            rand_s = [lrand.randint(0,lfk-1) for v in range(rfk)]
-            if not contast_within_classes_or_few_per_class(feats,rand_s,min_cl,ncl):
-                break
+    return rand_s
 
-        rand_s = [r+1 for r in rand_s]
-        means[k][i] = []
+boot_worker = None
 
-        for p in pairs:
-            robjects.globalenv["rand_s"] = robjects.IntVector(rand_s)
-            robjects.globalenv["sub_d"] = robjects.r('d[rand_s,]')
-            z = robjects.r('z <- suppressWarnings(lda(as.formula('+f+'),data=sub_d,tol='+str(tol_min)+'))')
-            robjects.r('w <- z$scaling[,1]')
-            robjects.r('w.unit <- w/sqrt(sum(w^2))')
-            robjects.r('ss <- sub_d[,-match("class",colnames(sub_d))]')
+def init_boot_worker(boot_fun,setup,args):
+    global boot_worker
+    boot_worker = (boot_fun,args)
+    if setup: setup(*args)
 
-            if 'subclass' in feats:
-                robjects.r('ss <- ss[,-match("subclass",colnames(ss))]')
+def run_boot(i):
+    return boot_worker[0](i,*boot_worker[1])
 
-            if 'subject' in feats:
-                robjects.r('ss <- ss[,-match("subject",colnames(ss))]')
+def run_boots(boot_fun,setup,args,boots,boot_jobs):
+    # every bootstrap iteration i draws from its own lrand.Random(seed+i) so
+    # the iterations can run in any order, and on any number of workers, with
+    # the same results
+    means = []
+    if boot_jobs <= 1:
+        if setup: setup(*args)
+        for i in range(boots):
+            means.append(boot_fun(i,*args))
+            report_progress('bootstrap',i+1,boots)
+        return means
+    with multiprocessing.get_context('spawn').Pool(boot_jobs,init_boot_worker,(boot_fun,setup,args)) as pool:
+        for m in pool.imap(run_boot,range(boots)):
+            means.append(m)
+            report_progress('bootstrap',len(means),boots)
+    return means
+
+def lda_scores(fk,means,lda_th):
+    # means are the bootstrap x class pair x feature effect sizes
+    m = numpy.asarray(means).mean(axis=0).max(axis=0)
+    res = dict([(k,math.copysign(1.0,m[j])*math.log(1.0+math.fabs(m[j]),10)) for j,k in enumerate(fk)])
+    return res,dict([(k,x) for k,x in res.items() if math.fabs(x) > lda_th])
 
-            robjects.r('xy.matrix <- as.matrix(ss)')
-            robjects.r('LD <- xy.matrix%*%w.unit')
-            robjects.r('effect.size <- abs(mean(LD[sub_d[,"class"]=="'+p[0]+'"]) - mean(LD[sub_d[,"class"]=="'+p[1]+'"]))')
-            scal = robjects.r('w.unit * effect.size')
-            rres = robjects.r('z$means')
-            rowns = list(rres.rownames)
-            lenc = len(list(rres.colnames))
-            coeff = [abs(float(v)) if not math.isnan(float(v)) else 0.0 for v in scal]
-            res = dict([(pp,[float(ff) for ff in rres.rx(pp,True)] if pp in rowns else [0.0]*lenc ) for pp in [p[0],p[1]]])
+def lda_r_setup(cls,feats,fract_sample,tol_min,pairs,seed):
+    if robjects is None: init()
+    rdict = {}
+
+    for a,b in feats.items():
+        if a == 'class' or a == 'subclass' or a == 'subject':
+            rdict[a] = robjects.StrVector(b)
+        else:
+            rdict[a] = robjects.FloatVector(b)
 
-            for j,k in enumerate(fk):
-                gm = abs(res[p[0]][j] - res[p[1]][j])
-                means[k][i].append((gm+coeff[j])*0.5)
+    robjects.globalenv["d"] = robjects.DataFrame(rdict)
 
-    res = {}
+def lda_boot_r(i,cls,feats,fract_sample,tol_min,pairs,seed):
+    fk = [k for k in feats.keys() if k != 'class']
+    f = "class ~ "+fk[0]
 
-    for k in fk:
-        m = max([numpy.mean([means[k][kk][p] for kk in range(boots)]) for p in range(len(pairs))])
-        res[k] = math.copysign(1.0,m)*math.log(1.0+math.fabs(m),10)
+    for k in fk[1:]:
+        f += " + " + k.strip()
 
-    return res,dict([(k,x) for k,x in res.items() if math.fabs(x) > lda_th])
+    rand_s = [r+1 for r in boot_sample(cls,feats,fract_sample,lrand.Random(seed+i))]
+    means = []
+
+    for p in pairs:
+        robjects.globalenv["rand_s"] = robjects.IntVector(rand_s)
+        robjects.globalenv["sub_d"] = robjects.r('d[rand_s,]')
+        z = robjects.r('z <- suppressWarnings(lda(as.formula('+f+'),data=sub_d,tol='+str(tol_min)+'))')
+        robjects.r('w <- z$scaling[,1]')
+        robjects.r('w.unit <- w/sqrt(sum(w^2))')
+        robjects.r('ss <- sub_d[,-match("class",colnames(sub_d))]')
+
+        if 'subclass' in feats:
+            robjects.r('ss <- ss[,-match("subclass",colnames(ss))]')
+
+        if 'subject' in feats:
+            robjects.r('ss <- ss[,-match("subject",colnames(ss))]')
+
+        robjects.r('xy.matrix <- as.matrix(ss)')
+        robjects.r('LD <- xy.matrix%*%w.unit')
+        robjects.r('effect.size <- abs(mean(LD[sub_d[,"class"]=="'+p[0]+'"]) - mean(LD[sub_d[,"class"]=="'+p[1]+'"]))')
+        scal = robjects.r('w.unit * effect.size')
+        rres = robjects.r('z$means')
+        rowns = list(rres.rownames)
+        lenc = len(list(rres.colnames))
+        coeff = [abs(float(v)) if not math.isnan(float(v)) else 0.0 for v in scal]
+        res = dict([(pp,[float(ff) for ff in rres.rx(pp,True)] if pp in rowns else [0.0]*lenc ) for pp in [p[0],p[1]]])
+        means.append([(abs(res[p[0]][j] - res[p[1]][j])+coeff[j])*0.5 for j,k in enumerate(fk)])
+
+    return means
+
+def test_lda_r(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nlogs,seed=1982,boot_jobs=1):
+    fk = list(feats.keys())
+    perturb_feats(cls,feats)
+    pairs = [(a,b) for a in set(cls['class']) for b in set(cls['class']) if a > b]
+    means = run_boots(lda_boot_r,lda_r_setup,(cls,feats,fract_sample,tol_min,pairs,seed),boots,boot_jobs)
+    return lda_scores(fk,means,lda_th)
+
+
+def lda_native(x,g,tol):
+    # the moment estimator of MASS::lda: returns the first column of the
+    # scaling (the first discriminant direction), the group labels and the
+    # group means of the samples (rows) of x
+    lev,gi = numpy.unique(g,return_inverse=True)
+    n,ng = x.shape[0], len(lev)
+    counts = numpy.bincount(gi,minlength=ng)
+    prior = counts/float(n)
+    gmeans = numpy.zeros((ng,x.shape[1]))
+    numpy.add.at(gmeans,gi,x)
+    gmeans /= counts[:,None]
+    xc = x - gmeans[gi]
+    f1 = numpy.std(xc,axis=0,ddof=1)
+    if numpy.any(f1 < tol):
+        raise ValueError("variable "+str(int(numpy.flatnonzero(f1 < tol)[0])+1)+" appears to be constant within groups")
+    u,d,vt = numpy.linalg.svd(xc*(math.sqrt(1.0/(n-ng))/f1),full_matrices=False)
+    rank = int(numpy.sum(d > tol))
+    if rank == 0:
+        raise ValueError("rank = 0: variables are numerically constant")
+    scaling = (vt[:rank].T/d[:rank])/f1[:,None]
+    xbar = numpy.dot(prior,gmeans)
+    xm = numpy.sqrt(n*prior/(ng-1.0))[:,None]*numpy.dot(gmeans-xbar,scaling)
+    u,d,vt = numpy.linalg.svd(xm,full_matrices=False)
+    rank = int(numpy.sum(d > tol*d[0]))
+    scaling = numpy.dot(scaling,vt[:rank].T)
+    return scaling[:,0],lev,gmeans
+
+def lda_boot_native(i,cls,feats,x,g,fract_sample,tol_min,pairs,seed):
+    rand_s = boot_sample(cls,feats,fract_sample,lrand.Random(seed+i))
+    sub_x,sub_g = x[rand_s],g[rand_s]
+    w,lev,gmeans = lda_native(sub_x,sub_g,tol_min)
+    w_unit = w/numpy.sqrt(numpy.sum(w**2))
+    ld = numpy.dot(sub_x,w_unit)
+    lev = list(lev)
+    means = numpy.zeros((len(pairs),x.shape[1]))
+
+    for j,p in enumerate(pairs):
+        with numpy.errstate(invalid='ignore'):
+            effect_size = abs(numpy.mean(ld[sub_g == p[0]]) - numpy.mean(ld[sub_g == p[1]])) if p[0] in lev and p[1] in lev else float('nan')
+        coeff = numpy.nan_to_num(numpy.abs(w_unit*effect_size),nan=0.0)
+        gm = numpy.abs((gmeans[lev.index(p[0])] if p[0] in lev else 0.0) - (gmeans[lev.index(p[1])] if p[1] in lev else 0.0))
+        means[j] = (gm+coeff)*0.5
+
+    return means
+
+def test_lda_native(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nlogs,seed=1982,boot_jobs=1):
+    # same resampling and effect-size math of test_lda_r with a NumPy LDA:
+    # the discriminant is fitted once per bootstrap iteration and shared by
+    # all the class pairs
+    fk = list(feats.keys())
+    perturb_feats(cls,feats)
+    pairs = [(a,b) for a in set(cls['class']) for b in set(cls['class']) if a > b]
+    x = numpy.array([feats[k] for k in fk],dtype=float).T
+    g = numpy.array(feats['class'])
+    means = run_boots(lda_boot_native,None,(cls,feats,x,g,fract_sample,tol_min,pairs,seed),boots,boot_jobs)
+    return lda_scores(fk,means,lda_th)
 
 
 def test_svm(cls,feats,cl_sl,boots,fract_sample,lda_th,tol_min,nsvm):
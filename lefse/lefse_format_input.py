@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 
 import sys,os,argparse,pickle,re,numpy
+import scipy.sparse
 
 import functools
 from lefsebiom.ConstantsBreadCrumbs import *
 from lefsebiom.AbundanceTable import *
+from lefse.lefse import save_data,SparseFeats
 
 #***************************************************************************************************************
 #*   Log of change                                                                                             *
@@ -55,6 +57,61 @@ def read_input_file(inp_file, CommonArea):
         CommonArea['ReturnedData'] = [[v.strip() for v in line.strip().split("\t")] for line in inp.readlines()]
         return CommonArea
 
+def read_input_matrix(inp_file, meta_rows, sparse = False):
+    # streaming reader for the tab-delimited input with the features on rows:
+    # the metadata rows (class, subclass, subject) are kept as strings and the
+    # feature rows are parsed straight into a preallocated float matrix, or
+    # only their non-zero values into a CSR matrix when sparse.
+    # Returns None on rows of different length, the list based reader is used
+    with open(inp_file) as inp:
+        nrows = sum(1 for line in inp if line.strip())
+    names, meta, mat = [], {}, None
+    data, indices, indptr = [], [], [0]
+    with open(inp_file) as inp:
+        i = 0
+        for line in inp:
+            if not line.strip(): continue
+            row = line.strip().split("\t")
+            if mat is None:
+                shape = (nrows-len([r for r in set(meta_rows) if r < nrows]),len(row)-1)
+                mat = scipy.sparse.csr_matrix(shape) if sparse else numpy.empty(shape)
+            if len(row) != mat.shape[1]+1: return None
+            if i in meta_rows: meta[i] = [v.strip() for v in row]
+            elif sparse:
+                vals = numpy.array([float(v) for v in row[1:]])
+                nz = numpy.flatnonzero(vals)
+                data.append(vals[nz])
+                indices.append(nz)
+                indptr.append(indptr[-1]+len(nz))
+                names.append(row[0].strip())
+            else:
+                mat[len(names)] = [float(v) for v in row[1:]]
+                names.append(row[0].strip())
+            i += 1
+    if sparse and mat is not None:
+        mat = scipy.sparse.csr_matrix((numpy.concatenate(data+[numpy.zeros(0)]),numpy.concatenate(indices+[numpy.zeros(0,dtype=int)]),indptr),shape=mat.shape)
+    return names, meta, mat
+
+def sort_permutation(meta, n, params):
+    # the column order given by sort_by_cl, computed on the metadata rows only
+    c = params['class']-1
+    s = params['subclass']-1 if not params['subclass'] is None else None
+    u = params['subject']-1 if not params['subject'] is None else None
+    nc = len(meta[c])-1
+    cols = [[meta[r][j+1] if r in meta else None for r in range(max(meta)+1)]+[j] for j in range(nc)]
+    return [col[-1] for col in sort_by_cl(cols,n,c,s,u)]
+
+def cls_rows(params):
+    cls_i = [('class',params['class']-1)]
+    if params['subclass'] is not None and params['subclass'] > 0:
+        cls_i.append(('subclass',params['subclass']-1))
+
+    if params['subject'] is not None and params['subject'] > 0:
+        cls_i.append(('subject',params['subject']-1))
+
+    cls_i.sort(key = functools.cmp_to_key(lambda x,y: -((x[1] > y[1]) - (x[1] < y[1]))))
+    return cls_i
+
 def transpose(data):
     return list(zip(*data))
 
@@ -80,12 +137,19 @@ def read_params(args):
     parser.add_argument('-n',dest="subcl_min_card", metavar="int", type=int, default=10,
         help="set the minimum cardinality of each subclass (subclasses with low cardinalities will be grouped together, if the cardinality is still low, no pairwise comparison will be performed with them)")
 
+    parser.add_argument('--output_format', dest="output_format", choices=["pickle","mmap"], type=str, default="pickle",
+        help="the format of the output file: the pickle read by all the LEfSe versions (default) or a memory-mappable matrix with the class metadata, faster to load for large tables")
+    parser.add_argument('--dtype', dest="dtype", choices=["float64","float32"], type=str, default="float64",
+        help="the float precision of the feature matrix in the mmap output format (default float64)")
+    parser.add_argument('--sparse', dest="sparse", action='store_true',
+        help="keep the feature matrix sparse (only the non-zero values) from the input to the mmap output file, for tables made mostly of zeros")
+
     parser.add_argument('-biom_c',dest="biom_class", type=str,
         help="For biom input files: Set which feature use as class  ")
     parser.add_argument('-biom_s',dest="biom_subclass", type=str,
         help="For biom input files: set which feature use as subclass   ")
 
-    args = parser.parse_args()
+    args = parser.parse_args(args[1:])
 
     return vars(args)
 
@@ -186,29 +250,49 @@ def get_class_slices(data):
     class_hierarchy.append((previous_class,subcls))
     return dict(class_slices), dict(subclass_slices), dict(class_hierarchy)
 
+def normalize(names, m, norm):
+    # scales each sample (column) of the matrix to sum up to norm, counting
+    # only the top-level features when the names are hierarchical; rows that
+    # end up (almost) constant are rounded to 6 decimals
+    if scipy.sparse.issparse(m): return normalize_sparse(names, m, norm)
+    m = numpy.asarray(m,dtype=float)
+    if norm < 0.0: return m
+    mul = norm_factors(names, m, norm)
+    m *= mul
+    mean = m.mean(axis=1)
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        const = (mean != 0) & (m.std(axis=1)/mean < 1e-10)
+    m[const] = numpy.round(m[const]*1e6)/1e6
+    return m
+
+def norm_factors(names, m, norm):
+    # the factor of every sample (column) used by normalize
+    hie = True if sum([k.count(".") for k in names]) > len(names) else False
+    if hie:
+        top = numpy.array([k.count(".") < 1 for k in names],dtype=bool)
+        mul = numpy.asarray(m[top].sum(axis=0)).ravel()
+    if not hie or mul.sum() == 0:
+        mul = numpy.asarray(m.sum(axis=0)).ravel()
+    with numpy.errstate(divide='ignore'):
+        return numpy.where(mul == 0, 0.0, float(norm) / mul)
+
+def normalize_sparse(names, m, norm):
+    # normalize for a CSR matrix, only rows with no zeros can be constant
+    m = scipy.sparse.csr_matrix(m,dtype=float,copy=True)
+    m.eliminate_zeros()
+    if norm < 0.0: return m
+    m.data *= norm_factors(names, m, norm)[m.indices]
+    m.eliminate_zeros()
+    for r in numpy.flatnonzero(numpy.diff(m.indptr) == m.shape[1]):
+        v = m.data[m.indptr[r]:m.indptr[r+1]]
+        if v.mean() != 0 and v.std()/v.mean() < 1e-10: v[:] = numpy.round(v*1e6)/1e6
+    return m
+
 def numerical_values(feats,norm):
-    mm = []
-    for k,v in feats.items():
-        feats[k] = [float(val) for val in v]
-    if norm < 0.0: return feats
-    tr = list(zip(*(list(feats.values()))))
-    mul = []
-    fk = list(feats.keys())
-    hie = True if sum([k.count(".") for k in fk]) > len(fk) else False
-    for i in range(len(list(feats.values())[0])):
-        if hie: mul.append(sum([t for j,t in enumerate(tr[i]) if fk[j].count(".") < 1 ]))
-        else: mul.append(sum(tr[i]))
-    if hie and sum(mul) == 0:
-        mul = []
-        for i in range(len(list(feats.values())[0])):
-            mul.append(sum(tr[i])) 
-    for i,m in enumerate(mul):
-        if m == 0: mul[i] = 0.0
-        else: mul[i] = float(norm) / m
-    for k,v in feats.items():
-        feats[k] = [val*mul[i] for i,val in enumerate(v)]
-        if numpy.mean(feats[k]) and (numpy.std(feats[k])/numpy.mean(feats[k])) < 1e-10:
-            feats[k] = [ float(round(kv*1e6)/1e6) for kv in feats[k]]
+    names = list(feats.keys())
+    m = normalize(names, numpy.array([[float(val) for val in v] for v in feats.values()]), norm)
+    for k,v in zip(names,m):
+        feats[k] = v.tolist()
     return feats
 
 def add_missing_levels2(ff):
@@ -241,23 +325,56 @@ def add_missing_levels2(ff):
     return ff
 
 
+def missing_levels(names, m):
+    # the missing clades (prefixes of the dotted feature names that are not
+    # features themselves) in order of first appearance and their abundances:
+    # the sum of all the features they contain. The sums are computed with one
+    # bottom-up pass over the levels of the tree, each node adds its own value
+    # (if it is a feature) and the sum of its descendants to its parent
+    ids = dict([(n,i) for i,n in enumerate(names)])
+    missing = []
+    for f in names:
+        fs = f.split(".")
+        for l in range(1,len(fs)):
+            n = ".".join( fs[:l] )
+            if n not in ids:
+                ids[n] = len(ids)
+                missing.append(n)
+    if scipy.sparse.issparse(m):
+        # every feature adds up to all its missing ancestors
+        rows, cols = [], []
+        for j,f in enumerate(names):
+            fs = f.split(".")
+            for l in range(1,len(fs)):
+                n = ids[".".join( fs[:l] )]
+                if n >= len(names):
+                    rows.append(n-len(names))
+                    cols.append(j)
+        agg = scipy.sparse.csr_matrix((numpy.ones(len(rows)),(rows,cols)),shape=(len(missing),len(names)))
+        return missing, scipy.sparse.csr_matrix(agg @ m)
+    nodes = list(names)+missing
+    parent = numpy.array([ids[n.rsplit(".",1)[0]] if "." in n else -1 for n in nodes],dtype=int)
+    depth = numpy.array([n.count(".") for n in nodes],dtype=int)
+    internal = numpy.unique(parent[parent >= 0])
+    int_id = numpy.full(len(nodes),-1,dtype=int)
+    int_id[internal] = numpy.arange(len(internal))
+    sums = numpy.zeros((len(internal),m.shape[1]))
+    nf = len(names)
+    for d in range(depth.max(),0,-1):
+        sel = numpy.flatnonzero(depth == d)
+        fsel = sel[sel < nf]
+        numpy.add.at(sums,int_id[parent[fsel]],m[fsel])
+        isel = sel[int_id[sel] >= 0]
+        numpy.add.at(sums,int_id[parent[isel]],sums[int_id[isel]])
+    return missing, sums[int_id[nf:]]
+
 def add_missing_levels(ff):
     if sum( [f.count(".") for f in ff] ) < 1: return ff
 
-    clades2leaves = {}
-    for f in ff:
-        fs = f.split(".")
-        if len(fs) < 2:
-            continue
-        for l in range(len(fs)):
-            n = ".".join( fs[:l] )
-            if n in clades2leaves:
-                clades2leaves[n].append( f )
-            else:
-                clades2leaves[n] = [f]
-    for k,v in clades2leaves.items():
-        if k and k not in ff:
-            ff[k] = [sum(a) for a in zip(*[[float(fn) for fn in ff[vv]] for vv in v])]
+    names = list(ff.keys())
+    missing, sums = missing_levels(names, numpy.array([numpy.asarray(v,dtype=float) for v in ff.values()]))
+    for k,v in zip(missing,sums):
+        ff[k] = v
     return ff
 
 
@@ -380,55 +497,75 @@ def  check_params_for_biom_case(params, CommonArea):
             params['subclass'] =  3
     return params
 
-def format_input():
+def format_data(params):
+    # the formatted input as written to OUTPUT_FILE, the features are the
+    # rows of the normalized feature matrix
     CommonArea = dict()         #Build a Common Area to pass variables in the biom case
-    params = read_params(sys.argv)
 
     if type(params['subclass']) is int and int(params['subclass']) < 1:
         params['subclass'] = None
     if type(params['subject']) is int and int(params['subject']) < 1:
         params['subject'] = None
 
-
-    CommonArea = read_input_file(sys.argv[1], CommonArea)       #Pass The CommonArea to the Read
-    data = CommonArea['ReturnedData']                   #Select the data
-
-    if sys.argv[1].endswith('biom'):    #*  Check if biom:
-        params = check_params_for_biom_case(params, CommonArea) #Check the params for the biom case
-
-    if params['feats_dir'] == "c":
-        data = transpose(data)
-
-    ncl = 1
-    if not params['subclass'] is None: ncl += 1
-    if not params['subject'] is None: ncl += 1
-
-    first_line = list(zip(*data))[0]
-
-    first_line = modify_feature_names(list(first_line))
-
-    data = list(zip( first_line,
-            *sort_by_cl(list(zip(*data))[1:],
-              ncl,
-              params['class']-1,
-              params['subclass']-1 if not params['subclass'] is None else None,
-              params['subject']-1 if not params['subject'] is None else None)))
-#   data.insert(0,first_line)
-#   data = remove_missing(data,params['missing_p'])
     cls = {}
+    feats = None
+    if not params['input_file'].endswith('biom') and params['feats_dir'] == "r":
+        ncl = 1
+        if not params['subclass'] is None: ncl += 1
+        if not params['subject'] is None: ncl += 1
+
+        cls_i = cls_rows(params)
+        rd = read_input_matrix(params['input_file'], [v[1] for v in cls_i], params['sparse'])
+        if rd is not None:
+            names, meta, mat = rd
+            perm = sort_permutation(meta, ncl, params)
+            if params['sparse']: mat = mat[:,perm]
+            else:
+                for r in range(mat.shape[0]):
+                    mat[r] = mat[r,perm]
+            for v in cls_i:
+                cls[v[0]] = tuple([meta[v[1]][1:][j] for j in perm])
+            names = modify_feature_names(names)
+            if len(set(names)) < len(names):
+                # same as building a dict: the last duplicate wins
+                last = dict(zip(names,range(len(names))))
+                names, mat = list(last.keys()), mat[list(last.values())]
+            feats = names, mat
+
+    if feats is None:
+        CommonArea = read_input_file(params['input_file'], CommonArea)       #Pass The CommonArea to the Read
+        data = CommonArea['ReturnedData']                   #Select the data
+
+        if params['input_file'].endswith('biom'):    #*  Check if biom:
+            params = check_params_for_biom_case(params, CommonArea) #Check the params for the biom case
+
+        if params['feats_dir'] == "c":
+            data = transpose(data)
+
+        ncl = 1
+        if not params['subclass'] is None: ncl += 1
+        if not params['subject'] is None: ncl += 1
+
+        first_line = list(zip(*data))[0]
+
+        first_line = modify_feature_names(list(first_line))
+
+        data = list(zip( first_line,
+                *sort_by_cl(list(zip(*data))[1:],
+                  ncl,
+                  params['class']-1,
+                  params['subclass']-1 if not params['subclass'] is None else None,
+                  params['subject']-1 if not params['subject'] is None else None)))
+#       data.insert(0,first_line)
+#       data = remove_missing(data,params['missing_p'])
+
+        for v in cls_rows(params):
+            cls[v[0]] = data.pop(v[1])[1:]
+
+        feats = dict([(d[0],d[1:]) for d in data])
+        feats = list(feats.keys()), numpy.array([[float(val) for val in v] for v in feats.values()])
+        if params['sparse']: feats = feats[0], scipy.sparse.csr_matrix(feats[1])
 
-    cls_i = [('class',params['class']-1)]
-    if params['subclass'] is not None and params['subclass'] > 0:
-        cls_i.append(('subclass',params['subclass']-1))
-
-    if params['subject'] is not None and params['subject'] > 0:
-        cls_i.append(('subject',params['subject']-1))
-
-    cls_i.sort(key = functools.cmp_to_key(lambda x,y: -((x[1] > y[1]) - (x[1] < y[1]))))
-
-    for v in cls_i: 
-        cls[v[0]] = data.pop(v[1])[1:]
-    
     if params['subclass'] is None:
         cls['subclass'] = [str(cl)+"_subcl" for cl in cls['class']]
 
@@ -442,28 +579,40 @@ def format_input():
     elif ('subclass' not in cls.keys()) and ('subject' in cls.keys()):
         class_sl, subclass_sl, class_hierarchy = get_class_slices(list(zip(cls['class'], cls['subject'])))
 
-    feats = dict([(d[0],d[1:]) for d in data])
-
-    feats = add_missing_levels(feats)
+    names, mat = feats
+    if sum( [f.count(".") for f in names] ) >= 1:
+        missing, sums = missing_levels(names, mat)
+        names, mat = names+missing, scipy.sparse.vstack((mat,sums),format='csr') if params['sparse'] else numpy.vstack((mat,sums))
 
-    feats = numerical_values(feats,params['norm_v'])
+    mat = normalize(names,mat,params['norm_v'])
     out = {}
-    out['feats'] = feats
+    out['feats'] = SparseFeats(names,mat) if params['sparse'] else dict(zip(names,mat))
     out['norm'] = params['norm_v']
     out['cls'] = cls
     out['class_sl'] = class_sl
     out['subclass_sl'] = subclass_sl
     out['class_hierarchy'] = class_hierarchy
+    return out
+
+def format_input():
+    params = read_params(sys.argv)
+    out = format_data(params)
+    if params['output_format'] != "mmap":
+        out['feats'] = dict([(k,v.tolist()) for k,v in out['feats'].items()])
 
     if params['output_table']:
+        cls = out['cls']
         with open( params['output_table'], "w") as outf:
             if 'class' in cls: outf.write( "\t".join(list(["class"])+list(cls['class'])) + "\n" )
             if 'subclass' in cls: outf.write( "\t".join(list(["subclass"])+list(cls['subclass'])) + "\n" )
             if 'subject' in cls: outf.write( "\t".join(list(["subject"])+list(cls['subject']))  + "\n" )
             for k,v in out['feats'].items(): outf.write( "\t".join([k]+[str(vv) for vv in v]) + "\n" )
 
-    with open(params['output_file'], 'wb') as back_file:
-        pickle.dump(out,back_file)
+    if params['output_format'] == "mmap":
+        save_data(out,params['output_file'],params['dtype'])
+    else:
+        with open(params['output_file'], 'wb') as back_file:
+            pickle.dump(out,back_file)
 
 
 if  __name__ == '__main__':
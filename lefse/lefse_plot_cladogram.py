@@ -1,28 +1,34 @@
 #!/usr/bin/env python3
 import os, sys, argparse, string
-# 強制把本檔所在目錄加到 module search path
-this_dir = os.path.dirname(__file__)
-if this_dir not in sys.path:
-    sys.path.insert(0, this_dir)
 
 import matplotlib
 matplotlib.use('Agg')
 from pylab import *
-# 改成直接 import lefse.py 裡的東西
-import lefse
+from matplotlib.collections import LineCollection, PathCollection
+from matplotlib.markers import MarkerStyle
+from matplotlib.patches import Rectangle
+from matplotlib.path import Path
+from matplotlib.colors import to_rgba
+from matplotlib.transforms import IdentityTransform
 
 # Default color palettes
 colors = ['r','g','b','m','c',[1.0,0.5,0.0],[0.0,1.0,0.0],[0.33,0.125,0.0],[0.75,0.75,0.75],'k']
 dark_colors = [[0.4,0.0,0.0],[0.0,0.2,0.0],[0.0,0.0,0.4],'m','c',[1.0,0.5,0.0],[0.0,1.0,0.0],[0.33,0.125,0.0],[0.75,0.75,0.75],'k']
 
 class CladeNode:
+    # slots keep the nodes small for large taxonomies; the children are kept
+    # in a plain list (an empty tuple shared by the leaves) sorted by name in
+    # place when first asked for after a change, the list returned must not
+    # be modified
+    __slots__ = ('id','name','last_name','abundance','pos','children','children_sorted','isleaf','color','next_leaf','prev_leaf','viz')
     def __init__(self, name, abundance, viz=True):
         self.id = name
-        self.name = name.split('.')
+        self.name = tuple(name.split('.'))
         self.last_name = self.name[-1]
         self.abundance = abundance
         self.pos = (-1.0, -1.0)
-        self.children = {}
+        self.children = ()
+        self.children_sorted = True
         self.isleaf = True
         self.color = 'y'
         self.next_leaf = -1
@@ -32,9 +38,16 @@ class CladeNode:
         return self.last_name
     def add_child(self, node):
         self.isleaf = False
-        self.children[node.__repr__()] = node
+        if not self.children: self.children = []
+        self.children.append(node)
+        self.children_sorted = False
     def get_children(self):
-        return [self.children[k] for k in sorted(self.children.keys())]
+        if not self.children_sorted:
+            # a child added twice under the same name replaces the first one
+            self.children = list(dict([(c.last_name,c) for c in self.children]).values())
+            self.children.sort(key=lambda c: c.last_name)
+            self.children_sorted = True
+        return self.children
     def get_color(self):
         return self.color
     def set_color(self, c):
@@ -78,38 +91,47 @@ def read_params(args):
                         help="Comma-separated list of colors for classes in sorted order, e.g. 'red,blue,green'")
     parser.add_argument('--debug', action='store_true', help="顯示除錯訊息")
 
-    args = parser.parse_args()
+    args = parser.parse_args(args[1:])
     return vars(args)
 
 def cmp_names(la,lb):
-    if len(la) != len(lb): return False
-    for p in [(a,b) for i,a in enumerate(la) for j,b in enumerate(lb) if i == j]:
-        if p[0] != p[1]: return False
-    return True
-
-def build_tree(father,all_nodes,l,depth,viz):
-    cc = [n for n in all_nodes if len(n.name) > len(father.name) and cmp_names(father.name,n.name[:len(father.name)])]
-    children = [n for n in cc if len(n.name) == len(father.name)+1]
+    return list(la) == list(lb)
+
+def children_by_parent(all_nodes):
+    # direct children of every clade, keyed by the dotted id of the parent
+    ret = {}
+    for n in all_nodes:
+        ret.setdefault(".".join(n.name[:-1]),[]).append(n)
+    return ret
+
+def build_tree(father,all_nodes,l,depth,viz,children_of=None):
+    if children_of is None: children_of = children_by_parent(all_nodes)
+    children = list(children_of.get(father.id,[]))
     if len(children) == 0 and l < depth -1: # !!!
         nc = CladeNode(father.id+"."+father.id.split(".")[-1],1.0,viz)
         father.add_child(nc)
         children.append(nc)
     for child in children:
-        build_tree(child,cc,l+1,depth,viz)
+        build_tree(child,all_nodes,l+1,depth,viz,children_of)
         father.add_child(child)
 
 def get_all_nodes(father):
-    ret = [father]
-    children = father.get_children()
-    for c in children:
-        ret += get_all_nodes(c)
+    # pre-order, the children in name order
+    ret, stack = [], [father]
+    while stack:
+        n = stack.pop()
+        ret.append(n)
+        stack.extend(reversed(n.get_children()))
     return ret
 
 def read_data(input_file,params):
     with open(input_file, 'r') as inp:
-        if params['sub_clade'] == "":
-            rows = [line.strip().split()[:-1] for line in inp.readlines() if params['max_lev'] < 1 or line.split()[0].count(".") < params['max_lev']]
-        else: rows = [line.split(params['sub_clade']+".")[1].strip().split()[:-1] for line in inp.readlines() if ( params['max_lev'] < 1 or line.split()[0].count(".") < params['max_lev'] ) and line.startswith(params['sub_clade']+".")]
+        return read_tree(inp.readlines(),params)
+
+def read_tree(lines,params):
+    if params['sub_clade'] == "":
+        rows = [line.strip().split()[:-1] for line in lines if params['max_lev'] < 1 or line.split()[0].count(".") < params['max_lev']]
+    else: rows = [line.split(params['sub_clade']+".")[1].strip().split()[:-1] for line in lines if ( params['max_lev'] < 1 or line.split()[0].count(".") < params['max_lev'] ) and line.startswith(params['sub_clade']+".")]
 
     abundances = [float(v) for v in list(zip(*rows))[1] if float(v) >= 0.0]
     tree = {}
@@ -146,13 +168,13 @@ def read_data(input_file,params):
 
     depth = max([len(n.name) for n in all_nodes])
 
-    n2 = ["_".join(nn.name) for nn in all_nodes]
+    n2 = set(["_".join(nn.name) for nn in all_nodes])
     for i,nn in enumerate(all_nodes):
         n = nn
         while "_".join(n.name[:-1]) not in n2 and len(n.name) > 1:
             n = CladeNode(".".join(n.name[:-1]),n.abundance)
             all_nodes.append(n)
-            n2.append("_".join(n.name))
+            n2.add("_".join(n.name))
 
     cls2 = []
     if params['all_feats'] != "":
@@ -181,11 +203,10 @@ def read_data(input_file,params):
     tree['root'] = root
     tree['max_abs'] = max(abundances)
     tree['min_abs'] = min(abundances)
-    levs = []
-    for i in range(depth):
-        depthi = [n for n in all_nodes if len(n.name) == i+1]
-        levs.append(len(depthi))
-    tree['nlev'] = levs
+    levs = [0]*(depth+1)
+    for n in all_nodes:
+        if len(n.name) <= depth: levs[len(n.name)] += 1
+    tree['nlev'] = levs[1:depth+1]
     return tree
 
 def add_all_pos(father,n,distn,seps,tsep,mlev,last_leaf=-1,nc=1):
@@ -212,25 +233,29 @@ def add_all_pos(father,n,distn,seps,tsep,mlev,last_leaf=-1,nc=1):
     tsep += seps[len(father.name)-1]
     return n,tsep,last_leaf
 
-def plot_points(father,params,pt_scale,ax):
-    children = father.get_children()
-    children.sort(key = lambda a: -int(a.get_color() == 'y')*a.abundance)
+# The plot_ functions walk the tree appending the geometry to lists, in the
+# order it is drawn: points (x,r,size,color,edge width), lines (vertices,
+# color,width) and shaded clades (x,width,bottom,height,color). draw_tree
+# adds each list to the axes as a single collection
+
+def plot_points(father,params,pt_scale,pts):
+    children = sorted(father.get_children(), key = lambda a: -int(a.get_color() == 'y')*a.abundance)
     x,r = father.pos[0], father.pos[1]
     for i,child in enumerate(children):
-        xc,rc = plot_points(child,params,pt_scale,ax)
+        xc,rc = plot_points(child,params,pt_scale,pts)
     if not father.viz: return x,r
     ps = pt_scale[0]+father.abundance/pt_scale[1]+pt_scale[0]
     col = father.get_color()
     pw = params['markeredgewidth'] if col == 'y' else params['markeredgewidth']*3.0
-    if x==0 and r==0: ax.plot(x,r, 'o',markersize=ps,color=col,markeredgewidth=0.01,markeredgecolor=params['fore_color'])
-    else: ax.plot(x,r, 'o',markersize=ps,color=col,markeredgewidth=pw,markeredgecolor=params['fore_color'])
+    if x==0 and r==0: pts.append((x,r,ps,col,0.01))
+    else: pts.append((x,r,ps,col,pw))
     return x,r
 
-def plot_lines(father,params,depth,ax,xf):
+def plot_lines(father,params,depth,lines,xf):
     children = father.get_children()
     x,r = father.pos[0], father.pos[1]
     for i,child in enumerate(children):
-        xc,rc = plot_lines(child,params,depth,ax,x)
+        xc,rc = plot_lines(child,params,depth,lines,x)
         if i == 0: x_first, r_first = xc, rc
         if len(father.name) >= depth-params['radial_start_lev']:
             col = params['fore_color']
@@ -240,8 +265,8 @@ def plot_lines(father,params,depth,ax,xf):
                 col = child.get_color()
                 lw *=2.5
             if col != params['fore_color']:
-                ax.plot([x,xc],[r,rc],"-",color=params['fore_color'],lw=lw*1.5)
-            ax.plot([x,xc],[r,rc],"-",color=col,lw=lw)
+                lines.append(([(x,r),(xc,rc)],params['fore_color'],lw*1.5))
+            lines.append(([(x,r),(xc,rc)],col,lw))
 
     if not father.viz or (len(children) == 1 and not children[0].viz): return x,r
     if len(father.name) < depth-params['radial_start_lev']:
@@ -261,12 +286,11 @@ def plot_lines(father,params,depth,ax,xf):
             if len(children) == 0: rc = r
             xt = x if len(children)>1 else xx
             if col != params['fore_color']:
-                ax.plot([x,xt],[r,rc],"-",color=params['fore_color'],lw=lw*1.5)
-            ax.plot([x,xt],[r,rc],"-",color=col,lw=lw)
+                lines.append(([(x,r),(xt,rc)],params['fore_color'],lw*1.5))
+            lines.append(([(x,r),(xt,rc)],col,lw))
     if len(children) > 0 and 1 < len(father.name) < depth-params['radial_start_lev']:
         xs = arange(x_first,xc,0.01)
-        ys = [rc for t in xs]
-        ax.plot(xs,ys,"-",color=col,lw=params['siblings_connector_width'],markeredgecolor=params['fore_color'])
+        lines.append((np.column_stack([xs,np.full(len(xs),rc)]),col,params['siblings_connector_width']))
     return x,r
 
 def uniqueid():
@@ -279,7 +303,7 @@ def uniqueid():
         yield str(i)
         i += 1
 
-def plot_names(father,params,depth,ax,u_i,seps):
+def plot_names(father,params,depth,ax,u_i,seps,wedges,handles):
     children = father.get_children()
     l = len(father.name)
     if len(children)==0:
@@ -290,7 +314,7 @@ def plot_names(father,params,depth,ax,u_i,seps):
             fr_0, fr_1 = father.pos[0], father.pos[0]  # fallback 或其他合理邏輯
 
     for i,child in enumerate(children):
-        fr,to = plot_names(child,params,depth,ax,u_i,seps)
+        fr,to = plot_names(child,params,depth,ax,u_i,seps,wedges,handles)
         if i == 0: fr_0 = fr
         fr_1 = to
     if father.get_color() != 'y' and params['labeled_start_lev'] < l <= params['labeled_stop_lev']+1:
@@ -309,10 +333,10 @@ def plot_names(father,params,depth,ax,u_i,seps):
             ide = next(u_i)
             lab = str(ide)+": "+father.last_name
             txt = str(ide)
-        ax.bar(fr_0, clto, width = fr_1-fr_0, bottom = float(l-1)/float(de), alpha = params['alpha'], color=col, edgecolor=col)
+        wedges.append((fr_0, fr_1-fr_0, float(l-1)/float(de), clto, col))
         # --- 修改開始：只在有標籤內容時才為圖例創建一個隱藏的條形 ---
         if lab: # 只有當 'lab' 不為空字串時，才建立這個圖例條目
-            ax.bar(0.0, 0.0, width = 0.0, bottom = 0.0, alpha = 1.0, color=father.get_color(), edgecolor=params['fore_color'], label=lab)
+            handles.append(Rectangle((0.0,0.0), 0.0, 0.0, alpha = 1.0, facecolor=father.get_color(), edgecolor=params['fore_color'], label=lab))
         # --- 修改結束 ---
         if l <= params['abrv_stop_lev'] + 1:
             if not params['col_lab']: col = params['fore_color']
@@ -328,6 +352,35 @@ def plot_names(father,params,depth,ax,u_i,seps):
             ax.text((fr_0+fr_1)*0.5, clto+float(l-1)/float(de)-dim*perc_ext/2.0, txt, size = params['label_font_size'], rotation=des, ha ="center", va="center", color=col)
     return fr_0, fr_1
 
+def add_lines(ax,lines):
+    if not lines: return
+    segs = [np.asarray(v,dtype=float) for v,c,w in lines]
+    ax.add_collection(LineCollection(segs, colors=[to_rgba(c) for v,c,w in lines], linewidths=[w for v,c,w in lines],
+                                     capstyle=rcParams['lines.solid_capstyle'], joinstyle=rcParams['lines.solid_joinstyle']), autolim=False)
+    ax.update_datalim(np.concatenate(segs))
+
+def add_points(ax,pts,params):
+    # the markers of plot(x,r,'o',markersize=size), on top of the lines
+    if not pts: return
+    xy = np.array([(x,r) for x,r,s,c,w in pts])
+    marker = MarkerStyle('o')
+    path = marker.get_path().transformed(marker.get_transform())
+    ax.add_collection(PathCollection([path], sizes=[s*s for x,r,s,c,w in pts], offsets=xy, offset_transform=ax.transData,
+                                     facecolors=[to_rgba(c) for x,r,s,c,w in pts], edgecolors=params['fore_color'],
+                                     linewidths=[w for x,r,s,c,w in pts], transform=IdentityTransform(), zorder=2, snap=True), autolim=False)
+    ax.update_datalim(xy)
+
+def add_wedges(ax,wedges,params):
+    # the bars of the labelled clades, drawn as wedges like ax.bar does (and
+    # centered on x as it does)
+    if not wedges: return
+    paths = [Path([(x-w*0.5,b),(x+w*0.5,b),(x+w*0.5,b+h),(x-w*0.5,b+h),(x-w*0.5,b)], closed=True, _interpolation_steps=100) for x,w,b,h,c in wedges]
+    cols = [to_rgba(c) for x,w,b,h,c in wedges]
+    coll = PathCollection(paths, facecolors=cols, edgecolors=cols, alpha=params['alpha'], joinstyle='miter')
+    coll.sticky_edges.y.extend([b for x,w,b,h,c in wedges])
+    ax.add_collection(coll, autolim=False)
+    ax.update_datalim(np.concatenate([p.vertices[:4] for p in paths]))
+
 def draw_tree(out_file,tree,params):
     plt_size = 7
     nlev = tree['nlev']
@@ -354,20 +407,25 @@ def draw_tree(out_file,tree,params):
 
     add_all_pos(tree['root'],0.0,ds,seps,0.0,depth)
 
-    plot_lines(tree['root'],params,depth,ax,0)
-    plot_points(tree['root'],params,pt_scale,ax)
-    plot_names(tree['root'],params,depth,ax,uniqueid(),seps)
+    lines, pts, wedges, handles = [], [], [], []
+    plot_lines(tree['root'],params,depth,lines,0)
+    plot_points(tree['root'],params,pt_scale,pts)
+    plot_names(tree['root'],params,depth,ax,uniqueid(),seps,wedges,handles)
+    add_lines(ax,lines)
+    add_points(ax,pts,params)
+    add_wedges(ax,wedges,params)
+    ax.autoscale_view()
     r = np.arange(0, 3.0, 0.01)
     theta = 2*np.pi*r
 
     def get_col_attr(x):
             return hasattr(x, 'set_color') and not hasattr(x, 'set_facecolor')
 
-    h, l = ax.get_legend_handles_labels()
+    l = [h.get_label() for h in handles]
     if len(l) > 0:
         # Each column allows at most 35 species (rows)
         ncol = len(l)//35+1
-        leg = ax.legend(bbox_to_anchor=(1.02, 1), frameon=False, loc=2, borderaxespad=0.,
+        leg = ax.legend(handles, l, bbox_to_anchor=(1.02, 1), frameon=False, loc=2, borderaxespad=0.,
                 prop={'size':params['label_font_size']},ncol=ncol)
         if leg != None:
             gca().add_artist(leg)
@@ -376,7 +434,7 @@ def draw_tree(out_file,tree,params):
 
     cll = sorted(tree['classes']) if params['all_feats'] == "" else sorted(params['all_feats'].split(":"))
     # --- 修改開始：圖例條顏色從 tree['class_to_color_map'] 獲取 ---
-    nll = [ax.bar(0.0, 0.0, width = 0.0, bottom = 0.0, color=tree['class_to_color_map'][c], label=c) for c in cll if c in tree['class_to_color_map']]
+    nll = [Rectangle((0.0,0.0), 0.0, 0.0, facecolor=tree['class_to_color_map'][c], label=c) for c in cll if c in tree['class_to_color_map']]
     # --- 修改結束 ---
     cl = [c for c in cll if c in tree['classes']]
 
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import os,sys,matplotlib,zipfile,argparse,string
+import os,sys,io,matplotlib,zipfile,argparse,string,multiprocessing
 matplotlib.use('Agg')
 from pylab import *
 from lefse.lefse import *
@@ -31,6 +31,7 @@ def read_params(args):
 	parser.add_argument('--archive', dest="archive", default="none", choices=["zip","none"], type=str, help="")
 	parser.add_argument('--background_color',dest="back_color", type=str, choices=["k","w"], default="w", help="set the color of the background")
 	parser.add_argument('--dpi',dest="dpi", type=int, default=72)
+	parser.add_argument('--jobs',dest="jobs", type=int, default=1, help="number of worker processes rendering the features (default 1)")
 		
 	args = parser.parse_args()
 
@@ -55,8 +56,23 @@ def read_data(file_data,file_feats,params):
                 sys.exit(0)
 	return features
 
+# the figure of the process, cleared and reused for all the features
+worker_fig = None
+worker_params = None
+
+def get_figure(params):
+	global worker_fig
+	if worker_fig is None: worker_fig = plt.figure(figsize=(params['width'], params['height']),edgecolor=params['fore_color'],facecolor=params['back_color'])
+	else:
+		worker_fig.clf()
+		worker_fig.set_size_inches(params['width'], params['height'])
+		worker_fig.set_edgecolor(params['fore_color'])
+		worker_fig.set_facecolor(params['back_color'])
+		plt.figure(worker_fig.number)
+	return worker_fig
+
 def plot(name,k_n,feat,params):
-	fig = plt.figure(figsize=(params['width'], params['height']),edgecolor=params['fore_color'],facecolor=params['back_color'])
+	fig = get_figure(params)
 	ax = fig.add_subplot(111,facecolor=params['back_color']) 
 	subplots_adjust(bottom=0.15)
 
@@ -134,23 +150,45 @@ def plot(name,k_n,feat,params):
 	
 
 	plt.savefig(name,format=params['format'],facecolor=params['back_color'],edgecolor=params['fore_color'],dpi=params['dpi'])
-	plt.close()
 	return name 
 
+def init_worker(params):
+	global worker_params
+	worker_params = params
+
+def render(task):
+	# for the archives the image is rendered in memory and returned,
+	# otherwise it is written to the file name
+	k,name,feat = task
+	if worker_params['archive'] != "zip": return k,plot(name,k,feat,worker_params),None
+	buf = io.BytesIO()
+	plot(buf,k,feat,worker_params)
+	return k,name,buf.getvalue()
+
+def export(images,archive):
+	for k,name,img in images:
+		print("Exporting ", k)
+		if archive is not None: archive.writestr(name, img, zipfile.ZIP_DEFLATED)
+
 def plot_features():
 	params = read_params(sys.argv)
 	params['fore_color'] = 'w' if params['back_color'] == 'k' else 'k'
 	features = read_data(params['input_file_1'],params['input_file_2'],params)
-	if params['archive'] == "zip": file = zipfile.ZipFile(params['output_file'], "w")
+	tasks = []
 	for k,f in features.items():
-		print("Exporting ", k)
-		if params['archive'] == "zip":
-			of = plot("/tmp/"+str(int(f['sig']))+"_"+"-".join(k.split("."))+"."+params['format'],k,f,params)
-			file.write(of, os.path.basename(of), zipfile.ZIP_DEFLATED)
-		else:
-			if params['f'] == 'one': plot(params['output_file'],k,f,params)
-			else: plot(params['output_file']+str(int(f['sig']))+"_"+"-".join(k.split("."))+"."+params['format'],k,f,params) 
-	if params['archive'] == "zip": file.close()
+		if params['archive'] == "zip": name = str(int(f['sig']))+"_"+"-".join(k.split("."))+"."+params['format']
+		elif params['f'] == 'one': name = params['output_file']
+		else: name = params['output_file']+str(int(f['sig']))+"_"+"-".join(k.split("."))+"."+params['format']
+		tasks.append((k,name,f))
+	archive = zipfile.ZipFile(params['output_file'], "w") if params['archive'] == "zip" else None
+	# pool.imap returns the images in order, the archive is the one of --jobs 1
+	if params['jobs'] <= 1:
+		init_worker(params)
+		export(map(render,tasks),archive)
+	else:
+		with multiprocessing.get_context('spawn').Pool(params['jobs'],init_worker,(params,)) as pool:
+			export(pool.imap(render,tasks),archive)
+	if archive is not None: archive.close()
 
 
 if __name__ == '__main__':
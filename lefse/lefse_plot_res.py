@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
 import os
+import io
 import sys
+import json
+import numpy
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from collections import defaultdict
+from matplotlib.collections import PolyCollection, PathCollection
+from matplotlib.font_manager import FontProperties
+from matplotlib.path import Path
+from matplotlib.textpath import TextPath, text_to_path
+from matplotlib.transforms import Affine2D
 import argparse
 
 def read_params(args):
@@ -15,7 +22,7 @@ def read_params(args):
     parser.add_argument('--title', type=str, default="", help="Plot title")
     parser.add_argument('--feature_font_size', type=int, default=7)
     parser.add_argument('--class_legend_font_size', type=int, default=10)
-    parser.add_argument('--format', choices=["png","svg","pdf"], default='png')
+    parser.add_argument('--format', choices=["png","svg","pdf","json"], default='png', help="json writes a Vega-Lite spec of the plot for the browser instead of an image")
     parser.add_argument('--dpi', type=int, default=300)
     parser.add_argument('--width', type=float, default=7.0)
     parser.add_argument('--height', type=float, default=4.0)
@@ -29,11 +36,14 @@ def read_params(args):
     parser.add_argument('--otu_only', action='store_true')
     parser.add_argument('--report_features', action='store_true')
     parser.add_argument('--colors', type=str, default="")
-    return vars(parser.parse_args())
+    return vars(parser.parse_args(args[1:]))
 
 def read_data(input_file, otu_only):
     with open(input_file, 'r') as inp:
-        lines = [line.strip().split() for line in inp if len(line.strip().split()) > 3]
+        return read_rows(inp, otu_only)
+
+def read_rows(res_lines, otu_only):
+    lines = [line.strip().split() for line in res_lines if len(line.strip().split()) > 3]
     if otu_only:
         lines = [ln for ln in lines if len(ln[0].split('.')) == 8]
     classes = sorted({ln[2] for ln in lines})
@@ -48,80 +58,154 @@ def get_color_map(classes, colors_arg):
     cycle = plt.rcParams['axes.prop_cycle'].by_key()['color']
     return {cls: cycle[i % len(cycle)] for i, cls in enumerate(classes)}
 
-def plot_hor(path, params, data):
+def bar_rows(params, data):
+    # the rows in plotting order with the signed LDA score of the bar (negative
+    # for the second of two classes) and the label of the feature
     rows = data['rows']
     classes = data['cls']
-    if not rows:
-        print("[ERROR] No features to plot.")
-        return
-
-    print(f"[INFO] Plotting {len(rows)} features for classes: {classes}")
     two_class = len(classes) == 2
-
     if two_class:
         rows.sort(key=lambda ab: abs(float(ab[3])) * (classes.index(ab[2])*2-1))
     else:
         mmax = max(abs(float(ab[3])) for ab in rows)
         rows.sort(key=lambda ab: abs(float(ab[3]))/mmax + (classes.index(ab[2])+1))
+    vals, lbls = [], []
+    for feat, _, grp, lda, *rest in rows:
+        vals.append(abs(float(lda)) * ((-1) if (two_class and classes.index(grp)==1) else 1))
+        parts = feat.split('.')
+        disp = parts[-params['n_scl']:] if params['n_scl'] > 0 else parts
+        lbl = ".".join(disp)
+        if len(lbl) > params['max_feature_len']:
+            lbl = lbl[:params['max_feature_len']//2 - 2] + " [..]" + lbl[-params['max_feature_len']//2 + 2:]
+        lbls.append(lbl)
+    return rows, vals, lbls
 
-    fig = plt.figure(figsize=(params['width'], len(rows)*0.2 + 1.0),
-                     facecolor=params['background_color'], edgecolor=params['background_color'])
-    ax = fig.add_subplot(1,1,1, facecolor=params['background_color'])
-    plt.subplots_adjust(left=params['ls'], right=1-params['rs'],
-                        top=0.9, bottom=0.1)
+def label_paths(lbls, size, right):
+    # the labels as paths in points from the left end of their baseline,
+    # moved left by their width for the right aligned ones
+    prop = FontProperties(size=size)
+    paths = []
+    for lbl in lbls:
+        path = TextPath((0,0), lbl, prop=prop)
+        if right and len(path.vertices):
+            w = text_to_path.get_text_width_height_descent(lbl, prop, ismath=False)[0]
+            path = Path(path.vertices-(w,0.0), path.codes)
+        paths.append(path)
+    return paths
 
-    color_map = get_color_map(classes, params['colors'])
+def save_spec(path, params, data, color_map, rows, vals, lbls):
+    # Vega-Lite spec of the barplot with the data inlined, for the browser to
+    # render instead of an image: the bars and the labels of the features,
+    # left of zero for the first class and right of it for the others
+    classes = data['cls']
+    fore = matplotlib.colors.to_hex(params['fore_color'])
+    mv = max([abs(v) for v in vals])
+    values = [{'feature': r[0], 'label': l, 'class': r[2], 'lda': abs(v), 'value': v,
+               'label_x': -mv/40.0 if classes.index(r[2]) == 0 else mv/40.0, 'order': i}
+              for i, (r, v, l) in enumerate(zip(rows, vals, lbls))]
+    # top to bottom as in the images, the first row is at the bottom there
+    y = {'field': 'order', 'type': 'ordinal', 'sort': 'descending', 'axis': None}
+    def labels(first):
+        return {'transform': [{'filter': "datum.label_x %s 0" % ('<' if first else '>')}],
+                'mark': {'type': 'text', 'align': 'right' if first else 'left', 'baseline': 'middle',
+                         'fontSize': params['feature_font_size'], 'color': fore},
+                'encoding': {'y': y, 'x': {'field': 'label_x', 'type': 'quantitative', 'title': 'LDA SCORE (log10)'},
+                             'text': {'field': 'label', 'type': 'nominal'}}}
+    spec = {'$schema': 'https://vega.github.io/schema/vega-lite/v5.json',
+            'title': {'text': params['title'], 'color': fore},
+            'background': matplotlib.colors.to_hex(params['background_color']),
+            'width': int(params['width']*72), 'height': {'step': 14},
+            'data': {'values': values},
+            'layer': [{'mark': {'type': 'bar', 'stroke': fore},
+                       'encoding': {'y': y,
+                                    'x': {'field': 'value', 'type': 'quantitative', 'title': 'LDA SCORE (log10)'},
+                                    'color': {'field': 'class', 'type': 'nominal',
+                                              'scale': {'domain': classes, 'range': [matplotlib.colors.to_hex(color_map[c]) for c in classes]},
+                                              'legend': {'orient': 'top', 'title': None, 'labelColor': fore}},
+                                    'tooltip': [{'field': 'feature'}, {'field': 'class'}, {'field': 'lda'}]}},
+                      labels(True), labels(False)],
+            'config': {'axis': {'labelColor': fore, 'titleColor': fore, 'gridColor': fore}, 'view': {'stroke': None}}}
+    out = json.dumps(spec)
+    if isinstance(path, str):
+        with open(path, 'w') as outf:
+            outf.write(out)
+    elif isinstance(path, io.TextIOBase): path.write(out)
+    else: path.write(out.encode('utf-8'))
+    print(f"[INFO] Barplot spec saved to: {path}")
 
-    out_data = defaultdict(list)
-
-    for i, row in enumerate(rows):
-        feat, _, grp, lda, *rest = row
-        score = abs(float(lda))
-        if params['report_features']:
-            out_data[feat] = [lda, grp]
-
-        try:
-            col = color_map[grp]
-            val = score * ((-1) if (two_class and classes.index(grp)==1) else 1)
-            label = grp if (i==0 or rows[i-1][2] != grp) else ""
-            ax.barh(i, val,
-                    color=col,
-                    edgecolor=params['fore_color'],
-                    height=0.8,
-                    label=label)
-        except Exception as e:
-            print(f"[ERROR] Failed to draw bar for {feat}: {e}")
+def png_max_dpi(width, n_rows):
+    # the largest dpi keeping the PNG of a barplot of n_rows features below
+    # the 2^16 pixels Agg can draw
+    return int((2**16-1)/max(width, n_rows*0.2 + 1.0))
+
+def plot_hor(path, params, data):
+    rows = data['rows']
+    classes = data['cls']
+    if not rows:
+        print("[ERROR] No features to plot.")
+        return
+
+    print(f"[INFO] Plotting {len(rows)} features for classes: {classes}")
+    rows, vals, lbls = bar_rows(params, data)
+    color_map = get_color_map(classes, params['colors'])
 
     if params['report_features']:
         print("Feature\tLDA_score\tClass")
-        for f, v in out_data.items():
-            print(f"{f}\t{v[0]}\t{v[1]}")
+        for r in rows:
+            print(f"{r[0]}\t{r[3]}\t{r[2]}")
 
-    mv = max([abs(float(v[3])) for v in rows])  # 最大的 LDA 值，供定位用
+    if params['format'] == 'json':
+        save_spec(path, params, data, color_map, rows, vals, lbls)
+        return
 
-    for i, r in enumerate(rows):
-        indcl = classes.index(r[2])
-        feat = r[0]
-        parts = feat.split('.')
-        disp = parts[-params['n_scl']:] if params['n_scl'] > 0 else parts
-        lbl = ".".join(disp)
-        if len(lbl) > params['max_feature_len']:
-            lbl = lbl[:params['max_feature_len']//2 - 2] + " [..]" + lbl[-params['max_feature_len']//2 + 2:]
+    height = len(rows)*0.2 + 1.0
+    if params['format'] == 'png' and params['dpi'] > png_max_dpi(params['width'], len(rows)):
+        raise ValueError(f"{len(rows)} features do not fit in a PNG at {params['dpi']} dpi, "
+                         f"use --dpi {png_max_dpi(params['width'], len(rows))} or lower, or --format svg, pdf or json")
 
-        try:
-            lda_score = float(r[3])
-            sign = 1 if (classes.index(r[2]) == 0) else -1
-            if sign < 0:
-                ax.text(mv/40.0, float(i)-0.3, lbl,
-                        ha='left', va='baseline', color=params['fore_color'],
-                        size=params['feature_font_size'])
-            else:
-                ax.text(-mv/40.0, float(i)-0.3, lbl,
-                        ha='right', va='baseline', color=params['fore_color'],
-                        size=params['feature_font_size'])
-        except Exception as e:
-            print(f"[WARN] Failed to label {feat}: {e}")
+    fig = plt.figure(figsize=(params['width'], height),
+                     facecolor=params['background_color'], edgecolor=params['background_color'])
+    ax = fig.add_subplot(1,1,1, facecolor=params['background_color'])
+    plt.subplots_adjust(left=params['ls'], right=1-params['rs'],
+                        top=0.9, bottom=0.1)
+
+    # one collection of bars per class, in the order of the rows so the
+    # legend lists the classes as the bars
+    ys = numpy.arange(len(rows))
+    vals = numpy.array(vals)
+    grps = numpy.array([r[2] for r in rows])
+    for grp in dict.fromkeys(grps):
+        sel = grps == grp
+        y, v = ys[sel], vals[sel]
+        verts = numpy.empty((len(y),4,2))
+        verts[:,(0,3),0] = 0.0
+        verts[:,(1,2),0] = v[:,None]
+        verts[:,(0,1),1] = (y-0.4)[:,None]
+        verts[:,(2,3),1] = (y+0.4)[:,None]
+        bars = PolyCollection(verts, facecolors=color_map[grp], edgecolors=params['fore_color'], joinstyle='miter', label=grp)
+        bars.sticky_edges.x.append(0.0)
+        ax.add_collection(bars)
+    ax.autoscale_view()
 
+    # in a PNG the labels of each side are drawn as one collection of text
+    # paths, placed at the baseline like the ax.text labels of the vector
+    # formats, where the texts keep the files small (glyphs written once)
+    mv = numpy.abs(vals).max()  # 最大的 LDA 值，供定位用
+    first = numpy.array([classes.index(r[2]) == 0 for r in rows], dtype=bool)
+    for side, x in ((first, -mv/40.0), (~first, mv/40.0)):
+        if not side.any(): continue
+        side_lbls = [l for l, f in zip(lbls, side) if f]
+        if params['format'] == 'png':
+            texts = PathCollection(label_paths(side_lbls, params['feature_font_size'], x < 0),
+                                   offsets=numpy.column_stack([numpy.full(side.sum(), x), ys[side]-0.3]),
+                                   offset_transform=ax.transData, transform=Affine2D().scale(1/72.0)+fig.dpi_scale_trans,
+                                   facecolors=params['fore_color'], edgecolors='none', linewidths=0, zorder=3, clip_on=False)
+            ax.add_collection(texts, autolim=False)
+        else:
+            for y, lbl in zip(ys[side], side_lbls):
+                ax.text(x, float(y)-0.3, lbl,
+                        ha='right' if x < 0 else 'left', va='baseline', color=params['fore_color'],
+                        size=params['feature_font_size'])
 
     ax.set_yticks([])
     ax.set_xlabel("LDA SCORE (log10)", color=params['fore_color'])
@@ -144,7 +228,7 @@ def plot_hor(path, params, data):
     ax.set_title(params['title'], color=params['fore_color'])
 
     try:
-        plt.savefig(path,
+        fig.savefig(path,
                     dpi=params['dpi'],
                     format=params['format'],
                     facecolor=params['background_color'],
@@ -152,7 +236,7 @@ def plot_hor(path, params, data):
         print(f"[INFO] Barplot saved to: {path}")
     except Exception as e:
         print(f"[ERROR] Failed to save figure: {e}")
-    plt.close()
+    plt.close(fig)
 
 def plot_ver(path, params, data):
     plot_hor(path, params, data)
@@ -162,10 +246,14 @@ def plot_res():
     params['fore_color'] = 'w' if params.get('background_color', 'w') == 'k' else 'k'
     data = read_data(params['input_file'], params['otu_only'])
 
-    if params['orientation']=='h':
-        plot_hor(params['output_file'], params, data)
-    else:
-        plot_ver(params['output_file'], params, data)
+    try:
+        if params['orientation']=='h':
+            plot_hor(params['output_file'], params, data)
+        else:
+            plot_ver(params['output_file'], params, data)
+    except ValueError as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
 
 if __name__ == '__main__':
     plot_res()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import sys,argparse
+from lefse.lefse import load_store,save_res
+from lefse.lefse_run import refilter,threshold_params
+
+def read_params(args):
+    parser = argparse.ArgumentParser(description='LEfSe refilter: re-applies the thresholds to the results saved with lefse_run --store')
+    parser.add_argument('store_file', metavar='STORE_FILE', type=str, help="the results store written by lefse_run --store")
+    parser.add_argument('output_file', metavar='OUTPUT_FILE', type=str,
+                help="the output file containing the data for the visualization module")
+    parser.add_argument('-a',dest="anova_alpha", metavar='float', type=float, default=None,
+                help="set the alpha value for the Anova test, not larger than the one of lefse_run (default the one of lefse_run)")
+    parser.add_argument('-w',dest="wilcoxon_alpha", metavar='float', type=float, default=None,
+                help="set the alpha value for the Wilcoxon test (default the one of lefse_run)")
+    parser.add_argument('-l',dest="lda_abs_th", metavar='float', type=float, default=None,
+                help="set the threshold on the absolute value of the logarithmic LDA score (default the one of lefse_run)")
+    parser.add_argument('--verbose',dest="verbose", metavar='int', choices=[0,1], type=int, default=0,
+        help="verbose execution (default 0)")
+    args = parser.parse_args(args[1:])
+    return vars(args)
+
+def lefse_refilter():
+    params = read_params(sys.argv)
+    store = load_store(params['store_file'])
+    for k in threshold_params:
+        if params[k] is None: params[k] = store['params'][k]
+    res = refilter(store,params,params['verbose'])
+    if res is None:
+        print("The thresholds change the features tested or the ones of the LDA bootstrap, run lefse_run again")
+        sys.exit(1)
+    save_res(res,params['output_file'])
+
+
+if __name__ == '__main__':
+    lefse_refilter()
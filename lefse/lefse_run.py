@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import os,sys,math,pickle
+import os,sys,math,pickle,multiprocessing
 from lefse.lefse import *
 
 def read_params(args):
@@ -22,12 +22,20 @@ def read_params(args):
         help="verbose execution (default 0)")
     parser.add_argument('--wilc',dest="wilc", metavar='int', choices=[0,1], type=int, default=1,
         help="wheter to perform the Wicoxon step (default 1)")
-    parser.add_argument('-r',dest="rank_tec", metavar='str', choices=['lda','svm'], type=str, default='lda',
-        help="select LDA or SVM for effect size (default LDA)")
+    parser.add_argument('--stat-backend',dest="stat_backend", metavar='str', choices=['r','native'], type=str, default='r',
+        help="select R (rpy2) or the native NumPy/SciPy implementation for the Kruskal-Wallis and Wilcoxon tests (default r; native p-values agree with R within 1e-9)")
+    parser.add_argument('--jobs',dest="jobs", metavar='int', type=int, default=1,
+        help="number of worker processes for the Kruskal-Wallis and Wilcoxon tests (default 1)")
+    parser.add_argument('-r',dest="rank_tec", metavar='str', choices=['lda','lda_native','svm'], type=str, default='lda',
+        help="select LDA (R), LDA (native NumPy implementation) or SVM for effect size (default LDA)")
     parser.add_argument('--svm_norm',dest="svm_norm", metavar='int', choices=[0,1], type=int, default=1,
         help="whether to normalize the data in [0,1] for SVM feature waiting (default 1 strongly suggested)")
     parser.add_argument('-b',dest="n_boots", metavar='int', type=int, default=30,
                 help="set the number of bootstrap iteration for LDA (default 30)")
+    parser.add_argument('--boot-jobs',dest="boot_jobs", metavar='int', type=int, default=1,
+                help="number of worker processes for the LDA bootstrap iterations (default 1)")
+    parser.add_argument('--seed',dest="seed", metavar='int', type=int, default=1982,
+                help="set the random seed, every bootstrap iteration i uses seed+i (default 1982)")
     parser.add_argument('-e',dest="only_same_subcl", metavar='int', type=int, default=0,
                 help="set whether perform the wilcoxon test only among the subclasses with the same name (default 0)")
     parser.add_argument('-c',dest="curv", metavar='int', type=int, default=0,
@@ -42,30 +50,114 @@ def read_params(args):
                 help="minimum number of samples per subclass for performing wilcoxon test (default 10)")
     parser.add_argument('-t',dest="title", metavar='str', type=str, default="",
                 help="set the title of the analysis (default input file without extension)")
+    parser.add_argument('--store',dest="store", metavar='str', type=str, default="",
+                help="save the unthresholded results (KW p-values, Wilcoxon comparisons, LDA scores) in this file, lefse_refilter re-applies -a, -w and -l on it")
     parser.add_argument('-y',dest="multiclass_strat", choices=[0,1], type=int, default=0,
                 help="(for multiclass tasks) set whether the test is performed in a one-against-one ( 1 - more strict!) or in a one-against-all setting ( 0 - less strict) (default 0)")
-    args = parser.parse_args()
+    args = parser.parse_args(args[1:])
 
     params = vars(args)
     if params['title'] == "":
         params['title'] = params['input_file'].split("/")[-1].split('.')[0]
+    # keep the threshold free Wilcoxon results (see wilcoxon_detail), needed
+    # to re-apply -w without testing again
+    params['wilcoxon_detail'] = params['store'] != ""
 
     return params
 
 
-def lefse_run():
-    init()
-    params = read_params(sys.argv)
-    feats,cls,class_sl,subclass_sl,class_hierarchy = load_data(params['input_file'])
-    kord,cls_means = get_class_means(class_sl,feats)
+# R rank-sum tests run and skipped by wilcoxon_screen in the last test_feats
+wilcoxon_evals = [0,0]
+
+def test_feats(names,feats,cls,subclass_sl,class_hierarchy,params):
+    global wilcoxon_evals
+    wilcoxon_evals = [0,0]
+    res = []
+    if params['stat_backend'] == 'native':
+        # the subclasses (the non-zero values for sparse features) are
+        # sorted once for both tests
+        pairs = wilcoxon_pairs(subclass_sl,class_hierarchy,params['min_c'],params['only_same_subcl'])
+        if isinstance(feats,SparseFeats):
+            ent = sort_sparse(feats.matrix(names))
+            kw_res = dict(zip(names,test_kw_sparse(cls['class'],ent,params['anova_alpha'])))
+        else:
+            blocks = sort_blocks([feats[k] for k in names],subclass_sl) if names else None
+            kw_res = dict(zip(names,test_kw_native(cls['class'],blocks if names else [],params['anova_alpha'],blocks)))
+        kw_feats = [k for k in names if kw_res[k][0]]
+        kw_rows = [i for i,k in enumerate(names) if kw_res[k][0]]
+        if not params['wilc']: wilc_pvs = {}
+        elif isinstance(feats,SparseFeats): wilc_pvs = test_wilcoxon_sparse(subclass_sl,pairs,sparse_rows(ent,kw_rows))
+        else: wilc_pvs = test_wilcoxon_native(subclass_sl,pairs,blocks[kw_rows] if kw_rows else [],blocks[kw_rows] if kw_rows else None)
+        kw_ind = dict([(k,i) for i,k in enumerate(kw_feats)])
+        report_progress('kw',len(names),len(names))
+    nw = 0
+    for i,feat_name in enumerate(names):
+        if params['stat_backend'] == 'native': kw_ok,pv = kw_res[feat_name]
+        else:
+            kw_ok,pv = test_kw_r(cls,feats[feat_name],params['anova_alpha'],sorted(cls.keys()))
+            report_progress('kw',i+1,len(names))
+        if not kw_ok or not params['wilc']:
+            res.append((feat_name,kw_ok,pv,None,None))
+            continue
+        nw += 1
+        pvs = dict([(k,v[kw_ind[feat_name]]) for k,v in wilc_pvs.items()]) if params['stat_backend'] == 'native' else None
+        if params['wilcoxon_detail'] and not params['curv']:
+            detail = wilcoxon_detail(subclass_sl,class_hierarchy,feats[feat_name],params['min_c'],params['only_same_subcl'],pvs)
+            res.append((feat_name,kw_ok,pv,wilcoxon_pass(detail,list(class_hierarchy.keys()),params['wilcoxon_alpha'],params['multiclass_strat'],params['strict']),detail))
+        elif params['stat_backend'] == 'r' and not params['curv']:
+            wilc,n_run,n_skip = wilcoxon_screen(subclass_sl,class_hierarchy,feats[feat_name],params['wilcoxon_alpha'],params['multiclass_strat'],params['strict'],params['min_c'],params['only_same_subcl'])
+            wilcoxon_evals = [wilcoxon_evals[0]+n_run,wilcoxon_evals[1]+n_skip]
+            res.append((feat_name,kw_ok,pv,wilc,None))
+        else: res.append((feat_name,kw_ok,pv,test_rep_wilcoxon_r(subclass_sl,class_hierarchy,feats[feat_name],params['wilcoxon_alpha'],params['multiclass_strat'],params['strict'],feat_name,params['min_c'],params['only_same_subcl'],params['curv'],pvs),None))
+        report_progress('wilcoxon',nw,len(kw_feats) if params['stat_backend'] == 'native' else None)
+    return res
+
+worker_data = None
+
+def init_worker(*data):
+    global worker_data
+    worker_data = data
+    init(data[-1]['stat_backend'] == 'r')
+
+def test_shard(names):
+    return test_feats(names,*worker_data),wilcoxon_evals
+
+def test_feats_parallel(feats,cls,subclass_sl,class_hierarchy,params):
+    # features are split in contiguous shards tested by a pool of processes,
+    # each one with its own R (or native backend) initialized once. pool.imap
+    # returns the shards in order so the results are the ones of --jobs 1
+    names = list(feats.keys())
+    if params['jobs'] <= 1:
+        res = test_feats(names,feats,cls,subclass_sl,class_hierarchy,params)
+        n_run,n_skip = wilcoxon_evals
+    else:
+        ns = max(int(math.ceil(len(names)/float(params['jobs']*4))),1)
+        shards = [names[i:i+ns] for i in range(0,len(names),ns)]
+        res,n_run,n_skip = [],0,0
+        with multiprocessing.get_context('spawn').Pool(params['jobs'],init_worker,(feats,cls,subclass_sl,class_hierarchy,params)) as pool:
+            for shard_res,evals in pool.imap(test_shard,shards):
+                res += shard_res
+                n_run,n_skip = n_run+evals[0],n_skip+evals[1]
+                report_progress('kw',len(res),len(names))
+                report_progress('wilcoxon',len([r for r in res if r[3] is not None]),None)
+    if params['verbose'] and n_run+n_skip:
+        print("Wilcoxon tests run in R:",n_run,"skipped by the pre-screen:",n_skip)
+    return res
+
+def select_feats(feats,tests,params,classes):
+    # removes from feats the features failing the Kruskal-Wallis or the
+    # Wilcoxon step, tests are the results of test_feats_parallel. The
+    # alphas are applied again, when tests has the Wilcoxon details they can
+    # differ from the ones of the tests
     wilcoxon_res = {}
     kw_n_ok = 0
     nf = 0
-    for feat_name,feat_values in list(feats.items()):
+    for feat_name,kw_ok,pv,res_wilcoxon_rep,detail in tests:
+        kw_ok = pv < params['anova_alpha']
+        if detail is not None: res_wilcoxon_rep = wilcoxon_pass(detail,classes,params['wilcoxon_alpha'],params['multiclass_strat'],params['strict'])
         if params['verbose']:
             print("Testing feature",str(nf),": ",feat_name)
             nf += 1
-        kw_ok,pv = test_kw_r(cls,feat_values,params['anova_alpha'],sorted(cls.keys()))
         if not kw_ok:
             if params['verbose']: print("\tkw ko")
             del feats[feat_name]
@@ -75,25 +167,33 @@ def lefse_run():
 
         if not params['wilc']: continue
         kw_n_ok += 1
-        res_wilcoxon_rep = test_rep_wilcoxon_r(subclass_sl,class_hierarchy,feat_values,params['wilcoxon_alpha'],params['multiclass_strat'],params['strict'],feat_name,params['min_c'],params['only_same_subcl'],params['curv'])
         wilcoxon_res[feat_name] = str(pv) if res_wilcoxon_rep else "-"
         if not res_wilcoxon_rep:
             if params['verbose']: print("wilc ko")
             del feats[feat_name]
         elif params['verbose']: print("wilc ok\t")
+    return wilcoxon_res,kw_n_ok
 
+def lda_step(cls,feats,class_sl,kw_n_ok,params):
+    # the bootstrap perturbs the values in place, sparse features are made
+    # dense (only the selected ones are left)
+    if isinstance(feats,SparseFeats): feats = dict(feats.items())
     if len(feats) > 0:
         print("Number of significantly discriminative features:", len(feats), "(", kw_n_ok, ") before internal wilcoxon")
         if params['lda_abs_th'] < 0.0:
             lda_res,lda_res_th = dict([(k,0.0) for k,v in feats.items()]), dict([(k,v) for k,v in feats.items()])
         else:
-            if params['rank_tec'] == 'lda': lda_res,lda_res_th = test_lda_r(cls,feats,class_sl,params['n_boots'],params['f_boots'],params['lda_abs_th'],0.0000000001,params['nlogs'])
+            if params['rank_tec'] == 'lda': lda_res,lda_res_th = test_lda_r(cls,feats,class_sl,params['n_boots'],params['f_boots'],params['lda_abs_th'],0.0000000001,params['nlogs'],params['seed'],params['boot_jobs'])
+            elif params['rank_tec'] == 'lda_native': lda_res,lda_res_th = test_lda_native(cls,feats,class_sl,params['n_boots'],params['f_boots'],params['lda_abs_th'],0.0000000001,params['nlogs'],params['seed'],params['boot_jobs'])
             elif params['rank_tec'] == 'svm': lda_res,lda_res_th = test_svm(cls,feats,class_sl,params['n_boots'],params['f_boots'],params['lda_abs_th'],0.0,params['svm_norm'])
             else: lda_res,lda_res_th = dict([(k,0.0) for k,v in feats.items()]), dict([(k,v) for k,v in feats.items()])
     else:
         print("Number of significantly discriminative features:", len(feats), "(", kw_n_ok, ") before internal wilcoxon")
         print("No features with significant differences between the two classes")
         lda_res,lda_res_th = {},{}
+    return lda_res,lda_res_th
+
+def lefse_res(kord,cls_means,wilcoxon_res,lda_res,lda_res_th,params):
     outres = {}
     outres['lda_res_th'] = lda_res_th
     outres['lda_res'] = lda_res
@@ -101,7 +201,62 @@ def lefse_run():
     outres['cls_means_kord'] = kord
     outres['wilcox_res'] = wilcoxon_res
     print("Number of discriminative features with abs LDA score >",params['lda_abs_th'],":",len(lda_res_th))
-    save_res(outres,params["output_file"])
+    return outres
+
+def run_lefse(feats,cls,class_sl,subclass_sl,class_hierarchy,params):
+    # the statistical steps on the loaded data, returns the results in the
+    # form taken by save_res. feats is modified: the features failing the
+    # tests are removed and the LDA step perturbs the values (of a dense
+    # copy for SparseFeats)
+    kord,cls_means = get_class_means(class_sl,feats)
+    tests = test_feats_parallel(feats,cls,subclass_sl,class_hierarchy,params)
+    wilcoxon_res,kw_n_ok = select_feats(feats,tests,params,list(class_hierarchy.keys()))
+    lda_res,lda_res_th = lda_step(cls,feats,class_sl,kw_n_ok,params)
+    if params['store']: save_store(results_store(kord,cls_means,tests,lda_res,params,list(class_hierarchy.keys())),params['store'])
+    return lefse_res(kord,cls_means,wilcoxon_res,lda_res,lda_res_th,params)
+
+# the parameters of the results store: the thresholds re-applied by
+# refilter and the ones fixed by the tests and the bootstrap
+threshold_params = ('anova_alpha','wilcoxon_alpha','lda_abs_th')
+store_params = threshold_params+('wilc','curv','multiclass_strat','strict','min_c','only_same_subcl','stat_backend','rank_tec','n_boots','f_boots','nlogs','seed','svm_norm')
+
+def results_store(kord,cls_means,tests,lda_res,params,classes):
+    store = {}
+    store['params'] = dict([(k,params[k]) for k in store_params])
+    store['classes'] = classes
+    store['cls_means_kord'] = kord
+    store['cls_means'] = dict([(k,[float(v) for v in m]) for k,m in cls_means.items()])
+    store['tests'] = [[feat_name,pv,res_wilcoxon_rep,detail] for feat_name,kw_ok,pv,res_wilcoxon_rep,detail in tests]
+    store['lda_res'] = lda_res
+    return store
+
+def refilter(store,params,verbose=0):
+    # the results for the -a, -w and -l of params from the results store,
+    # None if they cannot be re-applied: -a is larger than the one of the
+    # tests, -w changes without the Wilcoxon details, or the selected
+    # features differ from the ones of the LDA bootstrap
+    sp = store['params']
+    if params['anova_alpha'] > sp['anova_alpha']: return None
+    tests = [(feat_name,None,pv,res_wilcoxon_rep,detail) for feat_name,pv,res_wilcoxon_rep,detail in store['tests']]
+    if params['wilcoxon_alpha'] != sp['wilcoxon_alpha'] and sp['wilc']:
+        if len([t for t in tests if t[2] < sp['anova_alpha'] and t[4] is None]) > 0: return None
+    p = dict(sp)
+    p.update([(k,params[k]) for k in threshold_params])
+    p['verbose'] = verbose
+    feats = dict([(t[0],None) for t in tests])
+    wilcoxon_res,kw_n_ok = select_feats(feats,tests,p,store['classes'])
+    if p['lda_abs_th'] < 0.0: lda_res = dict([(k,0.0) for k in feats])
+    elif sp['lda_abs_th'] < 0.0 or set(feats) != set(store['lda_res']): return None
+    else: lda_res = store['lda_res']
+    lda_res_th = dict([(k,x) for k,x in lda_res.items() if math.fabs(x) > p['lda_abs_th']])
+    cls_means = store['cls_means']
+    return lefse_res(store['cls_means_kord'],cls_means,wilcoxon_res,lda_res,lda_res_th,p)
+
+def lefse_run():
+    params = read_params(sys.argv)
+    init(params['stat_backend'] == 'r' or params['rank_tec'] == 'lda',params['seed'])
+    feats,cls,class_sl,subclass_sl,class_hierarchy = load_data(params['input_file'])
+    save_res(run_lefse(feats,cls,class_sl,subclass_sl,class_hierarchy,params),params["output_file"])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+# The LEfSe steps as Python functions passing in-memory objects, for callers
+# running several analyses in one process (e.g. the web app): format_input
+# returns the formatted data written by lefse_format_input, run returns the
+# results written by lefse_run and the plot functions take those results
+# and write the image to a file name or a file object. R and its libraries
+# are loaded once per process and reused by all the runs.
+#
+# The keyword parameters are the ones of the command line modules, by their
+# destination name (e.g. norm_v, lda_abs_th, back_color), with the same
+# defaults.
+#
+# With a ResultCache the formatted data, the Kruskal-Wallis/Wilcoxon results
+# and the LDA scores are cached under a key made of the sha256 of the input
+# file and of the parameters of that stage and of the ones before it, so a
+# parameter change only recomputes the stages after it. The thresholds are
+# applied to the cached results: a new -w, a smaller -a or a new LDA
+# threshold only rerun the bootstrap if the features selected change, and a
+# new colour only redraws the plots.
+
+import os,sys,math,time,uuid,pickle,shutil,hashlib,tempfile,threading,weakref,collections,multiprocessing
+import concurrent.futures
+import numpy
+from lefse import lefse, lefse_format_input, lefse_run, lefse_plot_res, lefse_plot_cladogram
+
+# the parameters not changing the result of a stage (file names, number of
+# workers, verbosity) are left out of the cache keys
+format_skip = ('input_file','output_file','output_table','output_format','dtype')
+test_params = ('anova_alpha','wilcoxon_alpha','wilc','stat_backend','multiclass_strat','strict','min_c','only_same_subcl','curv')
+lda_params = ('rank_tec','n_boots','f_boots','nlogs','seed','svm_norm')
+
+def obj_size(obj):
+    # approximate memory used by the cached objects
+    if isinstance(obj,numpy.ndarray): return obj.nbytes
+    if isinstance(obj,lefse.SparseFeats): return obj.m.data.nbytes+obj.m.indices.nbytes+obj.m.indptr.nbytes+obj_size(obj.index)
+    if isinstance(obj,dict): return sys.getsizeof(obj)+sum([obj_size(k)+obj_size(v) for k,v in obj.items()])
+    if isinstance(obj,(list,tuple)): return sys.getsizeof(obj)+sum([obj_size(v) for v in obj])
+    return sys.getsizeof(obj)
+
+class ResultCache:
+    # least recently used entries are evicted when the cached objects take
+    # more than max_bytes; safe to share among threads. With a directory the
+    # entries are also pickled there, under the sha256 of the key, and read
+    # back on a miss, so the processes using the same directory (the workers
+    # of a JobQueue) share their results; the files read least recently are
+    # removed when they take more than disk_bytes
+    def __init__(self, max_bytes = 512*2**20, directory = None, disk_bytes = 2*2**30):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        if directory: os.makedirs(directory, exist_ok=True)
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+        value = self.load(key)
+        if value is not None: self.put(key, value, False)
+        return value
+    def put(self, key, value, store = True):
+        size = obj_size(value)
+        with self.lock:
+            if key in self.entries: self.size -= self.entries.pop(key)[1]
+            if size <= self.max_bytes:
+                self.entries[key] = (value,size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    self.size -= self.entries.popitem(last=False)[1][1]
+        if store: self.store(key, value)
+        return value
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode('utf-8')).hexdigest()+".pkl")
+    def load(self, key):
+        if not self.directory: return None
+        fn = self.path(key)
+        try:
+            with open(fn, 'rb') as inp: value = pickle.load(inp)
+            os.utime(fn)
+        except (OSError,EOFError,pickle.UnpicklingError): return None
+        # a hash collision is not taken for a hit
+        return value[1] if value[0] == key else None
+    def store(self, key, value):
+        if not self.directory: return
+        # written under a temporary name and renamed, the other processes
+        # see either no file or the complete one
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as out: pickle.dump((key,value), out, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+        self.prune()
+    def prune(self):
+        files = []
+        for e in os.scandir(self.directory):
+            if not e.name.endswith(".pkl"): continue
+            try: st = e.stat()
+            except OSError: continue
+            files.append((st.st_mtime,st.st_size,e.path))
+        total = sum([f[1] for f in files])
+        for mtime,size,fn in sorted(files):
+            if total <= self.disk_bytes: break
+            try: os.remove(fn)
+            except OSError: pass
+            total -= size
+
+def file_digest(input_file):
+    h = hashlib.sha256()
+    with open(input_file, 'rb') as inp:
+        for chunk in iter(lambda: inp.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def get_params(read_params, input_file = "", output_file = "", **kw):
+    params = read_params(["", input_file, output_file])
+    unknown = sorted(set(kw) - set(params))
+    if unknown: raise TypeError("unknown parameters: "+", ".join(unknown))
+    params.update(kw)
+    return params
+
+def init(stat_backend = 'r', rank_tec = 'lda', seed = 1982):
+    lefse.init(stat_backend == 'r' or rank_tec == 'lda', seed)
+
+def format_input(input_file, cache = None, **kw):
+    # with a cache the data is shared by the callers and must not be
+    # modified, data['key'] is the key of the later stages; the data keeps
+    # the numpy matrices of the mmap output format
+    kw.setdefault('output_format', 'mmap')
+    params = get_params(lefse_format_input.read_params, input_file, **kw)
+    if cache is None: return lefse_format_input.format_data(params)
+    key = ('format',file_digest(input_file))+tuple(sorted([(k,v) for k,v in params.items() if k not in format_skip]))
+    data = cache.get(key)
+    if data is None:
+        data = lefse_format_input.format_data(params)
+        data['key'] = key
+        cache.put(key, data)
+    return data
+
+def run(data, cache = None, **kw):
+    params = get_params(lefse_run.read_params, **kw)
+    init(params['stat_backend'], params['rank_tec'], params['seed'])
+    # the steps remove and perturb the features, data is left untouched
+    if isinstance(data['feats'],lefse.SparseFeats): feats = data['feats'].copy()
+    else: feats = dict([(k,numpy.array(v,dtype=float)) for k,v in data['feats'].items()])
+    cls,class_sl,subclass_sl,class_hierarchy = data['cls'],data['class_sl'],data['subclass_sl'],data['class_hierarchy']
+    if cache is None or 'key' not in data:
+        return lefse_run.run_lefse(feats,cls,class_sl,subclass_sl,class_hierarchy,params)
+
+    kord,cls_means = lefse.get_class_means(class_sl,feats)
+    # the tests keep the Wilcoxon details and are reused for any smaller -a
+    # and any -w (only the same -w with -c 1), select_feats applies them
+    params['wilcoxon_detail'] = True
+    key = data['key']+('tests',)+tuple([params[p] for p in test_params if p != 'anova_alpha' and (p != 'wilcoxon_alpha' or params['curv'])])
+    tests = cache.get(key)
+    if tests is None or tests[0] < params['anova_alpha']:
+        tests = cache.put(key, (params['anova_alpha'],lefse_run.test_feats_parallel(feats,cls,subclass_sl,class_hierarchy,params)))
+    wilcoxon_res,kw_n_ok = lefse_run.select_feats(feats,tests[1],params,list(class_hierarchy.keys()))
+    # the scores depend on the features selected but not on the threshold,
+    # it is applied here
+    key += ('lda',params['lda_abs_th'] < 0.0,hashlib.sha256("\n".join(feats).encode('utf-8')).hexdigest())+tuple([params[p] for p in lda_params])
+    lda_res = cache.get(key)
+    if lda_res is None: lda_res = cache.put(key, lefse_run.lda_step(cls,feats,class_sl,kw_n_ok,params)[0])
+    lda_res_th = dict([(k,x) for k,x in lda_res.items() if math.fabs(x) > params['lda_abs_th']])
+    return lefse_run.lefse_res(kord,cls_means,wilcoxon_res,lda_res,lda_res_th,params)
+
+def res_lines(res):
+    return lefse.res_lines(res)
+
+def plot_res(res, output, **kw):
+    params = get_params(lefse_plot_res.read_params, **kw)
+    params['fore_color'] = 'w' if params['background_color'] == 'k' else 'k'
+    data = lefse_plot_res.read_rows(lefse.res_lines(res), params['otu_only'])
+    if params['orientation'] == 'h': lefse_plot_res.plot_hor(output, params, data)
+    else: lefse_plot_res.plot_ver(output, params, data)
+
+def plot_cladogram(res, output, **kw):
+    params = get_params(lefse_plot_cladogram.read_params, **kw)
+    params['fore_color'] = 'w' if params['back_color'] == 'k' else 'k'
+    tree = lefse_plot_cladogram.read_tree(lefse.res_lines(res), params)
+    lefse_plot_cladogram.draw_tree(output, tree, params)
+
+class QueueFull(RuntimeError):
+    pass
+
+worker_cache = None
+worker_progress = None
+
+def init_worker(cache_bytes, cache_dir, load_r, progress):
+    global worker_cache, worker_progress
+    worker_cache = ResultCache(cache_bytes, cache_dir)
+    worker_progress = progress
+    lefse.init(load_r)
+
+def run_job(job_id, fun, *args, **kw):
+    # runs fun in a worker publishing the lefse.progress_hook reports in
+    # worker_progress[job_id], at most twice a second
+    state, last = {}, [0.0]
+    def hook(stage, done, total):
+        state[stage] = (done,total)
+        if time.time()-last[0] > 0.5 or done == total:
+            last[0] = time.time()
+            worker_progress[job_id] = dict(state)
+    lefse.progress_hook = hook
+    try: return fun(*args, **kw)
+    finally:
+        lefse.progress_hook = None
+        worker_progress[job_id] = dict(state)
+
+class JobQueue:
+    # runs the jobs on a pool of worker processes, each one with its own R
+    # (loaded once) and its own ResultCache of cache_bytes in memory. The
+    # caches of the workers share their entries through cache_dir (a
+    # temporary directory removed with the queue if not given), so a re-run
+    # reuses the results of the previous runs whichever worker gets it. At
+    # most max_jobs jobs are queued or running, submit raises QueueFull
+    # beyond that. The jobs are known by the id returned by submit, status
+    # can be polled from any thread until keep seconds after the job ended
+    def __init__(self, workers = 2, max_jobs = 8, cache_bytes = 512*2**20, load_r = True, keep = 24*3600, cache_dir = None):
+        ctx = multiprocessing.get_context('spawn')
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix="lefse_cache_")
+            weakref.finalize(self, shutil.rmtree, cache_dir, True)
+        self.cache_dir = cache_dir
+        self.manager = ctx.Manager()
+        self.progress = self.manager.dict()
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers, ctx, init_worker, (cache_bytes,cache_dir,load_r,self.progress))
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.keep = keep
+        self.jobs = {}
+        self.lock = threading.Lock()
+    def submit(self, fun, *args, **kw):
+        self.forget_old()
+        if not self.slots.acquire(blocking=False): raise QueueFull("too many LEfSe jobs queued")
+        job_id = uuid.uuid4().hex
+        try: fut = self.executor.submit(run_job, job_id, fun, *args, **kw)
+        except BaseException:
+            self.slots.release()
+            raise
+        job = {'future': fut, 'args': args, 'kw': kw, 'submitted': time.time(), 'ended': None}
+        with self.lock: self.jobs[job_id] = job
+        def done(f):
+            job['ended'] = time.time()
+            self.slots.release()
+        fut.add_done_callback(done)
+        return job_id
+    def status(self, job_id):
+        # state is 'queued', 'running', 'done', 'failed' or 'unknown';
+        # progress maps the stages to (done,total), result is the value
+        # returned by the job and error the message of its exception
+        with self.lock: job = self.jobs.get(job_id)
+        if job is None: return {'state': 'unknown'}
+        fut = job['future']
+        st = {'args': job['args'], 'kw': job['kw'], 'progress': self.progress.get(job_id,{})}
+        if not fut.done(): st['state'] = 'running' if fut.running() else 'queued'
+        elif fut.exception() is not None: st['state'], st['error'] = 'failed', str(fut.exception())
+        else: st['state'], st['result'] = 'done', fut.result()
+        return st
+    def forget_old(self):
+        now = time.time()
+        with self.lock:
+            old = [k for k,j in self.jobs.items() if j['ended'] is not None and now-j['ended'] > self.keep]
+            for k in old:
+                del self.jobs[k]
+                self.progress.pop(k,None)
+
+def analyse(input_file, out_dir, format_kw = {}, run_kw = {}, plot_res_kw = {}, cladogram_kw = {}, barplot_png = False):
+    # formats, runs and plots input_file writing result.res, barplot and
+    # cladogram in out_dir, returns the paths of the files written. With
+    # barplot_png a barplot in another format also gets a PNG copy
+    # (barplot_png), at a dpi lowered to fit in Agg if needed. A failed
+    # cladogram is left out, the other steps raise RuntimeError
+    lefse.report_progress('format',0,1)
+    try: data = format_input(input_file, cache=worker_cache, **format_kw)
+    except Exception as e: raise RuntimeError("Format input failed: "+str(e))
+    lefse.report_progress('format',1,1)
+    try: res = run(data, cache=worker_cache, **run_kw)
+    except Exception as e: raise RuntimeError("LEfSe failed: "+str(e))
+    lefse.report_progress('plots',0,2)
+    out = {'result': os.path.join(out_dir, "result.res")}
+    lefse.save_res(res, out['result'])
+    ext = plot_res_kw.get('format', 'png')
+    bar = os.path.join(out_dir, "barplot."+ext)
+    try: plot_res(res, bar, **plot_res_kw)
+    except Exception as e: raise RuntimeError("Barplot generation failed: "+str(e))
+    if os.path.exists(bar): out['barplot'] = bar
+    if barplot_png and ext != 'png':
+        png_kw = dict(plot_res_kw, format='png')
+        params = get_params(lefse_plot_res.read_params, **png_kw)
+        png_kw['dpi'] = min(params['dpi'], lefse_plot_res.png_max_dpi(params['width'], len(res['lda_res_th'])))
+        png = os.path.join(out_dir, "barplot.png")
+        try: plot_res(res, png, **png_kw)
+        except Exception as e: raise RuntimeError("Barplot generation failed: "+str(e))
+        if os.path.exists(png): out['barplot_png'] = png
+    lefse.report_progress('plots',1,2)
+    clad = os.path.join(out_dir, "cladogram."+cladogram_kw.get('format', 'svg'))
+    try:
+        plot_cladogram(res, clad, **cladogram_kw)
+        out['cladogram'] = clad
+    except Exception: pass
+    lefse.report_progress('plots',2,2)
+    return out
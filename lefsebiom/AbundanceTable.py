@@ -34,10 +34,9 @@ __status__ = "Development"
 
 import csv
 import sys
-from .CClade import CClade
 from .ConstantsBreadCrumbs import ConstantsBreadCrumbs
 import copy
-from datetime import date
+from datetime import date, datetime
 import numpy as np
 import os
 import re
@@ -62,6 +61,7 @@ except ImportError:
 
 from biom.parse import *
 from biom.table import *
+from biom.util import get_biom_format_version_string, get_biom_format_url_string
 
 c_dTarget    = 1.0
 c_fRound    = False
@@ -228,8 +228,9 @@ class AbundanceTable:
 
         ### Data
 
-        #The abundance data
-        self._npaFeatureAbundance = npaAbundance
+        #The abundance data, kept as the feature IDs, a 2-D matrix (Row=Features, Columns=Samples)
+        #and the sample names instead of the structured array given
+        self._funcSetAbundance(npaAbundance)
 
 
         ### Logistical
@@ -246,14 +247,14 @@ class AbundanceTable:
         self._fIsNormalized = self._fIsSummed = None
         #If contents is not a false then set contents to appropriate objects
         # Checking to see if the data is normalized, summed and if we need to run a filter on it.
-        if len(self._npaFeatureAbundance) and self._dictTableMetadata:
-            self._iOriginalFeatureCount = self._npaFeatureAbundance.shape[0]
+        if self.funcGetFeatureCount() and self._dictTableMetadata:
+            self._iOriginalFeatureCount = self.funcGetFeatureCount()
             self._iOriginalSampleCount = len(self.funcGetSampleNames())
-        
-            self._fIsNormalized = ( max( [max( list(a)[1:] or [0] ) for a in self._npaFeatureAbundance] or [0] ) <= 1 )
 
-            lsLeaves = AbundanceTable.funcGetTerminalNodesFromList( [a[0] for a in self._npaFeatureAbundance], self._cFeatureDelimiter )
-            self._fIsSummed = ( len( lsLeaves ) != len( self._npaFeatureAbundance ) )
+            self._fIsNormalized = ( ( self._npaAbundance.max() if self._npaAbundance.size else 0 ) <= 1 )
+
+            lsLeaves = AbundanceTable.funcGetTerminalNodesFromList( self._npaFeatureIDs.tolist(), self._cFeatureDelimiter )
+            self._fIsSummed = ( len( lsLeaves ) != self.funcGetFeatureCount() )
 
             #Occurence filtering
             #Removes features that do not have a given level iLowestAbundance in a given amount of samples iLowestSampleOccurence
@@ -263,6 +264,67 @@ class AbundanceTable:
 #      else:
 #        sys.stderr.write( "Abundance or metadata was None, should be atleast an empty object\n" )
 
+    def _funcSetAbundance(self, npaAbundance):
+        """
+        Private method
+        Splits a structured array of abundance data into the feature IDs (first field), a 2-D matrix
+        of the measurements (the other fields) and the sample names, which are what the table holds.
+
+        :param    npaAbundance:    Structured Array of abundance data (Row=Features, Columns=Samples)
+        :type:    Numpy Structured Array abundance data (Row=Features, Columns=Samples) or None
+        """
+
+        if npaAbundance is None:
+            self._sIDMetadataName, self._lsSampleNames = None, []
+            self._npaFeatureIDs = self._npaAbundance = None
+            return
+
+        lsNames = npaAbundance.dtype.names
+        self._sIDMetadataName, self._lsSampleNames = lsNames[0], list(lsNames[1:])
+        self._npaFeatureIDs = npaAbundance[lsNames[0]].copy()
+        dtypeData = np.result_type(*[npaAbundance.dtype[sName] for sName in lsNames[1:]]) if len(lsNames) > 1 else np.dtype(float)
+        self._npaAbundance = np.empty((len(npaAbundance), len(lsNames)-1), dtype=dtypeData)
+        for iIndex, sName in enumerate(lsNames[1:]):
+            self._npaAbundance[:,iIndex] = npaAbundance[sName]
+
+    def _funcMakeStructuredArray(self, npaFeatureIDs = None, npaAbundance = None, lsSampleNames = None):
+        """
+        Private method
+        Builds a structured array (the layout of the public interface) from feature IDs, a 2-D matrix of
+        measurements and sample names, by default the ones of the table.
+
+        :param    npaFeatureIDs:    Feature IDs in the order of the rows of npaAbundance
+        :type:    Numpy array
+        :param    npaAbundance:    Measurements (Row=Features, Columns=Samples)
+        :type:    2-D Numpy array
+        :param    lsSampleNames:    Names of the columns of npaAbundance
+        :type:    List of strings
+        :return    Numpy Structured Array:    The ID field followed by one field per sample.
+        """
+
+        npaFeatureIDs = self._npaFeatureIDs if npaFeatureIDs is None else npaFeatureIDs
+        npaAbundance = self._npaAbundance if npaAbundance is None else npaAbundance
+        lsSampleNames = self._lsSampleNames if lsSampleNames is None else lsSampleNames
+
+        npaStructured = np.empty(len(npaFeatureIDs), dtype=np.dtype([(self._sIDMetadataName, npaFeatureIDs.dtype)] +
+            [(sName, npaAbundance.dtype) for sName in lsSampleNames]))
+        npaStructured[self._sIDMetadataName] = npaFeatureIDs
+        for iIndex, sName in enumerate(lsSampleNames):
+            npaStructured[sName] = npaAbundance[:,iIndex]
+        return npaStructured
+
+    def _funcKeepFeatures(self, lfKeepFeatures):
+        """
+        Private method
+        Reduces the table to the features (rows) flagged or indexed.
+
+        :param    lfKeepFeatures:    Features to keep
+        :type:    Numpy array of booleans (one per feature) or of indices
+        """
+
+        self._npaFeatureIDs = self._npaFeatureIDs[lfKeepFeatures]
+        self._npaAbundance = self._npaAbundance[lfKeepFeatures]
+
     @staticmethod
     def funcMakeFromFile(xInputFile, cDelimiter = ConstantsBreadCrumbs.c_cTab, sMetadataID = None, sLastMetadataRow = None, sLastMetadata = None,
        lOccurenceFilter = None, cFeatureNameDelimiter="|", xOutputFile = None, strFormat = None):
@@ -448,9 +510,9 @@ class AbundanceTable:
       Create a string representation of the Abundance Table.
       """
 
-      return "".join(["Sample count:", str(len(self._npaFeatureAbundance.dtype.names[1:])),
-      os.linesep+"Feature count:", str(len(self._npaFeatureAbundance[self._npaFeatureAbundance.dtype.names[0]])),
-      os.linesep+"Id Metadata:", self._npaFeatureAbundance.dtype.names[0],
+      return "".join(["Sample count:", str(len(self._lsSampleNames)),
+      os.linesep+"Feature count:", str(self.funcGetFeatureCount()),
+      os.linesep+"Id Metadata:", self._sIDMetadataName,
       os.linesep+"Metadata ids:", str(list(self._dictTableMetadata.keys())),
       os.linesep+"Metadata count:", str(len(list(self._dictTableMetadata.keys()))),
       os.linesep+"Originating source:",self._strOriginalName,
@@ -808,7 +870,7 @@ class AbundanceTable:
         :param npdData: Rows of features to add to the table
         :type:    Numpy array accessed by row.
         """
-        if ( self._npaFeatureAbundance == None ):
+        if ( self._npaAbundance is None ):
             return False
 
         # Check number of input data rows
@@ -816,12 +878,9 @@ class AbundanceTable:
         if (len(lsNames) != iDataRows):
             print("Error:The names and the rows of data features to add must be of equal length")
 
-        # Grow the array by the neccessary amount and add the new rows
-        iTableRowCount = self.funcGetFeatureCount()
-        iRowElementCount = self.funcGetSampleCount()
-        self._npaFeatureAbundance.resize(iTableRowCount+iDataRows)
-        for iIndexData in range(iDataRows):
-            self._npaFeatureAbundance[iTableRowCount+iIndexData] = tuple([lsNames[iIndexData]]+list(npdData[iIndexData]))
+        # Add the new rows
+        self._npaFeatureIDs = np.concatenate([self._npaFeatureIDs, np.array(lsNames[:iDataRows], dtype=self._npaFeatureIDs.dtype)])
+        self._npaAbundance = np.vstack([self._npaAbundance, np.asarray(npdData, dtype=self._npaAbundance.dtype).reshape(iDataRows, -1)])
 
         return True
 
@@ -855,7 +914,7 @@ class AbundanceTable:
         :type:    Character
         :return    Boolean:    Indicator of success or not (false)
         """
-        if ( self._npaFeatureAbundance == None ):
+        if ( self._npaFeatureIDs is None ):
             return False
         cDelimiterCurrent = self.funcGetFeatureDelimiter()
         if ( not cDelimiter or not cDelimiterCurrent):
@@ -866,7 +925,7 @@ class AbundanceTable:
         
         #Update new feature names to abundance table
         if (not self.funcGetIDMetadataName() == None):
-            self._npaFeatureAbundance[self.funcGetIDMetadataName()] = np.array(lsNewFeatureNames)
+            self._npaFeatureIDs = np.array(lsNewFeatureNames)
 
         #Update delimiter
         self._cFeatureDelimiter = cDelimiter
@@ -881,7 +940,7 @@ class AbundanceTable:
                                 A list of string names or empty list on error as well as no underlying table.
         """
 
-        return self._npaFeatureAbundance.dtype.names[1:] if ( len(self._npaFeatureAbundance) > 1 ) else []
+        return tuple(self._lsSampleNames) if ( self.funcGetFeatureCount() > 1 ) else []
 
     #Happy Path Tested
     def funcGetIDMetadataName(self):
@@ -892,7 +951,7 @@ class AbundanceTable:
                       Returns none on error.
         """
 
-        return self._npaFeatureAbundance.dtype.names[0] if ( len(self._npaFeatureAbundance) > 1  ) else None
+        return self._sIDMetadataName if ( self.funcGetFeatureCount() > 1  ) else None
 
     #Happy path tested
     def funcGetAbundanceCopy(self):
@@ -903,7 +962,7 @@ class AbundanceTable:
                                        Returns none on error.
         """
 
-        return self._npaFeatureAbundance.copy() if ( self._npaFeatureAbundance != None ) else None
+        return self._funcMakeStructuredArray() if ( self._npaAbundance is not None ) else None
 
     #Happy path tested
     def funcGetAverageAbundancePerSample(self, lsTargetedFeatures):
@@ -961,11 +1020,7 @@ class AbundanceTable:
             return ldAverageSample
 
         #If there are samples return the average of each feature in the order of the feature names.
-        for sFeature in self._npaFeatureAbundance:
-            npFeaturesAbundance = list(sFeature)[1:]
-            ldAverageSample.append(sum(npFeaturesAbundance)/float(len(npFeaturesAbundance)))
-
-        return ldAverageSample
+        return (self._npaAbundance.sum(axis=1)/float(self._npaAbundance.shape[1])).tolist()
 
     #Tested 2 cases
     def funcHasFeatureHierarchy(self):
@@ -976,7 +1031,7 @@ class AbundanceTable:
         :return    Boolean:    True (Has a hierarchy) or False (Does not have a hierarchy)
         """
 
-        if ( self._npaFeatureAbundance == None ):
+        if ( self._npaFeatureIDs is None ):
             return None
         cDelimiter = self.funcGetFeatureDelimiter()
         if ( not cDelimiter ):
@@ -1007,7 +1062,7 @@ class AbundanceTable:
         :return    Boolean:    True (Has a hierarchy) or False (Does not have a hierarchy)
         """
 
-        if ( self._npaFeatureAbundance == None ):
+        if ( self._npaFeatureIDs is None ):
             return None
         cDelimiter = self.funcGetFeatureDelimiter()
         lsPrefixes = self.funcGetCladePrefixes()
@@ -1029,7 +1084,7 @@ class AbundanceTable:
 
         #Update new feature names to abundance table
         if not self.funcGetIDMetadataName() == None:
-            self._npaFeatureAbundance[self.funcGetIDMetadataName()] = np.array(lsUpdatedFeatureNames)
+            self._npaFeatureIDs = np.array(lsUpdatedFeatureNames)
 
         return True
 
@@ -1044,14 +1099,14 @@ class AbundanceTable:
                   On an error None is returned.
         """
         
-        if ( self._npaFeatureAbundance == None ) or ( lsFeatures == None ):
+        if ( self._npaAbundance is None ) or ( lsFeatures is None ):
             return None
 
         #Get a list of boolean indicators that the row is from the features list
-        lfFeatureData = [sRowID in lsFeatures for sRowID in self.funcGetFeatureNames()]
+        lfFeatureData = np.isin(self._npaFeatureIDs, list(lsFeatures))
         #compressed version as an Abundance table
         lsNamePieces = os.path.splitext(self._strOriginalName)
-        abndFeature = AbundanceTable(npaAbundance=np.compress(lfFeatureData, self._npaFeatureAbundance, axis = 0),
+        abndFeature = AbundanceTable(npaAbundance=self._funcMakeStructuredArray(self._npaFeatureIDs[lfFeatureData], self._npaAbundance[lfFeatureData]),
                     dictMetadata = self.funcGetMetadataCopy(),
                     strName = lsNamePieces[0] + "-" + str(len(lsFeatures)) +"-Features"+lsNamePieces[1],
                     strLastMetadata=self.funcGetLastMetadataName(),
@@ -1079,7 +1134,7 @@ class AbundanceTable:
                         Returns None on error.
         """
 
-        return self._npaFeatureAbundance.shape[0] if not self._npaFeatureAbundance is None else 0
+        return self._npaFeatureIDs.shape[0] if not self._npaFeatureIDs is None else 0
 
     #Happy path tested
     def funcGetFeatureSumAcrossSamples(self,sFeatureName):
@@ -1101,10 +1156,8 @@ class AbundanceTable:
         :return    Double:    Feature across samples.
         """
 
-        for sFeature in self._npaFeatureAbundance:
-            if sFeature[0] == sFeatureName:
-                return list(sFeature)[1:]
-        return None
+        liIndex = np.flatnonzero(self._npaFeatureIDs == sFeatureName) if not self._npaFeatureIDs is None else []
+        return list(self._npaAbundance[liIndex[0]]) if len(liIndex) else None
 
     #Happy path tested
     def funcGetFeatureNames(self):
@@ -1115,8 +1168,8 @@ class AbundanceTable:
                                 As an error returns empty list.
         """
 
-        if (not self._npaFeatureAbundance == None):
-            return self._npaFeatureAbundance[self.funcGetIDMetadataName()]
+        if (not self._npaFeatureIDs is None):
+            return self._npaFeatureIDs
         return []
 
     #Happy path tested
@@ -1148,8 +1201,8 @@ class AbundanceTable:
                 Empty numpy array returned on error.
         """
 
-        if (not self._npaFeatureAbundance == None):
-            return self._npaFeatureAbundance[sSampleName].copy()
+        if (not self._npaAbundance is None):
+            return self._npaAbundance[:,self._lsSampleNames.index(sSampleName)].copy()
         return np.array([])
 
     #Happy path tested
@@ -1302,19 +1355,15 @@ class AbundanceTable:
 
         #Get a threshold score of the value at the specified percentile for each sample
         #In the order of the sample names
-        ldScoreAtPercentile = [scipy.stats.scoreatpercentile(self._npaFeatureAbundance[lsSampleNames[iIndex]],dPercentileCutOff) for iIndex in range(iSampleCount)]
+        ldScoreAtPercentile = scipy.stats.scoreatpercentile(self._npaAbundance,dPercentileCutOff,axis=0)
 
         #Record how many entries for each feature have a value equal to or greater than the dPercentileCutOff
-        #If the percentile of entries passing the criteria are above the dPercentageAbovePercentile put index in list to keep
-        liKeepIndices = []
+        #If the percentile of entries passing the criteria are above the dPercentageAbovePercentile keep the feature
         iSampleCount = float(iSampleCount)
-        for iRowIndex, npaRow in enumerate(self._npaFeatureAbundance):
-            iCountPass = sum([1 if dValue >= ldScoreAtPercentile[iValueIndex] else 0 for iValueIndex, dValue in enumerate(list(npaRow)[1:])])
-            if (iCountPass / iSampleCount) >= dPercentageAbovePercentile:
-                liKeepIndices.append(iRowIndex)
+        lfKeepFeatures = (np.count_nonzero(self._npaAbundance >= ldScoreAtPercentile, axis=1) / iSampleCount) >= dPercentageAbovePercentile
 
         #Compress array
-        self._npaFeatureAbundance = self._npaFeatureAbundance[liKeepIndices,:]
+        self._funcKeepFeatures(lfKeepFeatures)
 
         #Update filter state
         self._strCurrentFilterState += ":dPercentileCutOff=" + str(dPercentileCutOff) + ",dPercentageAbovePercentile=" + str(dPercentageAbovePercentile)
@@ -1345,15 +1394,11 @@ class AbundanceTable:
             #sys.stderr.write( "Could not filter by sequence occurence because the data is already normalized.\n" )
             return False
 
-        #Holds which indexes are kept
-        liKeepFeatures = []
-        for iRowIndex, dataRow in enumerate( self._npaFeatureAbundance ):
-            #See which rows meet the criteria and keep the index if needed.
-            if len( list( filter( lambda d: d >= dMinAbundance, list(dataRow)[1:] ) ) ) >= iMinSamples:
-                liKeepFeatures.append(iRowIndex)
+        #See which rows meet the criteria
+        lfKeepFeatures = np.count_nonzero(self._npaAbundance >= dMinAbundance, axis=1) >= iMinSamples
 
         #Compress array
-        self._npaFeatureAbundance = self._npaFeatureAbundance[liKeepFeatures,:]
+        self._funcKeepFeatures(lfKeepFeatures)
         #Update filter state
         self._strCurrentFilterState += ":dMinAbundance=" + str(dMinAbundance) + ",iMinSamples=" + str(iMinSamples)
 
@@ -1381,15 +1426,11 @@ class AbundanceTable:
             #sys.stderr.write( "Could not filter by sequence occurence because the data is already normalized.\n" )
             return False
 
-        #Holds which indexes are kept
-        liKeepFeatures = []
-        for iRowIndex, dataRow in enumerate( self._npaFeatureAbundance ):
-            #See which rows meet the criteria and keep the index if needed.
-            if len( list( filter( lambda d: d >= iMinSequence, list(dataRow)[1:] ) ) ) >= iMinSamples:
-                liKeepFeatures.append(iRowIndex)
+        #See which rows meet the criteria
+        lfKeepFeatures = np.count_nonzero(self._npaAbundance >= iMinSequence, axis=1) >= iMinSamples
 
         #Compress array
-        self._npaFeatureAbundance = self._npaFeatureAbundance[liKeepFeatures,:]
+        self._funcKeepFeatures(lfKeepFeatures)
         #Update filter state
         self._strCurrentFilterState += ":iMinSequence=" + str(iMinSequence) + ",iMinSamples=" + str(iMinSamples)
 
@@ -1409,16 +1450,11 @@ class AbundanceTable:
         if(dMinSDCuttOff==0.0):
             return True
 
-        #Holds which indexes are kept
-        liKeepFeatures = []
+        #Evaluate each feature
+        lfKeepFeatures = np.std(self._npaAbundance, axis=1) >= dMinSDCuttOff
 
-        #Evaluate each sample
-        for iRowIndex, dataRow in enumerate(self._npaFeatureAbundance):
-            if(np.std(list(dataRow)[1:])>=dMinSDCuttOff):
-                liKeepFeatures.append(iRowIndex)
-        
         #Compress array
-        self._npaFeatureAbundance = self._npaFeatureAbundance[liKeepFeatures,:]
+        self._funcKeepFeatures(lfKeepFeatures)
 
         #Update filter state
         self._strCurrentFilterState += ":dMinSDCuttOff=" + str(dMinSDCuttOff)
@@ -1473,13 +1509,10 @@ class AbundanceTable:
             sys.stderr.write( "This table has clades summed, this normalization is not appropriate. Did not perform.\n" )
             return False
 
-        #Normalize
-        for columnName in self.funcGetSampleNames():
-            column = self._npaFeatureAbundance[columnName]
-            columnTotal = sum(column)
-            if(columnTotal > 0.0):
-                column = column/columnTotal
-            self._npaFeatureAbundance[columnName] = column
+        #Normalize, columns not summing above 0 are left as they are
+        adColumnTotals = self._npaAbundance.sum(axis=0)
+        adColumnTotals[adColumnTotals <= 0.0] = 1.0
+        self._npaAbundance = (self._npaAbundance / adColumnTotals).astype(self._npaAbundance.dtype)
 
         #Indicate normalization has occured
         self._fIsNormalized = True
@@ -1505,51 +1538,29 @@ class AbundanceTable:
             sys.stderr.write( "This table does not have clades summed, this normalization is not appropriate until the clades are summed. The clades are being summed now before normalization.\n" )
             self.funcSumClades()
 
-        #Load a hash table with root data {sKey: npaAbundances}
+        #Load a hash table with the row of the root data {sKey: [name length, row index]}
+        #(the first row with the shortest name of each root)
         hashRoots = {}
-        for npaRow in self._npaFeatureAbundance:
+        lsRoots = []
+        for iRowIndex, sFeature in enumerate(self._npaFeatureIDs.tolist()):
 
-            curldAbundance = np.array(list(npaRow)[1:])
-            curFeatureNameLength = len(npaRow[0].split(self._cFeatureDelimiter))
-            curlRootData = hashRoots.get(npaRow[0].split(self._cFeatureDelimiter)[0])
+            lsClades = sFeature.split(self._cFeatureDelimiter)
+            lsRoots.append(lsClades[0])
+            curlRootData = hashRoots.get(lsClades[0])
 
-            if not curlRootData:
-                hashRoots[npaRow[0].split(self._cFeatureDelimiter)[0]] = [curFeatureNameLength, curldAbundance]
-            elif curlRootData[0] > curFeatureNameLength:
-                hashRoots[npaRow[0].split(self._cFeatureDelimiter)[0]] = [curFeatureNameLength, curldAbundance]
+            if not curlRootData or curlRootData[0] > len(lsClades):
+                hashRoots[lsClades[0]] = [len(lsClades), iRowIndex]
 
         #Normalize each feature by thier root feature
-        dataMatrix = list()
-        for npaRow in self._npaFeatureAbundance:
-
-            curHashRoot = list(hashRoots[npaRow[0].split(self._cFeatureDelimiter)[0]][1])
-            dataMatrix.append(tuple([npaRow[0]]+[npaRow[i+1]/curHashRoot[i] if curHashRoot[i] > 0 else 0 for i in range(len(curHashRoot))]))
-
-        self._npaFeatureAbundance = np.array(dataMatrix,self._npaFeatureAbundance.dtype)
+        npaRoots = self._npaAbundance[[hashRoots[sRoot][1] for sRoot in lsRoots]].reshape(self._npaAbundance.shape)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self._npaAbundance = np.where(npaRoots > 0, self._npaAbundance / npaRoots, 0).astype(self._npaAbundance.dtype)
 
         #Indicate normalization has occured
         self._fIsNormalized = True
 
         return True
     
-    def _funcRankAbundanceHelper( self, aaTodo, iRank, lRankAbundance ):
-        """
-        Helper method for ranking abudance which are tied.
-
-        :params aaTodo: List of tied ranks to change to a rank.
-        :type:    List of Enumerates of samples.
-        :params iRank: Current Rank
-        :type:    Integer
-        :params lRankAbundance: Sample of abundance
-        :type:    List of integers
-        """
-
-        # Subtract one from iRank (each time) to account for next loop iteration
-        # Then average it with itself minus (the length of aaTodo + 1)
-        dRank = ( iRank + iRank - len( aaTodo ) - 1 ) / 2.0
-        for a in aaTodo:
-            lRankAbundance[a[0]] = dRank
-
     #1 Happy path test
     def funcRankAbundance(self):
         """
@@ -1559,30 +1570,14 @@ class AbundanceTable:
                               None is returned on error.
         """
 
-        if self._npaFeatureAbundance == None:
+        if self._npaAbundance is None:
             return None
 
-        lsSampleNames = self.funcGetSampleNames()
-        npRankAbundance = self.funcGetAbundanceCopy()
-        liRanks = []
-        #For each sample name get the ranks
-        for sName in lsSampleNames:
-            #Enumerate for order and sort abundances
-            lfSample = list(enumerate(npRankAbundance[sName]))
-            lfSample = sorted(lfSample, key = lambda a: a[1], reverse = True)
-
-            # Accumulate indices until a new value is encountered to detect + handle ties
-            aaTodo = []
-            for i, a in enumerate( lfSample ):
-                if ( not aaTodo ) or ( a[1] == aaTodo[-1][1] ):
-                    aaTodo.append( a )
-                else:
-            # Make multiple tied ranks = average of first and last
-                    self._funcRankAbundanceHelper( aaTodo, i, npRankAbundance[sName] )
-                    aaTodo = [a]
-            self._funcRankAbundanceHelper( aaTodo, i + 1, npRankAbundance[sName] )
+        #Rank each sample (column) from the largest abundance (rank 0)
+        #Tied ranks are the average of the first and last
+        npRankAbundance = (scipy.stats.rankdata(-self._npaAbundance, method="average", axis=0) - 1).astype(self._npaAbundance.dtype)
 
-        abndRanked = AbundanceTable(npaAbundance=npRankAbundance, dictMetadata=self.funcGetMetadataCopy(),
+        abndRanked = AbundanceTable(npaAbundance=self._funcMakeStructuredArray(npaAbundance=npRankAbundance), dictMetadata=self.funcGetMetadataCopy(),
             strName= self.funcGetName() + "-Ranked",
             strLastMetadata=self.funcGetLastMetadataName(),
             cFileDelimiter=self.funcGetFileDelimiter(),
@@ -1609,12 +1604,11 @@ class AbundanceTable:
         """
 
         if iCladeLevel < 1: return False
-        if not self._npaFeatureAbundance == None:
-            liFeatureKeep = []
-            [liFeatureKeep.append(tplFeature[0]) if (len(tplFeature[1][0].split(self.funcGetFeatureDelimiter())) <= iCladeLevel) else 0
-             for tplFeature in enumerate(self._npaFeatureAbundance)]
+        if not self._npaFeatureIDs is None:
+            lfFeatureKeep = np.array([len(sFeature.split(self.funcGetFeatureDelimiter())) <= iCladeLevel
+             for sFeature in self._npaFeatureIDs.tolist()], dtype=bool)
             #Compress array
-            self._npaFeatureAbundance = self._npaFeatureAbundance[liFeatureKeep,:]
+            self._funcKeepFeatures(lfFeatureKeep)
 
             #Update filter state
             self._strCurrentFilterState += ":iCladeLevel=" + str(iCladeLevel)
@@ -1644,7 +1638,8 @@ class AbundanceTable:
         lfKeepSamples = [not sSample in setSamples for sSample in self.funcGetSampleNames()]
         
         #Reduce the abundance data and update
-        self._npaFeatureAbundance = self._npaFeatureAbundance[[self.funcGetIDMetadataName()]+lsKeepSamples]
+        self._npaAbundance = self._npaAbundance[:,np.array(lfKeepSamples, dtype=bool)]
+        self._lsSampleNames = lsKeepSamples
 
         #Reduce the metadata and update
         for sKey in self._dictTableMetadata:
@@ -1682,62 +1677,98 @@ class AbundanceTable:
 
         if not self.funcIsSummed():
 
-            #Read in the data
-            #Find the header column (iCol) assumed to be 1 or 2 depending on the location of "NAME"
-            #Create a list (adSeq) that will eventually hold the sum of the columns of data
-            astrHeaders = iCol = None
-            adSeqs = np.array([0] * len(self.funcGetSampleNames()))
-            pTree = CClade( )
-            aastrRaw = []
-
-            #For each row in the npaAbundance
-            #Get the feature name, feature abundances, and sum up the abudance columns
-            #Keep the sum for later normalization
-            #Give a tree the feature name and abundance
-            for dataRow in self._npaFeatureAbundance:
-                
-                sFeatureName = dataRow[0]
-                ldAbundances = list(dataRow)[1:]
-
-                #Add to the sum of the columns (samples)
-                adSeqs = adSeqs + np.array(list(dataRow)[1:])
-
-                #Build tree
-                pTree.get( sFeatureName.split(self._cFeatureDelimiter) ).set( ldAbundances )
-
-            #Create tree of data
-            #Input missing data
-            #Fill hashFeatures with the clade name (key) and a blist of values (value) of the specified level interested.
-            pTree.impute( )
-            hashFeatures = {}
-            pTree.freeze( hashFeatures, c_iSumAllCladeLevels, c_fOutputLeavesOnly )
-            setstrFeatures = list(hashFeatures.keys( ))
-
-            #Remove parent clades that are identical to child clades
-            for strFeature, adCounts in hashFeatures.items( ):
-                    astrFeature = strFeature.strip( ).split( "|" )
-                    while len( astrFeature ) > 1:
-                        astrFeature = astrFeature[:-1]
-                        strParent = "|".join( astrFeature )
-                        adParent = hashFeatures.get( strParent )
-                        if adParent == adCounts:
-                            del hashFeatures[strParent]
-                            setstrFeatures.remove( strParent )
-
-            #Sort features to be nice
-            astrFeatures = sorted( setstrFeatures )
-
-            #Change the hash table to an array
-            dataMatrix = list()
-            for sFeature in astrFeatures:
-                dataMatrix.append(tuple([sFeature]+list(hashFeatures[sFeature])))
-            self._npaFeatureAbundance=np.array(dataMatrix,self._npaFeatureAbundance.dtype)
+            #Sum the clades of the consensus lineages
+            lsFeatures, npaCladeAbundance = AbundanceTable._funcSumCladeMatrix(self._npaFeatureIDs.tolist(), self._npaAbundance, self._cFeatureDelimiter)
+
+            #Replace the data with the clades
+            self._npaFeatureIDs = np.array(lsFeatures, dtype=self._npaFeatureIDs.dtype)
+            self._npaAbundance = npaCladeAbundance.astype(self._npaAbundance.dtype)
 
             #Indicate summation has occured
             self._fIsSummed = True
 
         return True
 
+    @staticmethod
+    def _funcSumCladeMatrix(lsFeatureNames, npaAbundance, cFeatureDelimiter):
+        """
+        Private method
+        Sums abundance data by the clades of the feature names (consensus lineages).
+        A clade which is a feature keeps its abundance, the others get the sum of their child clades.
+        Clades below a feature are only kept if they are features, and clades with the same abundance as
+        one of their descendants are left out.
+
+        :param    lsFeatureNames:    Feature names in the order of the rows of npaAbundance
+        :type:    List of strings
+        :param    npaAbundance:    Measurements (Row=Features, Columns=Samples)
+        :type:    2-D Numpy array
+        :param    cFeatureDelimiter:    Delimiter of the clades in the feature names
+        :type:    Character
+        :return    [Clades, Abundance]:    Sorted clade names ("|" delimited) and their float abundance (Row=Clades, Columns=Samples)
+        """
+
+        #Lineage index: an id for each clade in the order they are found, with the id of its parent (-1 for roots)
+        #and its depth, and the clade of each feature
+        dictCladeIds = {}
+        liParent, liDepth, liFeatureClade = [], [], []
+        for sFeatureName in lsFeatureNames:
+            sClade, iClade = None, -1
+            for iDepth, sName in enumerate(sFeatureName.split(cFeatureDelimiter)):
+                sClade = sName if sClade is None else "|".join([sClade,sName])
+                iParent, iClade = iClade, dictCladeIds.get(sClade)
+                if iClade is None:
+                    iClade = dictCladeIds[sClade] = len(liParent)
+                    liParent.append(iParent)
+                    liDepth.append(iDepth)
+            liFeatureClade.append(iClade)
+        lsClades = list(dictCladeIds.keys())
+        npaParent, npaDepth = np.array(liParent, dtype=int), np.array(liDepth, dtype=int)
+
+        #The clades given as features take their abundance (the last one if given more than once)
+        npaFeatureClade = np.array(liFeatureClade, dtype=int)
+        liLast = len(npaFeatureClade) - 1 - np.unique(npaFeatureClade[::-1], return_index=True)[1]
+        npaSums = np.zeros((len(lsClades), npaAbundance.shape[1]))
+        npaSums[npaFeatureClade[liLast]] = npaAbundance[liLast]
+        lfGiven = np.zeros(len(lsClades), dtype=bool)
+        lfGiven[npaFeatureClade[liLast]] = True
+
+        #Clades which are not features only get an abundance if none of their ancestors is a feature
+        lfUnderGiven = np.zeros(len(lsClades), dtype=bool)
+        for iDepth in range(1, npaDepth.max(initial=0)+1):
+            liChildren = np.flatnonzero(npaDepth == iDepth)
+            lfUnderGiven[liChildren] = lfGiven[npaParent[liChildren]] | lfUnderGiven[npaParent[liChildren]]
+        lfKeep = lfGiven | ~lfUnderGiven
+
+        #From the deepest level up, segment sums of the child clades (in the order found)
+        #into their parents which are not features
+        for iDepth in range(npaDepth.max(initial=0), 0, -1):
+            liChildren = np.flatnonzero(npaDepth == iDepth)
+            liChildren = liChildren[~lfGiven[npaParent[liChildren]]]
+            if not len(liChildren):
+                continue
+            liChildren = liChildren[np.argsort(npaParent[liChildren], kind="stable")]
+            liParents, liStarts = np.unique(npaParent[liChildren], return_index=True)
+            npaSums[liParents] = np.add.reduceat(npaSums[liChildren], liStarts, axis=0)
+
+        #Remove parent clades that are identical to a descendant clade
+        #Clades are grouped by a hash of their abundance, only the ancestors in the same group are compared
+        npaSums += 0.0
+        dictGroups = {}
+        npaGroup = np.full(len(lsClades), -1, dtype=int)
+        npaGroup[lfKeep] = [dictGroups.setdefault(npaRow.tobytes(), len(dictGroups)) for npaRow in npaSums[lfKeep]]
+        liDescendants = np.flatnonzero(lfKeep)
+        liDescendants = liDescendants[np.bincount(npaGroup[liDescendants], minlength=1)[npaGroup[liDescendants]] > 1]
+        liAncestors = npaParent[liDescendants]
+        while len(liDescendants):
+            lfHasAncestor = liAncestors >= 0
+            liDescendants, liAncestors = liDescendants[lfHasAncestor], liAncestors[lfHasAncestor]
+            lfKeep[liAncestors[npaGroup[liAncestors] == npaGroup[liDescendants]]] = False
+            liAncestors = npaParent[liAncestors]
+
+        #Sort features to be nice
+        liOrder = sorted(np.flatnonzero(lfKeep).tolist(), key=lambda iClade: lsClades[iClade])
+        return [lsClades[iClade] for iClade in liOrder], npaSums[liOrder].reshape(len(liOrder), npaAbundance.shape[1])
+
     #Happy path tested
     def funcStratifyByMetadata(self, strMetadata, fWriteToFile=False):
         """
@@ -1756,7 +1787,7 @@ class AbundanceTable:
                         Empty list on error.
         """
 
-        if self._npaFeatureAbundance is None or self._dictTableMetadata is None:
+        if self._npaAbundance is None or self._dictTableMetadata is None:
             return []
 
         #Get unique metadata values to stratify by
@@ -1774,8 +1805,8 @@ class AbundanceTable:
         for value in setValues:
             lfDataIndex = [sData==value for sData in lsMetadata]
             #Get abundance data for the metadata value
-            #The true is added to keep the first column which should be the feature id
-            npaStratfiedAbundance = self._npaFeatureAbundance[[self.funcGetIDMetadataName()]+list(np.compress(lfDataIndex,lsNames))]
+            npaStratfiedAbundance = self._funcMakeStructuredArray(npaAbundance=self._npaAbundance[:,np.array(lfDataIndex, dtype=bool)],
+                lsSampleNames=list(np.compress(lfDataIndex,lsNames)))
 
             #Get metadata for the metadata value
             dictStratifiedMetadata = dict()
@@ -1852,8 +1883,8 @@ class AbundanceTable:
                                 None is returned on error.
         """
 
-        if not self._npaFeatureAbundance == None:
-            return np.array([list(tplRow)[1:] for tplRow in self._npaFeatureAbundance],'float')
+        if not self._npaAbundance is None:
+            return np.array(self._npaAbundance,'float')
         return None
 
     #Happy Path tested
@@ -1913,16 +1944,14 @@ class AbundanceTable:
 
         #Write abundance
         lsOutput = list()
-        curAbundance = self._npaFeatureAbundance.tolist()
-
-        for curAbundanceRow in curAbundance:
+        for curAbundanceRow in zip(self._npaFeatureIDs.tolist(), self._npaAbundance.tolist()):
             # Make feature metadata, padding with NA as needed
             lsMetadata = []
             for sMetadataId in lsRowMetadataIDKeys:
                 lsMetadata = lsMetadata + self.rwmtRowMetadata.funGetFeatureMetadata( curAbundanceRow[0], sMetadataId )
                 lsMetadata = lsMetadata + ( [ ConstantsBreadCrumbs.c_strEmptyDataMetadata ] * 
                     ( self.rwmtRowMetadata.dictMetadataIDs.get( sMetadataId, 0 ) - len( lsMetadata ) ) )
-            f.writerows([[curAbundanceRow[0]]+lsMetadata+[str(curAbundanceElement) for curAbundanceElement in curAbundanceRow[1:]]])
+            f.writerows([[curAbundanceRow[0]]+lsMetadata+[str(curAbundanceElement) for curAbundanceElement in curAbundanceRow[1]]])
         return
 
     def _funcWriteBiomFile(self, xOutputFile):
@@ -1982,18 +2011,7 @@ class AbundanceTable:
         # Data                    *
         #**************************
         
-        lData = list()
-        lAbundanceCopyResultArray = self.funcGetAbundanceCopy()
-
-        for r in lAbundanceCopyResultArray:
-            lr = list(r)
-            lr.pop(0)    #Remove metadata
-            lAbundanceValues = list()
-            for AbundanceEntry in lr:
-                flAbundanceEntry = float(AbundanceEntry)
-                lAbundanceValues.append(flAbundanceEntry)
-            lData.append(lAbundanceValues)
-        arrData = array(lData)  #Convert list to array
+        arrData = self.funcToArray()
 
         
 
@@ -2252,55 +2270,49 @@ class AbundanceTable:
             return BiomCommonArea
  
         BiomCommonArea = dict()        
-        dBugNames = list()            #Bug Names Table
         dRowsMetadata = None        #Initialize the np.array of the Rows metadata
-        BiomElements  =  json.loads(BiomTable.to_json(''))
-        for BiomKey, BiomValue in BiomElements.items():
+
         #****************************************************
-        #*     Checking the different keys:  format,        *
-        #*     rows, columns, date, generated_by            *
+        #*  The file info, ids and metadata are read from   *
+        #*  the Table object (same values as its to_json)   *
         #****************************************************
-            if (BiomKey == ConstantsBreadCrumbs.c_strFormatKey  
-            or BiomKey == ConstantsBreadCrumbs.c_strFormatUrl  
-            or BiomKey == ConstantsBreadCrumbs.c_MatrixTtype
-            or BiomKey == ConstantsBreadCrumbs.c_strTypekey
-            or BiomKey == ConstantsBreadCrumbs.c_strIDKey #Same as below
-            or BiomKey == ConstantsBreadCrumbs.c_GeneratedBy  #<---Need to follow up with Biom as always BiomValue = "" even though in the file has a value
-            or BiomKey == ConstantsBreadCrumbs.c_strDateKey):  #Same as above
-                BiomCommonArea = AbundanceTable._funcInsertKeyToCommonArea(BiomCommonArea, BiomKey, BiomValue)
-
-
-            if BiomKey == ConstantsBreadCrumbs.c_rows:
-                iMaxIdLen = 0 
-                for iIndexRowMetaData in range(0, len(BiomValue)):
-                    if ConstantsBreadCrumbs.c_id_lowercase in BiomValue[iIndexRowMetaData]:
-                        sBugName = BiomValue[iIndexRowMetaData][ConstantsBreadCrumbs.c_id_lowercase]
-                        dBugNames.append(sBugName)      #Post to the bug table
-                        if len(sBugName) > iMaxIdLen:    #We  are calculating dynamically the length of the ID
-                            iMaxIdLen  =  len(sBugName)
-        
-                if ConstantsBreadCrumbs.c_metadata_lowercase in BiomValue[0] and BiomValue[0][ConstantsBreadCrumbs.c_metadata_lowercase] != None :
-                     dRowsMetadata = AbundanceTable._funcBiomBuildRowMetadata(BiomValue,  iMaxIdLen )
+        for BiomKey, BiomValue in [(ConstantsBreadCrumbs.c_strIDKey, str(BiomTable.table_id)),
+                                   (ConstantsBreadCrumbs.c_strFormatKey, get_biom_format_version_string((1, 0))),
+                                   (ConstantsBreadCrumbs.c_strFormatUrl, get_biom_format_url_string()),
+                                   (ConstantsBreadCrumbs.c_MatrixTtype, "sparse"),
+                                   (ConstantsBreadCrumbs.c_GeneratedBy, ""),
+                                   (ConstantsBreadCrumbs.c_strDateKey, datetime.now().isoformat()),
+                                   (ConstantsBreadCrumbs.c_strTypekey, str(BiomTable.type))]:
+            BiomCommonArea = AbundanceTable._funcInsertKeyToCommonArea(BiomCommonArea, BiomKey, BiomValue)
+
+        dBugNames = [str(sBugName) for sBugName in BiomTable.ids(axis='observation')]      #Bug Names Table
+        iMaxIdLen = max([len(sBugName) for sBugName in dBugNames] + [0])    #We  are calculating dynamically the length of the ID
+        lRowsMetadata = BiomTable.metadata(axis='observation')
+        if lRowsMetadata is not None and len(lRowsMetadata) > 0 and lRowsMetadata[0] is not None:
+            dRowsMetadata = AbundanceTable._funcBiomBuildRowMetadata([{ConstantsBreadCrumbs.c_id_lowercase: sBugName, ConstantsBreadCrumbs.c_metadata_lowercase: dMetadata}
+                for sBugName, dMetadata in zip(dBugNames, lRowsMetadata)], iMaxIdLen)
+
+        lSampleIDs = [str(sSampleID) for sSampleID in BiomTable.ids(axis='sample')]
+        lColumnsMetadata = BiomTable.metadata(axis='sample')
+        if lColumnsMetadata is None: lColumnsMetadata = [None] * len(lSampleIDs)
+        BiomCommonArea = AbundanceTable._funcDecodeBiomMetadata(BiomCommonArea,
+            [{ConstantsBreadCrumbs.c_id_lowercase: sSampleID, ConstantsBreadCrumbs.c_metadata_lowercase: dMetadata}
+                for sSampleID, dMetadata in zip(lSampleIDs, lColumnsMetadata)], iMaxIdLen)    #Call the subroutine to Build the metadata
 
- 
-            if BiomKey == ConstantsBreadCrumbs.c_columns:
-                BiomCommonArea = AbundanceTable._funcDecodeBiomMetadata(BiomCommonArea, BiomValue, iMaxIdLen)    #Call the subroutine to Build the metadata
- 
-     
         #*******************************************
         #* Build the TaxData                       *
+        #* One column (sample) at a time from the  *
+        #* table's sparse matrix                   *
         #*******************************************
-    
-        BiomTaxDataWork = list()            #Initlialize TaxData
-        BiomObservations = BiomTable.iter(axis='observation')        #Invoke biom method to fetch data from the biom file
-        for BiomObservationData in BiomObservations:
-            sBugName = BiomObservationData[1]
-            BiomTaxDataEntry = [sBugName]
-            BiomObservationsValues = BiomObservationData[0]
-            BiomTaxDataEntry.extend(BiomObservationsValues.tolist())
-            BiomTaxDataWork.append(tuple(BiomTaxDataEntry))    
-    
-        BiomCommonArea[ConstantsBreadCrumbs.c_BiomTaxData] = np.array(BiomTaxDataWork,dtype=np.dtype(BiomCommonArea[ConstantsBreadCrumbs.c_Dtype]))
+
+        npaTaxData = np.zeros(len(dBugNames), dtype=np.dtype(BiomCommonArea[ConstantsBreadCrumbs.c_Dtype]))
+        npaTaxData[ConstantsBreadCrumbs.c_ID] = dBugNames
+        BiomMatrix = BiomTable.matrix_data.tocsc()
+        for iSample, sSampleID in enumerate(BiomCommonArea[ConstantsBreadCrumbs.c_Metadata][ConstantsBreadCrumbs.c_ID]):
+            iStart, iEnd = BiomMatrix.indptr[iSample], BiomMatrix.indptr[iSample+1]
+            npaTaxData[sSampleID][BiomMatrix.indices[iStart:iEnd]] = BiomMatrix.data[iStart:iEnd]
+
+        BiomCommonArea[ConstantsBreadCrumbs.c_BiomTaxData] = npaTaxData
         BiomCommonArea[ConstantsBreadCrumbs.c_dRowsMetadata] = RowMetadata(dRowsMetadata)
         del(BiomCommonArea[ConstantsBreadCrumbs.c_Dtype])            #Not needed anymore
  
@@ -3,7 +3,7 @@ from setuptools.command.install import install
 from io import open
 import os
 
-install_requires = ["numpy", "matplotlib", "biom-format", "rpy2"]
+install_requires = ["numpy", "scipy", "matplotlib", "biom-format", "rpy2"]
 setuptools.setup(
     name='lefse',
     version='1.1.2',
@@ -20,6 +20,7 @@ setuptools.setup(
             'lefse_plot_features.py = lefse.lefse_plot_features:plot_features',
             'lefse_plot_res.py = lefse.lefse_plot_res:plot_res',
             'lefse_run.py  = lefse.lefse_run:lefse_run',
+            'lefse_refilter.py = lefse.lefse_refilter:lefse_refilter',
             'lefse2circlader.py = lefse.lefse2circlader:lefse2circlader',
             'qiime2lefse.py = lefse.qiime2lefse:qiime2lefse'
         ]
@@ -1,11 +1,97 @@
 import streamlit as st
-import subprocess, os, sys
+import os, glob, json, shutil, tempfile, time
 import pandas as pd
 from extract_significant_features import extract_significant_features
+from lefse import pipeline
 
 st.set_page_config(page_title="LEfSe WebApp", layout="wide")
 st.title("🔬 LEfSe Analysis Web")
 
+# === 統計後端：LEFSE_STAT_BACKEND=native 以 NumPy/SciPy 執行檢定與 LDA，不需安裝 R ===
+native_backend = os.environ.get("LEFSE_STAT_BACKEND", "r") == "native"
+
+# === 工作佇列：多位使用者同時分析，每個 worker process 各自載入 R 與記憶體快取，並透過快取目錄共用結果 ===
+@st.cache_resource
+def job_queue():
+    return pipeline.JobQueue(int(os.environ.get("LEFSE_WORKERS", "2")),
+                             int(os.environ.get("LEFSE_MAX_JOBS", "8")),
+                             int(os.environ.get("LEFSE_CACHE_MB", "512"))*2**20,
+                             load_r=not native_backend,
+                             keep=float(os.environ.get("LEFSE_KEEP_HOURS", "24"))*3600,
+                             cache_dir=os.environ.get("LEFSE_CACHE_DIR") or None)
+
+# === 顯示分析結果 ===
+def show_results(out, workdir, lda_th):
+    result_res = out["result"]
+
+    # Step 3️⃣: extract features.csv
+    df = pd.read_csv(result_res, sep="\t", header=None)
+    if df.shape[1] == 5:
+        df.columns = ["feature", "LDA", "_", "class", "pvalue"]
+    else:
+        df.columns = ["feature", "LDA", "pvalue"]
+    df_feat = df[df["LDA"].abs() >= lda_th][["feature", "LDA", "pvalue"]]
+    features_csv = os.path.join(workdir, "features.csv")
+    df_feat.to_csv(features_csv, index=False)
+
+    # Step 4️⃣: barplot, the Vega-Lite spec drawn by the browser and its PNG copy to download
+    st.text("✅ barplot completed")
+    if "barplot" in out:
+        with open(out["barplot"]) as f:
+            st.vega_lite_chart(json.load(f), use_container_width=True)
+    if "barplot_png" in out:
+        with open(out["barplot_png"], "rb") as f:
+            st.download_button("📥 Download barplot.png", f, "barplot.png", key="dl_bar")
+
+    # Step 5️⃣: cladogram
+    if "cladogram" in out:
+        st.image(out["cladogram"], caption="Cladogram", use_container_width=True)
+        with open(out["cladogram"], "rb") as f:
+            st.download_button("📥 Download cladogram.png", f, "cladogram.png", key="dl_clad")
+    else:
+        st.warning("⚠️ Cladogram image not found")
+
+    # Step 6️⃣: extract significant features by class
+    sigfeat_csv = os.path.join(workdir, "significant_features_by_class.csv")
+    extract_significant_features(result_res, sigfeat_csv)
+    if os.path.exists(sigfeat_csv):
+        with open(sigfeat_csv, "rb") as f:
+            st.download_button("📥 Download significant features", f, "significant_features_by_class.csv", key="dl_sig")
+
+    st.success("✅ LEfSe Analysis Complete!")
+
+# === 背景分析：job id 記在網址 (?job=...)，重新整理頁面後仍可查詢進度與結果 ===
+stage_names = {"format": "Format input", "kw": "Kruskal-Wallis", "wilcoxon": "Wilcoxon",
+               "bootstrap": "LDA bootstrap", "plots": "Plots"}
+
+@st.fragment(run_every=1)
+def show_progress(job_id):
+    status = job_queue().status(job_id)
+    if status["state"] not in ("queued", "running"):
+        st.rerun()
+    if status["state"] == "queued":
+        st.info("⏳ 等待中…")
+    for stage, (done, total) in status["progress"].items():
+        label = f"{stage_names.get(stage, stage)}: {done}" + (f"/{total}" if total else "")
+        st.progress(min(done / total, 1.0) if total else 0.0, text=label)
+
+job_id = st.query_params.get("job")
+if job_id:
+    status = job_queue().status(job_id)
+    if status["state"] in ("queued", "running"):
+        st.subheader("🔄 LEfSe 分析中…")
+        show_progress(job_id)
+    elif status["state"] == "failed":
+        st.error(f"❌ {status['error']}")
+    elif status["state"] == "unknown":
+        st.warning("⚠️ 找不到此分析（可能已過期），請重新上傳資料")
+    else:
+        show_results(status["result"], status["args"][1], status["kw"]["run_kw"]["lda_abs_th"])
+    if st.button("New analysis"):
+        del st.query_params["job"]
+        st.rerun()
+    st.stop()
+
 # === 上傳資料 ===
 uploaded = st.file_uploader("Upload feature table (.tsv)", type="tsv")
 if not uploaded:
@@ -20,6 +106,8 @@ with col1:
 with col2:
     lda_th     = st.slider("LDA threshold", 0.0, 10.0, 2.0, 0.1)
     run_wilcox = st.checkbox("Run Wilcoxon test", value=True)
+    anova_alpha    = st.number_input("Kruskal-Wallis alpha", min_value=0.0, max_value=1.0, value=0.05, step=0.01, format="%.3f")
+    wilcoxon_alpha = st.number_input("Wilcoxon alpha", min_value=0.0, max_value=1.0, value=0.05, step=0.01, format="%.3f")
 
 
 
@@ -60,102 +148,43 @@ for cls in class_names:
 # === 整理為 --colors 字串格式 ===
 class_colors_str = ",".join(st.session_state.class_colors_map[c] for c in class_names)
 
+# === 每次分析使用獨立的暫存目錄，超過 LEFSE_KEEP_HOURS 的舊目錄會被刪除 ===
+base_dir = os.environ.get("LEFSE_WORK_DIR", "tmp_lefse_run")
+
+def remove_old_runs(base_dir, max_age):
+    now = time.time()
+    for d in glob.glob(os.path.join(base_dir, "run_*")):
+        if now - os.path.getmtime(d) > max_age:
+            shutil.rmtree(d, ignore_errors=True)
+
 # === 點選分析 ===
 if st.button("Run LEfSe"):
-    workdir = "tmp_lefse_run"
-    os.makedirs(workdir, exist_ok=True)
+    os.makedirs(base_dir, exist_ok=True)
+    remove_old_runs(base_dir, float(os.environ.get("LEFSE_KEEP_HOURS", "24"))*3600)
+    workdir = tempfile.mkdtemp(prefix="run_", dir=base_dir)
     in_tsv = os.path.join(workdir, "input.tsv")
     with open(in_tsv, "wb") as f:
         f.write(uploaded.getbuffer())
 
-    # Step 1️⃣: format input
-    in_for_lefse = os.path.join(workdir, "input.in.for_lefse")
-    cmd_fmt = [
-        sys.executable, "-m", "lefse.lefse_format_input",
-        in_tsv, in_for_lefse, "-c", str(class_row), "-o", "1000000"
-    ]
-    if subclass_row: cmd_fmt += ["-s", str(subclass_row)]
-    if subject_row:  cmd_fmt += ["-u", str(subject_row)]
-    fmt = subprocess.run(cmd_fmt, capture_output=True, text=True)
-    if fmt.returncode != 0:
-        st.error(f"❌ Format input failed:\n{fmt.stderr}")
-        st.stop()
-
-    # Step 2️⃣: run LEfSe
-    result_res = os.path.join(workdir, "result.res")
-    cmd_lefse = [
-        sys.executable, "-m", "lefse.lefse_run",
-        in_for_lefse, result_res, "-l", str(lda_th)
-    ]
-    if not run_wilcox:
-        cmd_lefse += ["--wilc", "0"]
-    lef = subprocess.run(cmd_lefse, capture_output=True, text=True)
-    if lef.returncode != 0:
-        st.error(f"❌ LEfSe failed:\n{lef.stderr}")
-        st.stop()
-
-    # Step 3️⃣: extract features.csv
-    df = pd.read_csv(result_res, sep="\t", header=None)
-    if df.shape[1] == 5:
-        df.columns = ["feature", "LDA", "_", "class", "pvalue"]
-    else:
-        df.columns = ["feature", "LDA", "pvalue"]
-    df_feat = df[df["LDA"].abs() >= lda_th][["feature", "LDA", "pvalue"]]
-    features_csv = os.path.join(workdir, "features.csv")
-    df_feat.to_csv(features_csv, index=False)
-
-    # Step 4️⃣: barplot
-    bar_png = os.path.join(workdir, "barplot.png")
-    cmd_bar = [
-        sys.executable, "-m", "lefse.lefse_plot_res",
-        result_res, bar_png,
-        "--dpi", "300",
-        "--format", "png",
-        "--colors", class_colors_str,
-        "--title", "",                  # ✅ 必加
-        "--feature_font_size", "8",     # ✅ 依需求調整
-        "--class_legend_font_size", "10",
-        "--background_color", "w"  # ✅ 這一行是關鍵
-    ]
-
-
-    bar = subprocess.run(cmd_bar, capture_output=True, text=True)
-    if bar.returncode != 0:
-        st.error("❌ Barplot generation failed")
-        st.text(bar.stderr)
+    # Step 1️⃣-2️⃣, 4️⃣-5️⃣: format input, run LEfSe, barplot, cladogram
+    try:
+        job_id = job_queue().submit(pipeline.analyse, in_tsv, workdir,
+            format_kw={"class": class_row, "subclass": subclass_row, "subject": subject_row, "norm_v": 1000000.0, "output_format": "mmap"},
+            run_kw={"lda_abs_th": lda_th, "wilc": int(run_wilcox),
+                    "anova_alpha": anova_alpha, "wilcoxon_alpha": wilcoxon_alpha,
+                    "stat_backend": "native" if native_backend else "r",
+                    "rank_tec": "lda_native" if native_backend else "lda"},
+            plot_res_kw={"dpi": 300,
+                         "format": "json",
+                         "colors": class_colors_str,
+                         "title": "",                    # ✅ 必加
+                         "feature_font_size": 8,         # ✅ 依需求調整
+                         "class_legend_font_size": 10,
+                         "background_color": "w"},       # ✅ 這一行是關鍵
+            cladogram_kw={"dpi": 300, "format": "png", "colors": class_colors_str},
+            barplot_png=True)
+    except pipeline.QueueFull:
+        st.error("❌ 伺服器忙碌中，請稍後再試")
         st.stop()
-    else:
-        st.text("✅ barplot subprocess completed")
-        st.text(bar.stdout)
-    if os.path.exists(bar_png):
-        st.image(bar_png, caption="LDA Barplot", use_container_width=True)
-        with open(bar_png, "rb") as f:
-            st.download_button("📥 Download barplot.png", f, "barplot.png", key="dl_bar")
-
-    # Step 5️⃣: cladogram
-    clad_png = os.path.join(workdir, "cladogram.png")
-    cmd_clad = [
-        sys.executable,
-        "lefse/lefse_plot_cladogram.py",
-        result_res,
-        clad_png,
-        "--dpi", "300",
-        "--format", "png",
-        "--colors", class_colors_str
-    ]
-    clad = subprocess.run(cmd_clad, capture_output=True, text=True)
-    if os.path.exists(clad_png):
-        st.image(clad_png, caption="Cladogram", use_container_width=True)
-        with open(clad_png, "rb") as f:
-            st.download_button("📥 Download cladogram.png", f, "cladogram.png", key="dl_clad")
-    else:
-        st.warning("⚠️ Cladogram image not found")
-
-    # Step 6️⃣: extract significant features by class
-    sigfeat_csv = os.path.join(workdir, "significant_features_by_class.csv")
-    extract_significant_features(result_res, sigfeat_csv)
-    if os.path.exists(sigfeat_csv):
-        with open(sigfeat_csv, "rb") as f:
-            st.download_button("📥 Download significant features", f, "significant_features_by_class.csv", key="dl_sig")
-
-    st.success("✅ LEfSe Analysis Complete!")
\ No newline at end of file
+    st.query_params["job"] = job_id
+    st.rerun()
@@ -0,0 +1,101 @@
+# AbundanceTable on its 2-D matrix: clade summation (funcSumClades and
+# _funcSumCladeMatrix) on small taxonomies and the feature filters, which
+# keep the feature IDs and the rows together, against per-row loops.
+
+import statistics
+import numpy
+import pytest
+pytest.importorskip('biom')
+from lefsebiom.AbundanceTable import AbundanceTable
+
+SAMPLES = ["S1","S2","S3"]
+
+def table(rows, samples = SAMPLES):
+    npa = numpy.array([tuple([k]+list(v)) for k,v in rows], dtype=[("ID","U64")]+[(s,"f8") for s in samples])
+    return AbundanceTable(npa, {"ID": list(samples), "Group": ["g%d" % (i % 2) for i in range(len(samples))]}, "ID", "Group")
+
+def contents(abnd):
+    return [(k, list(abnd.funcGetFeature(k))) for k in abnd.funcGetFeatureNames().tolist()]
+
+LEAVES = [("k__A|p__B|c__C", [1,2,3]),
+          ("k__A|p__B|c__D", [4,0,1]),
+          ("k__A|p__E|c__F", [2,2,2]),
+          ("k__G|p__H", [5,1,0])]
+
+def test_sum_clades():
+    abnd = table(LEAVES)
+    assert not abnd.funcIsSummed()
+    assert abnd.funcSumClades()
+    assert abnd.funcIsSummed()
+    # k__A|p__E and k__G have the abundance of their only child
+    assert contents(abnd) == [("k__A", [7,4,6]),
+                              ("k__A|p__B", [5,2,4]),
+                              ("k__A|p__B|c__C", [1,2,3]),
+                              ("k__A|p__B|c__D", [4,0,1]),
+                              ("k__A|p__E|c__F", [2,2,2]),
+                              ("k__G|p__H", [5,1,0])]
+    npa = abnd.funcGetAbundanceCopy()
+    assert npa.dtype.names == ("ID",)+tuple(SAMPLES)
+    assert npa["S1"].tolist() == [7,5,1,4,2,5]
+
+def test_sum_clades_internal_features():
+    # a clade given as a feature keeps its abundance, and the clades below it
+    # are only kept if they are features
+    names, m = AbundanceTable._funcSumCladeMatrix(["k__A","k__A|p__B|c__C","k__A|p__D"], numpy.array([[10.0,10.0],[1.0,2.0],[3.0,0.0]]), "|")
+    assert names == ["k__A","k__A|p__B|c__C","k__A|p__D"]
+    assert m.tolist() == [[10.0,10.0],[1.0,2.0],[3.0,0.0]]
+    names, m = AbundanceTable._funcSumCladeMatrix(["k__A|p__B","k__A|p__B|c__C","k__A|p__E"], numpy.array([[1.0,1.0],[1.0,1.0],[0.5,0.0]]), "|")
+    assert names == ["k__A","k__A|p__B|c__C","k__A|p__E"]
+    assert m.tolist() == [[1.5,1.0],[1.0,1.0],[0.5,0.0]]
+
+def test_sum_clades_delimiter():
+    names, m = AbundanceTable._funcSumCladeMatrix(["a;b","a;c"], numpy.array([[1.0],[2.0]]), ";")
+    assert names == ["a","a|b","a|c"]
+    assert m.tolist() == [[3.0],[1.0],[2.0]]
+
+def random_rows(n = 30, seed = 1982):
+    rng = numpy.random.RandomState(seed)
+    names = ["k__%d|p__%d|c__%d" % (i % 3, i % 5, i) for i in range(n)]
+    names[::4] = ["k__%d|p__x%d" % (i % 3, i) for i in range(0, n, 4)]
+    return [(k, rng.randint(0, 8, len(SAMPLES)).astype(float).tolist()) for k in names]
+
+def check_filter(name, args, keep):
+    rows = random_rows()
+    abnd = table(rows)
+    getattr(abnd, name)(*args)
+    expected = [(k,v) for k,v in rows if keep(k,v)]
+    assert 0 < len(expected) < len(rows)
+    assert contents(abnd) == expected
+
+def test_filter_sequence_occurence():
+    check_filter("funcFilterAbundanceBySequenceOccurence", (4,2), lambda k,v: len([x for x in v if x >= 4]) >= 2)
+
+def test_filter_sd():
+    check_filter("funcFilterFeatureBySD", (2.0,), lambda k,v: statistics.pstdev(v) >= 2.0)
+
+def test_filter_clade_level():
+    check_filter("funcReduceFeaturesToCladeLevel", (2,), lambda k,v: k.count("|") < 2)
+
+def test_filter_percentile():
+    rows = random_rows()
+    cut = [numpy.percentile([v[j] for k,v in rows], 75) for j in range(len(SAMPLES))]
+    check_filter("funcFilterAbundanceByPercentile", (75.0,50.0), lambda k,v: len([1 for x,c in zip(v,cut) if x >= c])/3.0 >= 0.5)
+
+def test_filter_min_value():
+    rows = random_rows()
+    abnd = table(rows)
+    assert abnd.funcNormalizeColumnsBySum()
+    totals = [sum([v[j] for k,v in rows]) for j in range(len(SAMPLES))]
+    abnd.funcFilterAbundanceByMinValue(0.05, 2)
+    expected = [k for k,v in rows if len([1 for x,t in zip(v,totals) if x/t >= 0.05]) >= 2]
+    assert 0 < len(expected) < len(rows)
+    assert abnd.funcGetFeatureNames().tolist() == expected
+
+def test_keep_features():
+    rows = random_rows()
+    abnd = table(rows)
+    abnd._funcKeepFeatures(numpy.array([5,0,7]))
+    assert contents(abnd) == [rows[5],rows[0],rows[7]]
+    abnd._funcKeepFeatures(numpy.array([False,True,True]))
+    assert contents(abnd) == [rows[0],rows[7]]
+    assert abnd.funcGetAbundanceCopy()["ID"].tolist() == [rows[0][0],rows[7][0]]
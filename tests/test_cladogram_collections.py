@@ -0,0 +1,117 @@
+# The cladogram drawn through collections against the per-artist drawing it
+# replaced (one ax.plot per line and point, one ax.bar per shaded clade), on
+# a small result: same vertices, colours and widths.
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgba
+from matplotlib.markers import MarkerStyle
+from lefse import lefse_plot_cladogram as clad
+
+RES = """a	3.1	A	3.5	0.001
+a.b	2.7	A	3.2	0.002
+a.b.c	1.2			-
+a.b.d	2.0	A	2.8	0.01
+a.e	1.9			-
+a.e.f	0.3			-
+b	2.5	B	3.0	0.003
+b.g	2.4	B	2.9	0.004
+b.g.h	1.1	B	2.6	0.02
+b.g.i	0.7			-
+b.j	0.4			-
+c	1.0			-
+""".splitlines(True)
+
+def geometry():
+    # the lists of plot_lines, plot_points and plot_names as in draw_tree
+    params = clad.read_params(["", "in.res", "out.png"])
+    params['fore_color'] = 'k'
+    tree = clad.read_tree(RES, params)
+    nlev = tree['nlev']
+    depth = len(nlev)
+    pt_scale = (params['min_point_size'],max(1.0,((tree['max_abs']-tree['min_abs']))/(params['max_point_size']-params['min_point_size'])))
+    sep = (2.0*np.pi)/float(nlev[-1])
+    seps = [params['clade_sep']*sep/float(depth-i+1) for i in range(1,depth+1)]
+    totseps = sum([s*nlev[i] for i,s in enumerate(seps[:-1])])
+    clad.add_all_pos(tree['root'],0.0,(2.0*np.pi-totseps)/float(nlev[-1]),seps,0.0,depth)
+    fig = plt.figure()
+    ax = fig.add_subplot(111, polar=True)
+    lines, pts, wedges, handles = [], [], [], []
+    clad.plot_lines(tree['root'],params,depth,lines,0)
+    clad.plot_points(tree['root'],params,pt_scale,pts)
+    clad.plot_names(tree['root'],params,depth,ax,clad.uniqueid(),seps,wedges,handles)
+    plt.close(fig)
+    return params, lines, pts, wedges
+
+def axes():
+    fig = plt.figure()
+    return fig, fig.add_subplot(111, polar=True, frame_on=False)
+
+def test_lines_match_plot():
+    params, lines, pts, wedges = geometry()
+    assert lines
+    fig, ax = axes()
+    clad.add_lines(ax, lines)
+    coll = ax.collections[0]
+    ref_fig, ref_ax = axes()
+    ref = [ref_ax.plot(np.asarray(v)[:,0],np.asarray(v)[:,1],"-",color=c,lw=w)[0] for v,c,w in lines]
+    ax.autoscale_view()
+    fig.canvas.draw()
+    ref_fig.canvas.draw()
+    assert len(coll.get_paths()) == len(ref)
+    for path, lw, col, line in zip(coll.get_paths(), coll.get_linewidths(), coll.get_colors(), ref):
+        np.testing.assert_allclose(path.vertices, line.get_xydata())
+        np.testing.assert_allclose(ax.transData.transform_path(path).vertices,
+                                   line.get_transform().transform_path(line.get_path()).vertices)
+        assert lw == line.get_linewidth()
+        np.testing.assert_allclose(col, to_rgba(line.get_color()))
+    assert coll.get_capstyle() == ref[0].get_solid_capstyle()
+    assert coll.get_joinstyle() == ref[0].get_solid_joinstyle()
+    plt.close(fig)
+    plt.close(ref_fig)
+
+def test_points_match_plot():
+    params, lines, pts, wedges = geometry()
+    fig, ax = axes()
+    clad.add_points(ax, pts, params)
+    coll = ax.collections[0]
+    ref_fig, ref_ax = axes()
+    ref = [ref_ax.plot(x,r,'o',markersize=s,color=c,markeredgewidth=w,markeredgecolor=params['fore_color'])[0] for x,r,s,c,w in pts]
+    ax.autoscale_view()
+    fig.canvas.draw()
+    ref_fig.canvas.draw()
+    marker = coll.get_paths()[0]
+    offsets = coll.get_offset_transform().transform(coll.get_offsets())
+    for i, line in enumerate(ref):
+        # the marker in pixels around its centre
+        ms = MarkerStyle('o')
+        ref_path = ms.get_path().transformed(ms.get_transform().scale(line.get_markersize()*fig.dpi/72.0))
+        np.testing.assert_allclose(marker.transformed(matplotlib.transforms.Affine2D(coll.get_transforms()[i])).vertices, ref_path.vertices)
+        np.testing.assert_allclose(offsets[i], line.get_transform().transform(line.get_xydata())[0])
+        np.testing.assert_allclose(coll.get_facecolors()[i], to_rgba(line.get_markerfacecolor()))
+        assert coll.get_linewidths()[i] == line.get_markeredgewidth()
+    plt.close(fig)
+    plt.close(ref_fig)
+
+def test_wedges_match_bar():
+    params, lines, pts, wedges = geometry()
+    assert wedges
+    fig, ax = axes()
+    clad.add_wedges(ax, wedges, params)
+    coll = ax.collections[0]
+    ref_fig, ref_ax = axes()
+    ref = [ref_ax.bar(x, h, width=w, bottom=b, alpha=params['alpha'], color=c, edgecolor=c)[0] for x,w,b,h,c in wedges]
+    ax.autoscale_view()
+    ref_ax.autoscale_view()
+    fig.canvas.draw()
+    ref_fig.canvas.draw()
+    np.testing.assert_allclose(ax.get_ylim(), ref_ax.get_ylim())
+    for path, fc, rect in zip(coll.get_paths(), coll.get_facecolors(), ref):
+        np.testing.assert_allclose(path.vertices, rect.get_patch_transform().transform(rect.get_path().vertices))
+        np.testing.assert_allclose(ax.transData.transform_path(path).vertices,
+                                   rect.get_transform().transform_path(rect.get_path()).vertices)
+        np.testing.assert_allclose(fc, rect.get_facecolor())
+    plt.close(fig)
+    plt.close(ref_fig)
@@ -0,0 +1,74 @@
+# The cladogram tree built from the parent-id index against the old build_tree,
+# which scanned all the nodes with cmp_names at every level, in particular
+# the placeholder children added below the clades ending before the last
+# level.
+
+import random
+import pytest
+from lefse import lefse_plot_cladogram as clad
+
+def scan_cmp_names(la,lb):
+    if len(la) != len(lb): return False
+    for p in [(a,b) for i,a in enumerate(la) for j,b in enumerate(lb) if i == j]:
+        if p[0] != p[1]: return False
+    return True
+
+def scan_build_tree(father,all_nodes,l,depth,viz):
+    cc = [n for n in all_nodes if len(n.name) > len(father.name) and scan_cmp_names(father.name,n.name[:len(father.name)])]
+    children = [n for n in cc if len(n.name) == len(father.name)+1]
+    if len(children) == 0 and l < depth -1:
+        nc = clad.CladeNode(father.id+"."+father.id.split(".")[-1],1.0,viz)
+        father.add_child(nc)
+        children.append(nc)
+    for child in children:
+        scan_build_tree(child,cc,l+1,depth,viz)
+        father.add_child(child)
+
+def clade_names(n = 300, seed = 1982):
+    # clades ending at different levels, some of their ancestors missing
+    r = random.Random(seed)
+    names = set()
+    while len(names) < n:
+        d = r.randint(1,6)
+        name = tuple("l%d_%d" % (i,r.randint(0,3)) for i in range(d))
+        names.add(".".join(name))
+        if r.random() < 0.5: names.add(".".join(name[:r.randint(1,d)]))
+    return sorted(names)
+
+def nodes(names):
+    # the nodes of read_tree, with the missing levels added
+    all_nodes = [clad.CladeNode("root."+n,1.0) for n in names]
+    ids = set([n.id for n in all_nodes])
+    for nn in list(all_nodes):
+        n = nn
+        while ".".join(n.name[:-1]) not in ids and len(n.name) > 1:
+            n = clad.CladeNode(".".join(n.name[:-1]),n.abundance)
+            all_nodes.append(n)
+            ids.add(n.id)
+    return all_nodes, max([len(n.name) for n in all_nodes])
+
+def flat(root):
+    return [(n.id,n.isleaf,n.viz) for n in clad.get_all_nodes(root)]
+
+@pytest.mark.parametrize('viz', [True,False])
+@pytest.mark.parametrize('seed', [1,2,3])
+def test_build_tree_matches_scan(viz, seed):
+    names = clade_names(seed=seed)
+    trees = []
+    for build in (clad.build_tree, scan_build_tree):
+        all_nodes, depth = nodes(names)
+        root = clad.CladeNode("root",-1.0)
+        build(root,all_nodes,0,depth,viz)
+        trees.append(flat(root))
+    assert trees[0] == trees[1]
+    # clades ending early get a chain of placeholder children to the last level
+    placeholders = [i for i,isleaf,v in trees[0] if i.count(".") > 1 and i.split(".")[-1] == i.split(".")[-2]]
+    assert placeholders and all([v == viz for i,isleaf,v in trees[0] if i in placeholders])
+    assert all([len(i.split(".")) == depth for i,isleaf,v in trees[0] if isleaf])
+
+def test_read_tree_placeholders():
+    lines = ["a\t1.0\t\t\t-\n", "b.c.d\t2.0\tA\t3.0\t0.01\n", "b.e\t1.5\t\t\t-\n"]
+    params = clad.read_params(["", "in.res", "out.png"])
+    tree = clad.read_tree(lines, params)
+    ids = [n.id for n in clad.get_all_nodes(tree['root'])]
+    assert ids == ['root', 'root.a', 'root.a.a', 'root.a.a.a', 'root.b', 'root.b.c', 'root.b.c.d', 'root.b.e', 'root.b.e.e']
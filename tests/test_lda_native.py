@@ -0,0 +1,103 @@
+# The native LDA engine (-r lda_native): lda_native against MASS::lda and
+# test_lda_native against test_lda_r when rpy2 and the R libraries are
+# available, and always against frozen reference scores.
+
+import numpy
+import pytest
+from lefse import lefse
+
+TOL = 0.0000000001
+
+def table():
+    # three classes of 10 samples, f4 has few distinct values per class so
+    # perturb_feats jitters it
+    rng = numpy.random.RandomState(1982)
+    cls = {'class': ['a']*10+['b']*10+['c']*10}
+    shift = numpy.repeat([0.0,1.0,2.0],10)
+    feats = {
+        'f1': list(rng.normal(size=30)+shift),
+        'f2': list(rng.normal(size=30)),
+        'f3': list(rng.rand(30)*10.0+shift[::-1]*3.0),
+        'f4': list(rng.randint(0,3,size=30).astype(float)),
+        'f5': list(numpy.abs(rng.normal(size=30))*1000.0+shift*500.0),
+    }
+    return cls, feats
+
+def scores(test_lda, seed=1982, boots=30, lda_th=2.0, boot_jobs=1):
+    # the jitter of perturb_feats draws from the seed set by init
+    cls, feats = table()
+    lefse.init(False, seed)
+    return test_lda(cls, feats, None, boots, 0.67, lda_th, TOL, 3, seed, boot_jobs)
+
+# lda_native of the whole table (columns f1..f5), the sign of a
+# discriminant direction is arbitrary
+LDA_REF = [0.6994031414001388, 0.1439371899099432, -0.19996830886519223, -0.1462412345147044, 0.0006503379372623896]
+
+# test_lda_native scores of table() with the defaults of lefse_run
+SCORES_REF = {'f1': 0.576364001636665, 'f2': 0.3007198476744836, 'f3': 0.7492444709242084,
+              'f4': 0.32476497215983263, 'f5': 2.7552051496679977}
+
+def matrix():
+    cls, feats = table()
+    return numpy.array([feats[k] for k in sorted(feats)]).T, numpy.array(cls['class'])
+
+def same_direction(w, ref):
+    w, ref = numpy.asarray(w), numpy.asarray(ref)
+    numpy.testing.assert_allclose(w*numpy.sign(w[0]), ref*numpy.sign(ref[0]), rtol=1e-9, atol=0)
+
+def test_lda_native_reference():
+    x, g = matrix()
+    w, lev, gmeans = lefse.lda_native(x, g, TOL)
+    same_direction(w, LDA_REF)
+    assert list(lev) == ['a','b','c']
+    numpy.testing.assert_allclose(gmeans, [x[g == c].mean(axis=0) for c in 'abc'])
+
+def test_lda_native_constant_within_groups():
+    x, g = matrix()
+    x[:,1] = numpy.repeat([1.0,2.0,3.0],10)
+    with pytest.raises(ValueError, match="variable 2 appears to be constant within groups"):
+        lefse.lda_native(x, g, TOL)
+
+def test_lda_native_scores_reference():
+    res, res_th = scores(lefse.test_lda_native)
+    assert sorted(res) == sorted(SCORES_REF)
+    numpy.testing.assert_allclose([res[k] for k in sorted(res)], [SCORES_REF[k] for k in sorted(res)], rtol=1e-9, atol=0)
+    assert res_th == dict([(k,v) for k,v in res.items() if abs(v) > 2.0])
+    assert list(res_th) == ['f5']
+
+@pytest.fixture(scope='module')
+def r_backend():
+    pytest.importorskip('rpy2.robjects')
+    try: lefse.init(True)
+    except Exception as e: pytest.skip("R libraries not available: %s" % e)
+    return lefse
+
+def test_lda_native_matches_mass(r_backend):
+    ro = r_backend.robjects
+    x, g = matrix()
+    rx = ro.r.matrix(ro.FloatVector(x.T.ravel()), nrow=x.shape[0])
+    ref = ro.r('function(x,g,tol) lda(x,g,tol=tol)$scaling[,1]')(rx, ro.FactorVector(ro.StrVector(list(g))), TOL)
+    w, lev, gmeans = lefse.lda_native(x, g, TOL)
+    same_direction(w, list(ref))
+
+def test_lda_native_matches_r(r_backend):
+    # both engines draw the same jitter and bootstrap samples
+    native, native_th = scores(lefse.test_lda_native)
+    r, r_th = scores(r_backend.test_lda_r)
+    numpy.testing.assert_allclose([native[k] for k in sorted(native)], [r[k] for k in sorted(native)], rtol=1e-9, atol=0)
+    assert sorted(native_th) == sorted(r_th)
+
+def test_lda_native_boot_jobs():
+    # every bootstrap iteration has its own random stream, the workers give
+    # the scores of the serial loop
+    serial, serial_th = scores(lefse.test_lda_native, boot_jobs=1)
+    pool, pool_th = scores(lefse.test_lda_native, boot_jobs=2)
+    assert pool == serial
+    assert pool_th == serial_th
+
+def test_lda_native_seed():
+    res, res_th = scores(lefse.test_lda_native)
+    assert scores(lefse.test_lda_native)[0] == res
+    other, other_th = scores(lefse.test_lda_native, seed=1983)
+    assert sorted(other) == sorted(res)
+    assert all(other[k] != res[k] for k in res)
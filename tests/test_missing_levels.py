@@ -0,0 +1,50 @@
+# The completion of the missing hierarchy levels with missing_levels against
+# add_missing_levels2, the scan over all the features it replaced.
+
+import numpy
+import scipy.sparse
+from lefse.lefse_format_input import missing_levels,add_missing_levels,add_missing_levels2
+
+def leaves(n = 300, depth = 6, fan = 3, samples = 8, seed = 1982):
+    # features given at the last level only, as read from the input file
+    rng = numpy.random.RandomState(seed)
+    names = set()
+    while len(names) < n:
+        names.add(".".join(["l%d_%d" % (l,i) for l,i in enumerate(rng.randint(0,fan,size=depth))]))
+    vals = numpy.where(rng.rand(n,samples) < 0.5, 0.0, rng.rand(n,samples))
+    return dict([(k,[str(v) for v in row]) for k,row in zip(sorted(names),vals)])
+
+def check_same(ref, res):
+    assert set(ref) == set(res)
+    for k in ref:
+        numpy.testing.assert_allclose(numpy.asarray(res[k],dtype=float), numpy.asarray(ref[k],dtype=float), rtol=1e-12, atol=1e-12)
+
+def test_same_sums_as_add_missing_levels2():
+    ff = leaves()
+    check_same(add_missing_levels2(dict(ff)), add_missing_levels(dict(ff)))
+
+def test_mixed_depths_same_sums_as_add_missing_levels2():
+    # leaves at different levels of the same tree, a missing clade sums the
+    # leaves below it
+    ff = leaves(n = 100, depth = 6, seed = 8)
+    short = leaves(n = 60, depth = 4, seed = 7)
+    ff.update([(k,v) for k,v in short.items() if not [f for f in ff if f.startswith(k+".")]])
+    assert len(ff) > 100
+    check_same(add_missing_levels2(dict(ff)), add_missing_levels(dict(ff)))
+
+def test_given_internal_clades_are_kept():
+    ff = {'a.b.c': ['1','2'], 'a.b.d': ['3','4'], 'a.e': ['5','6'], 'x.y': ['7','8'], 'x': ['100','100']}
+    res = add_missing_levels(dict(ff))
+    assert res['x'] == ['100','100']
+    assert sorted(set(res)-set(ff)) == ['a','a.b']
+    numpy.testing.assert_array_equal(res['a.b'], [4,6])
+    numpy.testing.assert_array_equal(res['a'], [9,12])
+
+def test_sparse_matches_dense():
+    ff = leaves(seed = 3)
+    names = list(ff)
+    m = numpy.array([numpy.asarray(v,dtype=float) for v in ff.values()])
+    missing, dense = missing_levels(names, m)
+    smissing, sparse = missing_levels(names, scipy.sparse.csr_matrix(m))
+    assert missing == smissing
+    numpy.testing.assert_allclose(sparse.toarray(), dense, rtol=1e-12, atol=1e-12)
@@ -0,0 +1,92 @@
+# The memory-mappable file of lefse_format_input (LEFSEMM1, save_data and
+# load_data): the formatted data read back for dense float64 and float32
+# matrices and sparse ones, with and without subclass and subject, and the
+# errors on files that are not in the format.
+
+import numpy
+import pytest
+import scipy.sparse
+from lefse import lefse, pipeline
+
+def write_input(fn, meta):
+    rng = numpy.random.RandomState(1982)
+    n = 12
+    rows = [["class"]+["a","b","c"]*(n//3)]
+    if 'subclass' in meta: rows.append(["subclass"]+["s1","s2"]*(n//2))
+    if 'subject' in meta: rows.append(["subject"]+["p%d" % i for i in range(n)])
+    for name in ["k1|p1|c1","k1|p1|c2","k1|p2","k2|p3|c3","k2"]:
+        v = numpy.where(rng.rand(n) < 0.5, 0.0, rng.rand(n)*100.0)
+        rows.append([name]+["%.3f" % x for x in v])
+    with open(fn, 'w') as out:
+        for r in rows: out.write("\t".join(r)+"\n")
+
+def formatted(tmp_path, meta=('subclass','subject'), **kw):
+    # meta are the rows after the class one, in this order
+    fn = str(tmp_path / "input.tsv")
+    write_input(fn, meta)
+    for i,k in enumerate(meta): kw[k] = i+2
+    return pipeline.format_input(fn, **dict(kw, **{'class':1}))
+
+def dense(feats):
+    return dict([(k,numpy.asarray(v,dtype=float)) for k,v in feats.items()])
+
+def check_round_trip(tmp_path, out, dtype):
+    fn = str(tmp_path / "data.in")
+    lefse.save_data(out, fn, dtype)
+    feats,cls,class_sl,subclass_sl,class_hierarchy,norm = lefse.load_data(fn, True)
+    assert list(feats.keys()) == list(out['feats'].keys())
+    ref = dense(out['feats'])
+    for k,v in feats.items(): numpy.testing.assert_array_equal(v, ref[k].astype(dtype))
+    assert dict([(k,list(v)) for k,v in cls.items()]) == dict([(k,list(v)) for k,v in out['cls'].items()])
+    assert class_sl == out['class_sl'] and subclass_sl == out['subclass_sl']
+    assert class_hierarchy == out['class_hierarchy']
+    assert norm == out['norm']
+    return feats
+
+@pytest.mark.parametrize('meta', [('subclass','subject'), ('subclass',), ('subject',), ()])
+@pytest.mark.parametrize('dtype', ['float64','float32'])
+def test_dense_round_trip(tmp_path, meta, dtype):
+    out = formatted(tmp_path, meta)
+    # without a subclass row every class is its own subclass
+    assert ('subject' in out['cls']) == ('subject' in meta)
+    feats = check_round_trip(tmp_path, out, dtype)
+    assert isinstance(feats, dict)
+    assert all(isinstance(v, numpy.memmap) and v.dtype == numpy.dtype(dtype) for v in feats.values())
+
+@pytest.mark.parametrize('meta', [('subclass','subject'), ()])
+@pytest.mark.parametrize('dtype', ['float64','float32'])
+def test_sparse_round_trip(tmp_path, meta, dtype):
+    out = formatted(tmp_path, meta, sparse=True)
+    assert isinstance(out['feats'], lefse.SparseFeats)
+    feats = check_round_trip(tmp_path, out, dtype)
+    assert isinstance(feats, lefse.SparseFeats)
+    m = feats.matrix(list(feats.keys()))
+    assert m.dtype == numpy.dtype(dtype)
+    assert scipy.sparse.issparse(m) and m.nnz == out['feats'].matrix(list(out['feats'].keys())).nnz
+
+def saved(tmp_path):
+    fn = str(tmp_path / "data.in")
+    lefse.save_data(formatted(tmp_path), fn)
+    with open(fn, 'rb') as f: return fn, f.read()
+
+def rewrite(fn, data):
+    with open(fn, 'wb') as f: f.write(data)
+    return fn
+
+def test_bad_magic(tmp_path):
+    fn, data = saved(tmp_path)
+    with pytest.raises(ValueError, match="unsupported version"):
+        lefse.load_data(rewrite(fn, b"LEFSEMM9"+data[8:]))
+    with pytest.raises(ValueError, match="neither a LEfSe matrix file nor a pickle"):
+        lefse.load_data(rewrite(fn, b"NOTLEFSE"+data[8:]))
+    with pytest.raises(ValueError, match="not a LEfSe matrix file"):
+        lefse.load_mmap_data(fn)
+
+def test_bad_header(tmp_path):
+    fn, data = saved(tmp_path)
+    with pytest.raises(ValueError, match="corrupted LEfSe matrix header"):
+        lefse.load_data(rewrite(fn, data[:16]+b"#"+data[17:]))
+    with pytest.raises(ValueError, match="truncated LEfSe matrix header"):
+        lefse.load_data(rewrite(fn, data[:8]+b"\xff"*8+data[16:]))
+    with pytest.raises(ValueError, match="truncated LEfSe matrix,"):
+        lefse.load_data(rewrite(fn, data[:-8]))
@@ -0,0 +1,132 @@
+# The native Kruskal-Wallis and Wilcoxon rank-sum tests (--stat-backend
+# native) against the R backend, when rpy2 and the R libraries are
+# available, and always against scipy and frozen reference p-values.
+
+import math
+import numpy
+import pytest
+import scipy.sparse
+from scipy import stats
+from lefse import lefse
+
+# three classes, b_s2 has fewer than MIN_C samples
+SL = {'a_s1': (0,6), 'a_s2': (6,10), 'b_s1': (10,17), 'b_s2': (17,19), 'c_s1': (19,25)}
+CL_HIE = {'a': ['a_s1','a_s2'], 'b': ['b_s1','b_s2'], 'c': ['c_s1']}
+MIN_C = 3
+CLS = numpy.array([k[0] for k in sorted(SL, key=lambda k: SL[k][0]) for i in range(*SL[k])])
+
+def feats():
+    rng = numpy.random.RandomState(1982)
+    rows = [
+        rng.normal(size=25),                            # no ties
+        rng.randint(0, 4, size=25).astype(float),       # many ties
+        numpy.where(rng.rand(25) < 0.6, 0.0, rng.rand(25)),  # zero-inflated
+        numpy.r_[numpy.full(10, 2.0), rng.rand(15)],    # constant class a
+        numpy.r_[rng.rand(10), numpy.full(15, 0.5)],    # constant b and c
+        numpy.full(25, 1.0),                            # constant feature
+        numpy.r_[numpy.full(10, -1.0), numpy.zeros(9), rng.rand(6)],  # negatives and zeros
+    ]
+    return numpy.array(rows)
+
+# p-values of the rows of feats(), computed with scipy.stats.kruskal and
+# scipy.stats.mannwhitneyu (asymptotic, no continuity correction)
+KW_REF = [0.17310686579346393, 0.36397624783804167, 0.2647551687146934, 9.599659751089575e-05,
+          0.9999999999999909, float('nan'), 7.366451003804354e-06]
+WILC_REF = {
+    ('a_s1','b_s1'): [0.475050524053953, 0.599495430846676, 0.43962075010926305, 0.0016020006947992731,
+                      1.0, float('nan'), 0.0005320055051392492],
+    ('a_s2','c_s1'): [0.5224312849615644, 0.8230632737581215, 0.18966942796922226, 0.00829921599528076,
+                      1.0, float('nan'), 0.00829921599528076],
+}
+
+def groups(row, keys):
+    return [row[SL[k][0]:SL[k][1]] for k in keys]
+
+def check_close(native, ref):
+    native, ref = numpy.asarray(native, dtype=float), numpy.asarray(ref, dtype=float)
+    assert numpy.array_equal(numpy.isnan(native), numpy.isnan(ref))
+    ok = ~numpy.isnan(ref)
+    numpy.testing.assert_allclose(native[ok], ref[ok], rtol=1e-9, atol=0)
+
+def test_kw_native_matches_scipy():
+    f = feats()
+    pvs = [pv for ok, pv in lefse.test_kw_native(CLS, f, 0.05)]
+    ref = []
+    for row in f:
+        # depending on its version scipy raises or returns 0 when all the
+        # values are identical, the native test gives nan like R
+        if len(set(row)) == 1: ref.append(float('nan'))
+        else: ref.append(stats.kruskal(*[row[CLS == c] for c in 'abc']).pvalue)
+    check_close(pvs, ref)
+    check_close(pvs, KW_REF)
+
+def test_kw_native_sorted_blocks():
+    f = feats()
+    res = lefse.test_kw_native(CLS, f, 0.05, lefse.sort_blocks(f, SL))
+    check_close([pv for ok, pv in res], KW_REF)
+    assert [ok for ok, pv in res] == [pv < 0.05 for pv in KW_REF]
+
+def test_kw_sparse_matches_dense():
+    f = feats()
+    res = lefse.test_kw_sparse(CLS, lefse.sort_sparse(scipy.sparse.csr_matrix(f)), 0.05)
+    check_close([pv for ok, pv in res], KW_REF)
+
+def test_wilcoxon_pairs_min_c():
+    pairs = lefse.wilcoxon_pairs(SL, CL_HIE, MIN_C, False)
+    assert ('a_s1','b_s1') in pairs and ('a_s2','c_s1') in pairs
+    assert not [p for p in pairs if 'b_s2' in p]
+    assert len(lefse.wilcoxon_pairs(SL, CL_HIE, 2, False)) == len(pairs)+3
+
+def test_wilcoxon_native_matches_scipy():
+    f = feats()
+    pairs = lefse.wilcoxon_pairs(SL, CL_HIE, MIN_C, False)
+    pvs = lefse.test_wilcoxon_native(SL, pairs, f)
+    for pair in pairs:
+        ref = []
+        for row in f:
+            x, y = groups(row, pair)
+            if len(set(x) | set(y)) == 1: ref.append(float('nan'))
+            else: ref.append(stats.mannwhitneyu(x, y, use_continuity=False, alternative='two-sided', method='asymptotic').pvalue)
+        check_close(pvs[pair], ref)
+    for pair, ref in WILC_REF.items(): check_close(pvs[pair], ref)
+
+def test_wilcoxon_sparse_matches_dense():
+    f = feats()
+    pairs = lefse.wilcoxon_pairs(SL, CL_HIE, MIN_C, False)
+    dense = lefse.test_wilcoxon_native(SL, pairs, f)
+    sparse = lefse.test_wilcoxon_sparse(SL, pairs, lefse.sort_sparse(scipy.sparse.csr_matrix(f)))
+    for pair in pairs: check_close(sparse[pair], dense[pair])
+
+def test_wilcoxon_zero_variance_not_significant():
+    # a pair of constant subclasses has no p-value, wilcoxon_detail counts it
+    # as not significant
+    f = feats()
+    pairs = lefse.wilcoxon_pairs(SL, CL_HIE, MIN_C, False)
+    pvs = lefse.test_wilcoxon_native(SL, pairs, f)
+    row = f[5]
+    pv = dict((p, pvs[p][5]) for p in pairs)
+    assert all(math.isnan(v) for v in pv.values())
+    detail = lefse.wilcoxon_detail(SL, CL_HIE, row, MIN_C, False, pv)
+    assert all(not consistent and max_pv is None for x, y, consistent, max_pv, n in detail)
+
+@pytest.fixture(scope='module')
+def r_backend():
+    pytest.importorskip('rpy2.robjects')
+    try: lefse.init(True)
+    except Exception as e: pytest.skip("R libraries not available: %s" % e)
+    return lefse
+
+def test_kw_native_matches_r(r_backend):
+    f = feats()
+    native = [pv for ok, pv in lefse.test_kw_native(CLS, f, 0.05)]
+    cls = {'class': list(CLS)}
+    ref = [r_backend.test_kw_r(cls, list(row), 0.05, ['class'])[1] for row in f]
+    check_close(native, ref)
+
+def test_wilcoxon_native_matches_r(r_backend):
+    f = feats()
+    pairs = lefse.wilcoxon_pairs(SL, CL_HIE, MIN_C, False)
+    pvs = lefse.test_wilcoxon_native(SL, pairs, f)
+    for pair in pairs:
+        ref = [r_backend.wilcoxon_pv_r(*groups(row, pair)) for row in f]
+        check_close(pvs[pair], ref)
@@ -0,0 +1,44 @@
+# The result cache shared by the JobQueue workers through its directory.
+
+import os
+import numpy
+from lefse import pipeline
+
+def test_directory_shared_between_caches(tmp_path):
+    a = pipeline.ResultCache(2**20, str(tmp_path))
+    b = pipeline.ResultCache(2**20, str(tmp_path))
+    key = ('format','0'*64,('class',1))
+    assert b.get(key) is None
+    a.put(key, {'feats': numpy.arange(5.0)})
+    numpy.testing.assert_array_equal(b.get(key)['feats'], numpy.arange(5.0))
+    # kept in memory after the first read
+    assert key in b.entries
+
+def test_entries_larger_than_memory_still_shared(tmp_path):
+    a = pipeline.ResultCache(10, str(tmp_path))
+    a.put(('k',), numpy.zeros(100))
+    assert not a.entries
+    assert pipeline.ResultCache(10, str(tmp_path)).get(('k',)) is not None
+
+def test_directory_pruned(tmp_path):
+    cache = pipeline.ResultCache(2**20, str(tmp_path), disk_bytes=3*8000)
+    for i in range(6):
+        cache.put(('k',i), numpy.zeros(1000))
+    files = [f for f in os.listdir(str(tmp_path)) if f.endswith(".pkl")]
+    assert 0 < len(files) < 6
+    assert not [f for f in os.listdir(str(tmp_path)) if f.endswith(".tmp")]
+
+def put_in_worker(key, value):
+    pipeline.worker_cache.put(key, value)
+    return os.getpid()
+
+def test_job_queue_workers_share_cache():
+    queue = pipeline.JobQueue(workers=2, max_jobs=2, load_r=False)
+    try:
+        job = queue.submit(put_in_worker, ('shared',), [1,2,3])
+        queue.jobs[job]['future'].result(timeout=120)
+        assert queue.status(job)['state'] == 'done'
+        assert pipeline.ResultCache(2**20, queue.cache_dir).get(('shared',)) == [1,2,3]
+    finally:
+        queue.executor.shutdown()
+        queue.manager.shutdown()
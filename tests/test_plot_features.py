@@ -0,0 +1,64 @@
+# lefse_plot_features renders the same images, in the same order, on one
+# process and on a pool of workers (--jobs).
+
+import os
+import sys
+import zipfile
+import numpy
+import pytest
+from lefse import lefse, pipeline, lefse_plot_features
+
+def write_inputs(tmp_path):
+    rng = numpy.random.RandomState(1982)
+    n = 12
+    rows = [["class"]+["a","b"]*(n//2), ["subclass"]+["s1","s1","s2","s2"]*(n//4)]
+    for i in range(6):
+        rows.append(["k1|p%d" % i]+["%.3f" % x for x in rng.rand(n)*100.0])
+    fn = str(tmp_path / "input.tsv")
+    with open(fn, 'w') as out:
+        for r in rows: out.write("\t".join(r)+"\n")
+    data = pipeline.format_input(fn, **{'class':1,'subclass':2})
+    data_fn = str(tmp_path / "input.in")
+    lefse.save_data(data, data_fn)
+    # every other feature is a biomarker, the names of their images are
+    # 1_<name> and 0_<name> for the others
+    res_fn = str(tmp_path / "result.res")
+    names = []
+    with open(res_fn, 'w') as out:
+        for i,k in enumerate(data['feats']):
+            if i % 2: out.write("%s\t2.0\t-\n" % k)
+            else: out.write("%s\t2.0\t%s\t3.1\t0.01\n" % (k,"ab"[i % 4 // 2]))
+            names.append("%d_%s" % (1-i % 2,k.replace(".","-")))
+    return data_fn, res_fn, names
+
+def plot_features(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ["lefse_plot_features.py"]+[str(a) for a in args])
+    lefse_plot_features.plot_features()
+
+def members(fn):
+    with zipfile.ZipFile(fn) as z:
+        return [(i.filename, z.read(i.filename)) for i in z.infolist()]
+
+@pytest.mark.parametrize('fmt', ['png','pdf'])
+def test_archive_same_with_jobs(tmp_path, monkeypatch, fmt):
+    data_fn, res_fn, names = write_inputs(tmp_path)
+    zips = []
+    for jobs in (1,2):
+        zips.append(str(tmp_path / ("features_%d.zip" % jobs)))
+        plot_features(monkeypatch, data_fn, res_fn, zips[-1], "--archive", "zip", "-f", "all", "--format", fmt, "--jobs", jobs)
+    serial, pool = members(zips[0]), members(zips[1])
+    assert [n for n,img in serial] == [n+"."+fmt for n in names]
+    assert [n for n,img in pool] == [n for n,img in serial]
+    if fmt == 'png': assert [img for n,img in pool] == [img for n,img in serial]
+    else: assert all([img.startswith(b"%PDF") for n,img in pool])
+
+def test_files_same_with_jobs(tmp_path, monkeypatch):
+    data_fn, res_fn, names = write_inputs(tmp_path)
+    images = []
+    for jobs in (1,2):
+        out = tmp_path / ("out_%d" % jobs)
+        out.mkdir()
+        plot_features(monkeypatch, data_fn, res_fn, str(out)+"/", "-f", "diff", "--jobs", jobs)
+        images.append(dict([(f, (out / f).read_bytes()) for f in sorted(os.listdir(str(out)))]))
+    assert sorted(images[0]) == sorted([n+".png" for n in names if n.startswith("1_")])
+    assert images[1] == images[0]
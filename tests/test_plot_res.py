@@ -0,0 +1,119 @@
+# The LDA barplot: the rows and labels of bar_rows, the Vega-Lite spec of
+# --format json and the refusal of PNGs too large for Agg, in plot_hor, the
+# command line and pipeline.analyse.
+
+import io
+import sys
+import json
+import struct
+import numpy
+import pytest
+from lefse import lefse, pipeline, lefse_plot_res
+
+RES = ["k__A.p__B\t3.1\ta\t3.5\t0.001\n",
+       "k__A.p__C.g__very_long_genus_name_of_the_test\t2.7\ta\t2.2\t0.002\n",
+       "k__D\t2.0\t\t\t-\n",
+       "k__D.p__E\t2.4\tb\t4.1\t0.004\n",
+       "k__D.p__F\t1.1\tb\t2.9\t0.02\n"]
+
+def params(*args):
+    p = lefse_plot_res.read_params(["", "in.res", "out.png"]+list(args))
+    p['fore_color'] = 'w' if p['background_color'] == 'k' else 'k'
+    return p
+
+def test_bar_rows():
+    data = lefse_plot_res.read_rows(RES, False)
+    assert data['cls'] == ['a','b']
+    rows, vals, lbls = lefse_plot_res.bar_rows(params("--max_feature_len", "20"), data)
+    # bottom to top: the first class from its highest score, then the
+    # second one (negative) down to its highest
+    assert [r[0] for r in rows] == ["k__A.p__B","k__A.p__C.g__very_long_genus_name_of_the_test","k__D.p__F","k__D.p__E"]
+    assert vals == [3.5,2.2,-2.9,-4.1]
+    assert lbls == ["p__B","g__very_ [..]the_test","p__F","p__E"]
+    rows, vals, lbls = lefse_plot_res.bar_rows(params("--n_scl", "0"), lefse_plot_res.read_rows(RES, False))
+    assert lbls[0] == "k__A.p__B"
+
+def test_bar_rows_multiclass():
+    data = lefse_plot_res.read_rows(RES+["k__G\t1.0\tc\t2.5\t0.01\n"], False)
+    rows, vals, lbls = lefse_plot_res.bar_rows(params(), data)
+    assert [r[2] for r in rows] == ['a','a','b','b','c']
+    assert all(v > 0 for v in vals)
+
+def test_save_spec():
+    p = params("--format", "json", "--colors", "#ff0000,#0000ff", "--title", "T")
+    for out in (io.StringIO(), io.BytesIO()):
+        lefse_plot_res.plot_hor(out, p, lefse_plot_res.read_rows(RES, False))
+        value = out.getvalue()
+        spec = json.loads(value if isinstance(value, str) else value.decode('utf-8'))
+        values = spec['data']['values']
+        assert [v['feature'] for v in values] == ["k__A.p__B","k__A.p__C.g__very_long_genus_name_of_the_test","k__D.p__F","k__D.p__E"]
+        assert [v['value'] for v in values] == [3.5,2.2,-2.9,-4.1]
+        assert [v['lda'] for v in values] == [3.5,2.2,2.9,4.1]
+        assert [v['order'] for v in values] == [0,1,2,3]
+        # labels left of zero for the first class, right of it for the second
+        assert [v['label_x'] > 0 for v in values] == [False,False,True,True]
+        scale = spec['layer'][0]['encoding']['color']['scale']
+        assert scale == {'domain': ['a','b'], 'range': ['#ff0000','#0000ff']}
+        assert spec['title']['text'] == "T"
+        assert len(spec['layer']) == 3
+
+def test_save_spec_file(tmp_path):
+    fn = str(tmp_path / "barplot.json")
+    lefse_plot_res.plot_hor(fn, params("--format", "json"), lefse_plot_res.read_rows(RES, False))
+    with open(fn) as f: assert len(json.load(f)['data']['values']) == 4
+
+def test_png_too_large(tmp_path):
+    fn = tmp_path / "barplot.png"
+    # 7 inches at 10000 dpi are more than 2^16 pixels
+    with pytest.raises(ValueError, match="--dpi 9362 or lower"):
+        lefse_plot_res.plot_hor(str(fn), params("--dpi", "10000"), lefse_plot_res.read_rows(RES, False))
+    assert not fn.exists()
+    # 1100 features at 300 dpi
+    many = ["f%d\t2.0\t%s\t3.0\t0.01\n" % (i,"ab"[i % 2]) for i in range(1100)]
+    with pytest.raises(ValueError, match="1100 features do not fit"):
+        lefse_plot_res.plot_hor(str(fn), params(), lefse_plot_res.read_rows(many, False))
+    lefse_plot_res.plot_hor(str(fn), params("--dpi", "50"), lefse_plot_res.read_rows(RES, False))
+    assert fn.read_bytes().startswith(b"\x89PNG")
+
+def test_png_too_large_cli(tmp_path, monkeypatch, capsys):
+    res = tmp_path / "result.res"
+    res.write_text("".join(RES))
+    out = tmp_path / "barplot.png"
+    monkeypatch.setattr(sys, 'argv', ["lefse_plot_res.py", str(res), str(out), "--dpi", "10000"])
+    with pytest.raises(SystemExit) as e: lefse_plot_res.plot_res()
+    assert e.value.code == 1
+    assert "[ERROR] 4 features do not fit in a PNG" in capsys.readouterr().out
+    assert not out.exists()
+
+def analyse_input(tmp_path):
+    rng = numpy.random.RandomState(1982)
+    rows = [["class"]+["a"]*10+["b"]*10]
+    for i in range(5): rows.append(["k__A|p__%d" % i]+["%.3f" % x for x in rng.rand(20)*1000.0+numpy.repeat([0.0,2000.0],10)])
+    fn = tmp_path / "input.tsv"
+    fn.write_text("".join(["\t".join(r)+"\n" for r in rows]))
+    return str(fn), dict(format_kw={'class':1}, run_kw={'stat_backend':'native','rank_tec':'lda_native','min_c':3},
+                         cladogram_kw={'format':'png','dpi':50})
+
+def test_png_too_large_analyse(tmp_path):
+    # the job fails instead of returning the results without a barplot
+    fn, kw = analyse_input(tmp_path)
+    out = pipeline.analyse(str(fn), str(tmp_path), plot_res_kw={'format':'png','dpi':50}, **kw)
+    assert sorted(out) == ['barplot','cladogram','result']
+    with pytest.raises(RuntimeError, match="Barplot generation failed: 6 features do not fit in a PNG"):
+        pipeline.analyse(str(fn), str(tmp_path), plot_res_kw={'format':'png','dpi':10000}, **kw)
+
+def test_png_max_dpi():
+    assert lefse_plot_res.png_max_dpi(7.0, 4) == 9362
+    assert lefse_plot_res.png_max_dpi(7.0, 1100) == 296
+    assert 296*(1100*0.2+1.0) < 2**16 <= 297*(1100*0.2+1.0)
+
+def test_analyse_png_copy(tmp_path, monkeypatch):
+    # the PNG copy of a json barplot is drawn at a dpi fitting in Agg, here
+    # lowered to 20 dpi
+    fn, kw = analyse_input(tmp_path)
+    monkeypatch.setattr(lefse_plot_res, 'png_max_dpi', lambda width, n_rows: 20)
+    out = pipeline.analyse(fn, str(tmp_path), plot_res_kw={'format':'json','dpi':300}, barplot_png=True, **kw)
+    assert out['barplot'].endswith("barplot.json") and out['barplot_png'].endswith("barplot.png")
+    with open(out['barplot_png'], 'rb') as f: png = f.read()
+    assert png.startswith(b"\x89PNG") and struct.unpack(">I", png[16:20])[0] == 7*20
+    assert 'barplot_png' not in pipeline.analyse(fn, str(tmp_path), plot_res_kw={'format':'json'}, **kw)
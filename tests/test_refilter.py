@@ -0,0 +1,83 @@
+# The results store of lefse_run --store and lefse_refilter: re-applying -a,
+# -w and -l to the store gives the results of a new run with those
+# thresholds, or no result when the tests or the LDA bootstrap would differ.
+
+import sys
+import numpy
+import pytest
+from lefse import lefse, lefse_run, lefse_refilter
+
+def data():
+    # two classes of two subclasses, the first features shifted by class
+    rng = numpy.random.RandomState(1982)
+    sub = ['a_1','a_2','b_1','b_2']
+    n = 8
+    cls = {'class': [s[0] for s in sub for i in range(n)], 'subclass': [s for s in sub for i in range(n)]}
+    class_sl = {'a': (0,2*n), 'b': (2*n,4*n)}
+    subclass_sl = dict([(s,(i*n,(i+1)*n)) for i,s in enumerate(sub)])
+    class_hierarchy = {'a': ['a_1','a_2'], 'b': ['b_1','b_2']}
+    shift = numpy.repeat([0.0,1.0],2*n)
+    feats = {}
+    for i in range(30):
+        feats['f%02d' % i] = rng.rand(4*n)*100.0 + shift*(100.0*(30-i)/30.0 if i < 12 else 0.0)
+    return feats,cls,class_sl,subclass_sl,class_hierarchy
+
+def params(**kw):
+    p = lefse_run.read_params(["", "in", "out", "--stat-backend", "native", "-r", "lda_native", "--min_c", "3"])
+    p.update(kw)
+    p['wilcoxon_detail'] = p['store'] != ""
+    return p
+
+def run(**kw):
+    lefse.init(False, 1982)
+    return lefse_run.run_lefse(*(data()+(params(**kw),)))
+
+@pytest.fixture(scope='module')
+def store(tmp_path_factory):
+    fn = str(tmp_path_factory.mktemp("store") / "store.json")
+    run(store=fn)
+    return fn
+
+def refilter(store, **kw):
+    p = dict(lefse.load_store(store)['params'])
+    p.update(kw)
+    return lefse_run.refilter(lefse.load_store(store), p)
+
+def selected(res):
+    return sorted([k for k,v in res['wilcox_res'].items() if v != "-"])
+
+def test_store_same_results(store):
+    assert lefse.res_lines(refilter(store)) == lefse.res_lines(run())
+
+def test_new_lda_threshold(store):
+    for l in (1.0, 1.75, 3.0):
+        res = refilter(store, lda_abs_th=l)
+        assert lefse.res_lines(res) == lefse.res_lines(run(lda_abs_th=l))
+    assert 0 < len(refilter(store, lda_abs_th=1.75)['lda_res_th']) < len(refilter(store, lda_abs_th=1.0)['lda_res_th'])
+
+def test_new_alphas_without_lda(store):
+    # without the LDA step any smaller -a and any -w can be re-applied
+    for a,w in ((0.05,0.2), (0.05,0.001), (0.01,0.05), (0.001,0.01)):
+        res = refilter(store, anova_alpha=a, wilcoxon_alpha=w, lda_abs_th=-1.0)
+        assert lefse.res_lines(res) == lefse.res_lines(run(anova_alpha=a, wilcoxon_alpha=w, lda_abs_th=-1.0))
+    assert selected(refilter(store, wilcoxon_alpha=0.001, lda_abs_th=-1.0)) != selected(run())
+
+def test_new_wilcoxon_alpha(store):
+    # a -w keeping the features of the bootstrap is re-applied, one changing
+    # them is not
+    assert selected(run(wilcoxon_alpha=0.04)) == selected(run())
+    assert lefse.res_lines(refilter(store, wilcoxon_alpha=0.04)) == lefse.res_lines(run(wilcoxon_alpha=0.04))
+    assert refilter(store, wilcoxon_alpha=0.001) is None
+
+def test_larger_anova_alpha(store):
+    assert refilter(store, anova_alpha=0.1) is None
+
+def test_refilter_cli(store, tmp_path, monkeypatch, capsys):
+    out = str(tmp_path / "refiltered.res")
+    monkeypatch.setattr(sys, 'argv', ["lefse_refilter.py", store, out, "-l", "1.75"])
+    lefse_refilter.lefse_refilter()
+    with open(out) as f: assert f.readlines() == lefse.res_lines(run(lda_abs_th=1.75))
+    monkeypatch.setattr(sys, 'argv', ["lefse_refilter.py", store, out, "-a", "0.1"])
+    with pytest.raises(SystemExit) as e: lefse_refilter.lefse_refilter()
+    assert e.value.code == 1
+    assert "run lefse_run again" in capsys.readouterr().out
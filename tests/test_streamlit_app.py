@@ -0,0 +1,77 @@
+# The web app run through Streamlit's AppTest with LEFSE_STAT_BACKEND=native:
+# the upload, the job submitted to JobQueue with pipeline.analyse, the
+# polling of its status and the results page.
+
+import os
+import time
+import numpy
+import pytest
+from lefse import pipeline
+
+testing = pytest.importorskip('streamlit.testing.v1')
+import streamlit as st
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "streamlit_lefse_app.py")
+
+def table():
+    rng = numpy.random.RandomState(1982)
+    # the app normalises the samples, p__0 and p__1 are more abundant in b
+    rows = [["class"]+["a"]*10+["b"]*10]
+    for i in range(5): rows.append(["k__A|p__%d" % i]+["%.3f" % x for x in rng.rand(20)*1000.0+numpy.repeat([0.0,2000.0*(i < 2)],10)])
+    return "".join(["\t".join(r)+"\n" for r in rows]).encode()
+
+@pytest.fixture
+def queues(tmp_path, monkeypatch):
+    # the queues created by the app, shut down at the end of the test
+    monkeypatch.setenv("LEFSE_STAT_BACKEND", "native")
+    monkeypatch.setenv("LEFSE_WORKERS", "1")
+    monkeypatch.setenv("LEFSE_WORK_DIR", str(tmp_path / "runs"))
+    monkeypatch.setenv("LEFSE_CACHE_DIR", str(tmp_path / "cache"))
+    created = []
+    class Queue(pipeline.JobQueue):
+        def __init__(self, *args, **kw):
+            super().__init__(*args, **kw)
+            created.append(self)
+    monkeypatch.setattr(pipeline, 'JobQueue', Queue)
+    st.cache_resource.clear()
+    yield created
+    st.cache_resource.clear()
+    for q in created:
+        q.executor.shutdown()
+        q.manager.shutdown()
+
+def test_run_lefse(queues):
+    at = testing.AppTest.from_file(APP, default_timeout=60).run()
+    at.file_uploader[0].set_value(("input.tsv", table(), "text/tab-separated-values")).run()
+    assert not at.exception
+    at.number_input[1].set_value(0)
+    at.button[0].click().run()
+    assert not at.exception
+    job_id = at.query_params["job"]
+    job_id = job_id[0] if isinstance(job_id, list) else job_id
+
+    # one queue without R, the job runs analyse on the uploaded table
+    assert len(queues) == 1
+    status = queues[0].status(job_id)
+    assert status['args'][0].endswith("input.tsv")
+    assert status['kw']['run_kw']['stat_backend'] == 'native'
+    for i in range(120):
+        status = queues[0].status(job_id)
+        if status['state'] not in ('queued', 'running'): break
+        time.sleep(0.5)
+    assert status['state'] == 'done', status.get('error')
+    assert sorted(status['result']) == ['barplot','barplot_png','cladogram','result']
+    assert status['progress']['plots'] == (2,2)
+
+    at.run()
+    assert not at.exception
+    assert not at.error
+    assert "LEfSe Analysis Complete!" in at.success[0].value
+    assert len(at.get("vega_lite_chart")) == 1
+    labels = [b.proto.label for b in at.get("download_button")]
+    assert "📥 Download barplot.png" in labels and "📥 Download cladogram.png" in labels
+
+    # an unknown job after the queue forgot it
+    at.query_params["job"] = "0"*32
+    at.run()
+    assert "找不到此分析" in at.warning[0].value
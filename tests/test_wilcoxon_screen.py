@@ -0,0 +1,91 @@
+# The pre-screen of the repeated Wilcoxon tests run in R (wilcoxon_screen)
+# against test_rep_wilcoxon_r and wilcoxon_pass, with the R rank-sum test
+# replaced by the p-value of test_wilcoxon_native (the same statistic), and
+# its counts of R tests run and skipped in test_feats.
+
+import itertools
+import numpy
+import pytest
+from lefse import lefse, lefse_run
+
+class NativePv:
+    # stands for wilcoxon_pv_r, counting the calls
+    def __init__(self):
+        self.calls = 0
+    def __call__(self, cl1, cl2):
+        self.calls += 1
+        sl = {'x': (0,len(cl1)), 'y': (len(cl1),len(cl1)+len(cl2))}
+        return float(lefse.test_wilcoxon_native(sl, [('x','y')], [numpy.r_[cl1,cl2]])[('x','y')][0])
+
+@pytest.fixture
+def r_pv(monkeypatch):
+    pv = NativePv()
+    monkeypatch.setattr(lefse, 'wilcoxon_pv_r', pv)
+    return pv
+
+def hierarchy(rng):
+    # 2 or 3 classes of 1 to 3 subclasses of 2 to 8 samples, subclass names
+    # shared among the classes for -e 1
+    sl, cl_hie, n = {}, {}, 0
+    for c in ['a','b','c'][:rng.randint(2,4)]:
+        cl_hie[c] = []
+        for s in range(rng.randint(1,4)):
+            k = c+"_s%d" % s
+            m = rng.randint(2,9)
+            sl[k] = (n,n+m)
+            cl_hie[c].append(k)
+            n += m
+    feats = numpy.zeros(n)
+    for c,subs in cl_hie.items():
+        shift = rng.rand()*3.0
+        for k in subs:
+            i,j = sl[k]
+            if rng.rand() < 0.2: feats[i:j] = float(rng.randint(0,2))  # constant subclass
+            else: feats[i:j] = rng.randint(0,6,j-i)*0.5+shift*(rng.rand() < 0.8)
+    return sl, cl_hie, feats
+
+def test_screen_same_result(r_pv):
+    rng = numpy.random.RandomState(1982)
+    results = []
+    for it in range(150):
+        sl, cl_hie, feats = hierarchy(rng)
+        for ms, strict, min_c, same in itertools.product([0,1], [0,1,2], [2,5], [False,True]):
+            th = [0.05,0.2][it % 2]
+            ref = lefse.test_rep_wilcoxon_r(sl,cl_hie,feats,th,ms,strict,"f",min_c,same)
+            res, n_run, n_skip = lefse.wilcoxon_screen(sl,cl_hie,feats,th,ms,strict,min_c,same)
+            assert res == ref
+            detail = lefse.wilcoxon_detail(sl,cl_hie,feats,min_c,same)
+            assert lefse.wilcoxon_pass(detail,list(cl_hie.keys()),th,ms,strict) == ref
+            results.append(ref)
+    assert 0.1 < numpy.mean(results) < 0.9
+
+def test_screen_counts(r_pv):
+    rng = numpy.random.RandomState(1982)
+    sl, cl_hie, feats = hierarchy(rng)
+    cmps = lefse.subclass_cmps(sl,cl_hie,feats,2,False)
+    r_pv.calls = 0
+    res, n_run, n_skip = lefse.wilcoxon_screen(sl,cl_hie,feats,0.05,0,0,2,False)
+    assert n_run == r_pv.calls
+    assert n_run+n_skip == sum([len(tests) for x,y,consistent,tests,n_sub in cmps])
+
+def test_feats_counts(r_pv, monkeypatch):
+    # the R Kruskal-Wallis test replaced by the native one
+    monkeypatch.setattr(lefse_run, 'test_kw_r', lambda cls,feat,p,factors: lefse.test_kw_native(numpy.array(cls['class']),[feat],p)[0])
+    sub = ['a_1','a_2','b_1','b_2','c_1']
+    n = 6
+    sl = dict([(s,(i*n,(i+1)*n)) for i,s in enumerate(sub)])
+    cl_hie = {'a': ['a_1','a_2'], 'b': ['b_1','b_2'], 'c': ['c_1']}
+    cls = {'class': [s[0] for s in sub for i in range(n)], 'subclass': [s for s in sub for i in range(n)]}
+    rng = numpy.random.RandomState(1982)
+    shift = numpy.repeat([0.0,0.0,1.0,1.0,2.0],n)
+    feats = dict([('f%d' % i, rng.rand(len(sub)*n)+shift*rng.rand()) for i in range(40)])
+    params = lefse_run.read_params(["", "in", "out", "--min_c", "3"])
+    res = lefse_run.test_feats(list(feats),feats,cls,sl,cl_hie,params)
+    tested = [name for name,kw_ok,pv,wilc,detail in res if kw_ok]
+    assert 0 < len(tested) < len(feats)
+    n_run, n_skip = lefse_run.wilcoxon_evals
+    assert n_run == r_pv.calls and n_skip > 0
+    assert n_run+n_skip == sum([len(tests) for k in tested for x,y,consistent,tests,n_sub in lefse.subclass_cmps(sl,cl_hie,feats[k],3,False)])
+    for name,kw_ok,pv,wilc,detail in res:
+        if kw_ok: assert wilc == lefse.test_rep_wilcoxon_r(sl,cl_hie,feats[name],0.05,0,0,name,3,False)
+        else: assert wilc is None